@@ -1,82 +1,295 @@
-from django.core.management.base import BaseCommand, CommandError
+from django.core.management.base import BaseCommand
 from django.utils.timezone import now
 from django.core.cache import cache
-from django.db import transaction
+from django.db import connection
 
 from apiserver import secrets, settings
 from apiserver.api import models
 
 from uuid import uuid4
-import subprocess
+import os
 import time
+import zlib
+import shutil
+import sqlite3
+import hashlib
+import tarfile
 
 if settings.DEBUG:
-    API_FOLDER = '.'
     DATA_FOLDER = './data'
     BACKUP_FOLDER = './backups'
+    CACHE_FOLDER = './backup_cache'
 else:
-    API_FOLDER = '/opt/spaceport/apiserver'
     DATA_FOLDER = '/opt/spaceport/apiserver/data'
     BACKUP_FOLDER = '/opt/spaceport/apiserver/backups'
+    CACHE_FOLDER = '/opt/spaceport/apiserver/backup_cache'
+
+DB_FILE = 'db.sqlite3'
+USER_FILE = 'backup_user.txt'
+CANARY_FILE = 'static/123e4567-e89b-12d3-a456-426655440000.jpg'
+# never copied from the data folder, the snapshot and overlays replace them
+SKIP_FILES = {DB_FILE, DB_FILE + '-wal', DB_FILE + '-shm', DB_FILE + '-journal', USER_FILE, CANARY_FILE}
+
+CHUNK_SIZE = 1024 * 1024
+END_OF_ARCHIVE = b'\0' * tarfile.BLOCKSIZE * 2
 
 backup_id_string = lambda x: '{}\t{}\t{}'.format(
     str(now()), x['name'], x['backup_id'],
 )
 
+# Archives are built out of gzip members, which decompress to one stream
+# when concatenated. Anything shared between users or days is compressed
+# once and copied into each archive, only the canaries are per-user.
+
+def compress_to(out, chunks):
+    z = zlib.compressobj(wbits=31)  # gzip member
+    for chunk in chunks:
+        out.write(z.compress(chunk))
+    out.write(z.flush())
+
+def read_chunks(path, start=0, end=None):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        while end is None or f.tell() < end:
+            size = CHUNK_SIZE if end is None else min(CHUNK_SIZE, end - f.tell())
+            chunk = f.read(size)
+            if not chunk: break
+            yield chunk
+
+def copy_to(out, path):
+    for chunk in read_chunks(path):
+        out.write(chunk)
+
+def tar_padding(size):
+    return b'\0' * (-size % tarfile.BLOCKSIZE)
+
+def tar_header(name, size, mtime):
+    info = tarfile.TarInfo('data/' + name)
+    info.size = size
+    info.mtime = mtime
+    info.mode = 0o644
+    return info.tobuf()
+
+def tar_file(name, data):
+    return tar_header(name, len(data), time.time()) + data + tar_padding(len(data))
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    size = 0
+    for chunk in read_chunks(path):
+        digest.update(chunk)
+        size += len(chunk)
+    return digest.hexdigest(), size
+
+def store_file(path, store):
+    '''
+    Compress a file's tar data into the content-addressed store unless a
+    previous run already did, returns its hash and size
+    '''
+    digest, size = hash_file(path)
+    stored = os.path.join(store, digest + '.gz')
+    if os.path.exists(stored):
+        return digest, size
+
+    # hash again while compressing in case the file changed in between
+    new_digest = hashlib.sha256()
+    size = 0
+    temp = stored + '.tmp'
+
+    def chunks():
+        nonlocal size
+        for chunk in read_chunks(path):
+            new_digest.update(chunk)
+            size += len(chunk)
+            yield chunk
+        yield tar_padding(size)
+
+    with open(temp, 'wb') as out:
+        compress_to(out, chunks())
+
+    digest = new_digest.hexdigest()
+    os.replace(temp, os.path.join(store, digest + '.gz'))
+    return digest, size
+
+def snapshot_db(path):
+    '''
+    Copy the live database with SQLite's online backup API, in WAL mode
+    this only holds a read transaction so the site keeps working
+    '''
+    connection.ensure_connection()
+    dest = sqlite3.connect(path)
+    try:
+        connection.connection.backup(dest)
+        dest.execute('PRAGMA journal_mode = DELETE')  # restores as a single file
+    finally:
+        dest.close()
+
+def set_db_canary(path, backup_id):
+    db = sqlite3.connect(path)
+    try:
+        with db:
+            db.execute(
+                'INSERT OR REPLACE INTO {} (id, backup_id) VALUES (0, ?)'.format(models.MetaInfo._meta.db_table),
+                [backup_id],
+            )
+    finally:
+        db.close()
+
+def diff_pages(base_path, path, page_size):
+    '''
+    Split a database file into runs of pages that do or don't match the
+    base file, returns a list of (start, end, same)
+    '''
+    runs = []
+
+    with open(base_path, 'rb') as base, open(path, 'rb') as f:
+        offset = 0
+        while True:
+            page = f.read(page_size)
+            if not page: break
+            same = page == base.read(page_size)
+
+            if runs and runs[-1][2] == same:
+                runs[-1][1] = offset + len(page)
+            else:
+                runs.append([offset, offset + len(page), same])
+            offset += len(page)
+
+    return [tuple(run) for run in runs]
+
+
 class Command(BaseCommand):
     help = 'Generate backups.'
 
-    @transaction.atomic
+    def write_shared(self, path, store):
+        '''
+        Write everything in the data folder except the database and
+        canaries, file contents come from the store
+        '''
+        used = set()
+
+        with open(path, 'wb') as out:
+            for root, dirs, files in os.walk(DATA_FOLDER):
+                dirs.sort()
+                for file in sorted(files):
+                    full_path = os.path.join(root, file)
+                    name = os.path.relpath(full_path, DATA_FOLDER)
+                    if name in SKIP_FILES: continue
+
+                    try:
+                        mtime = os.path.getmtime(full_path)
+                        digest, size = store_file(full_path, store)
+                    except FileNotFoundError:
+                        continue  # deleted while walking
+
+                    compress_to(out, [tar_header(name, size, mtime)])
+                    copy_to(out, os.path.join(store, digest + '.gz'))
+                    used.add(digest + '.gz')
+
+        # whatever today's backup didn't use is gone from the data folder
+        for name in os.listdir(store):
+            if name not in used:
+                os.remove(os.path.join(store, name))
+
+        return len(used)
+
+    def write_archive(self, path, shared, base_db, user_db, page_size, base_runs, canary):
+        temp = path + '.tmp'
+        db_size = os.path.getsize(user_db)
+
+        with open(temp, 'wb') as out:
+            copy_to(out, shared)
+            compress_to(out, [tar_header(DB_FILE, db_size, time.time())])
+
+            for start, end, same in diff_pages(base_db, user_db, page_size):
+                if not same:
+                    compress_to(out, read_chunks(user_db, start, end))
+                    continue
+
+                # unchanged runs are usually the same for every user
+                run = base_runs.get((start, end))
+                if not run:
+                    run = base_runs[start, end] = '{}-{}-{}.gz'.format(base_db, start, end)
+                    with open(run, 'wb') as f:
+                        compress_to(f, read_chunks(base_db, start, end))
+                copy_to(out, run)
+
+            compress_to(out, [
+                tar_padding(db_size),
+                tar_file(USER_FILE, (canary['name'] + '\n').encode()),
+                tar_file(CANARY_FILE, (canary['backup_id'] + '\n').encode()),
+                END_OF_ARCHIVE,
+            ])
+
+        os.replace(temp, path)
+
+    def set_live_canary(self, user, backup_id):
+        models.MetaInfo.objects.update_or_create(
+            id=0,
+            defaults=dict(backup_id=backup_id),
+        )
+        with open(DATA_FOLDER + '/' + USER_FILE, 'w') as f:
+            f.write(user['name'] + '\n')
+        with open(DATA_FOLDER + '/' + CANARY_FILE, 'w') as f:
+            f.write(backup_id + '\n')
+
     def generate_backups(self):
         backup_users = secrets.BACKUP_TOKENS.values()
         count = 0
 
-        for user in backup_users:
-            models.MetaInfo.objects.update_or_create(
-                id=0,
-                defaults=dict(backup_id=backup_id_string(user)),
-            )
-            with open(DATA_FOLDER + '/backup_user.txt', 'w') as f:
-                f.write(user['name'] + '\n')
-            with open(DATA_FOLDER + '/static/123e4567-e89b-12d3-a456-426655440000.jpg', 'w') as f:
-                f.write(backup_id_string(user) + '\n')
+        store = os.path.join(CACHE_FOLDER, 'store')
+        work = os.path.join(CACHE_FOLDER, 'work')
+        shutil.rmtree(work, ignore_errors=True)
+        os.makedirs(store, exist_ok=True)
+        os.makedirs(work)
 
-            if user['name'] == 'null':  # reset the canaries for data-at-rest
-                continue
+        try:
+            base_db = os.path.join(work, DB_FILE)
+            snapshot_db(base_db)
+            db = sqlite3.connect(base_db)
+            page_size = db.execute('PRAGMA page_size').fetchone()[0]
+            db.close()
+            self.stdout.write('Snapshot database: {} bytes'.format(os.path.getsize(base_db)))
 
-            file_name = 'spaceport-backup-{}.tar.gz'.format(
-                str(now().date()),
-            )
+            shared = os.path.join(work, 'shared.gz')
+            files = self.write_shared(shared, store)
+            self.stdout.write('Shared files: {}, {} bytes compressed'.format(files, os.path.getsize(shared)))
 
-            path_name = str(uuid4())
+            base_runs = {}
 
-            full_name = '{}/{}/{}'.format(
-                BACKUP_FOLDER,
-                path_name,
-                file_name,
-            )
+            for user in backup_users:
+                backup_id = backup_id_string(user)
+
+                if user['name'] == 'null':  # reset the canaries for data-at-rest
+                    self.set_live_canary(user, backup_id)
+                    continue
+
+                user_db = os.path.join(work, 'user.sqlite3')
+                shutil.copyfile(base_db, user_db)
+                set_db_canary(user_db, backup_id)
+
+                file_name = 'spaceport-backup-{}.tar.gz'.format(
+                    str(now().date()),
+                )
 
-            mkdir_command = [
-                'mkdir',
-                BACKUP_FOLDER + '/' + path_name,
-            ]
+                path_name = str(uuid4())
+                os.makedirs(os.path.join(BACKUP_FOLDER, path_name))
 
-            tar_command = [
-                'tar',
-                '-czf',
-                full_name,
-                '--directory',
-                API_FOLDER,
-                'data/',
-            ]
+                full_name = '{}/{}/{}'.format(
+                    BACKUP_FOLDER,
+                    path_name,
+                    file_name,
+                )
 
-            subprocess.run(mkdir_command, check=True)
-            subprocess.run(tar_command, check=True)
+                canary = dict(name=user['name'], backup_id=backup_id)
+                self.write_archive(full_name, shared, base_db, user_db, page_size, base_runs, canary)
 
-            cache.set(user['cache_key'], path_name + '/' + file_name)
+                cache.set(user['cache_key'], path_name + '/' + file_name)
 
-            self.stdout.write('Wrote backup for: ' + user['name'])
-            count += 1
+                self.stdout.write('Wrote backup for: ' + user['name'])
+                count += 1
+        finally:
+            shutil.rmtree(work, ignore_errors=True)
 
         return count
 
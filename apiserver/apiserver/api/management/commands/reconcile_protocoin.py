@@ -0,0 +1,66 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Sum
+from apiserver.api import models, utils
+
+import time
+
+class Command(BaseCommand):
+    help = 'Check the protocoin ledger and total supply against the sum of transactions, --fix also creates missing rows. Run it with --fix after the ledger tables are first migrated. Usage example: reconcile_protocoin --fix'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fix', action='store_true', help='Recount balances that don\'t match or are missing.')
+
+    def reconcile_protocoin(self, fix):
+        sums = models.Transaction.objects.exclude(user=None).values('user_id').annotate(total=Sum('protocoin'))
+        sums = {x['user_id']: utils.to_protocoin(x['total']) for x in sums}
+        ledger = dict(models.ProtocoinBalance.objects.values_list('user_id', 'balance'))
+
+        count = 0
+
+        for user_id in sorted(set(sums) | set(ledger)):
+            expected = sums.get(user_id, utils.to_protocoin(0))
+            actual = ledger.get(user_id, None)
+
+            # reads sum the transactions of users without a ledger row,
+            # only ones with transactions need a row
+            if actual is None and not expected:
+                continue
+
+            if actual is not None and utils.to_protocoin(actual) == expected:
+                continue
+
+            self.stdout.write('User {} ledger: {}, transactions: {}'.format(user_id, actual, expected))
+            count += 1
+
+            if fix:
+                utils.update_protocoin_balance(user_id)
+
+        return count
+
+    def reconcile_supply(self, fix):
+        expected = models.Transaction.objects.aggregate(Sum('protocoin'))['protocoin__sum'] or 0
+        expected = utils.to_protocoin(expected)
+        actual = models.ProtocoinSupply.objects.filter(id=utils.PROTOCOIN_SUPPLY_ID).values_list('total', flat=True).first()
+
+        if actual is not None and utils.to_protocoin(actual) == expected:
+            return True
+
+        self.stdout.write('Supply ledger: {}, transactions: {}'.format(actual, expected))
+
+        if fix:
+            utils.update_protocoin_supply()
+
+        return False
+
+    def handle(self, *args, **options):
+        start = time.time()
+
+        count = self.reconcile_protocoin(options['fix'])
+        self.stdout.write('Found {} mismatched balances{}'.format(count, ', fixed' if options['fix'] and count else ''))
+
+        ok = self.reconcile_supply(options['fix'])
+        self.stdout.write('Total supply {}'.format('matches' if ok else 'mismatched'))
+
+        self.stdout.write('Completed in {} s'.format(
+            str(time.time() - start)[:4]
+        ))
@@ -1,6 +1,6 @@
 from django.core.management.base import BaseCommand, CommandError
 from django.utils.timezone import now
-from apiserver.api import models, utils, utils_stats, utils_email
+from apiserver.api import models, utils, utils_stats, utils_email, utils_telemetry
 from datetime import datetime, timedelta
 
 import time
@@ -9,37 +9,16 @@ class Command(BaseCommand):
     help = 'Tasks to run on the portal hourly.'
 
     def generate_stats(self):
-        utils_stats.calc_next_events()
-        counts = utils_stats.calc_member_counts()
-        signup_count = utils_stats.calc_signup_counts()
-
-        # do this hourly in case an admin causes a change
-        models.StatsMemberCount.objects.update_or_create(
-            date=utils.today_local_tz(),
-            defaults=dict(
-                member_count=counts['member_count'],
-                green_count=counts['green_count'],
-                six_month_plus_count=counts['six_month_plus_count'],
-                vetted_count=counts['vetted_count'],
-                subscriber_count=counts['subscriber_count'],
-            ),
-        )
-
-        models.StatsSignupCount.objects.update_or_create(
-            month=utils.today_local_tz().replace(day=1),
-            defaults=dict(signup_count=signup_count),
-        )
+        timings = utils_stats.run_stats()
 
-        utils_stats.calc_drink_sales()
-        utils_stats.calc_card_scans()
-        utils_stats.calc_dues_distribution()
-        utils_stats.calc_year_distribution()
-        utils_stats.calc_cert_distribution()
-        utils_stats.calc_year_attendance()
-        utils_stats.calc_forum_activity()
-        utils_stats.calc_classes_week()
+        for timing in timings:
+            self.stdout.write('    {} {} in {} s'.format(
+                'Calculated' if timing['ok'] else 'Failed',
+                timing['name'],
+                str(timing['seconds'])[:4],
+            ))
 
-        utils.gen_search_strings()
+        return len(timings)
 
     def send_class_reminders(self):
         # sends reminders to instructors that they are teaching a class
@@ -172,8 +151,11 @@ class Command(BaseCommand):
         self.stdout.write('{} - Beginning hourly tasks'.format(str(now())))
         start = time.time()
 
-        self.generate_stats()
-        self.stdout.write('Generated stats')
+        count = self.generate_stats()
+        self.stdout.write('Generated {} stale stats'.format(count))
+
+        count = utils_telemetry.rollup_telemetry()
+        self.stdout.write('Rolled up {} hours of telemetry'.format(count))
 
         #count = self.send_class_reminders()
         #self.stdout.write('Sent {} class reminders'.format(count))
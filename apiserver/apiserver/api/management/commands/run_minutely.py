@@ -1,6 +1,6 @@
 from django.core.management.base import BaseCommand, CommandError
 from django.utils.timezone import now
-from apiserver.api import models, utils, utils_stats
+from apiserver.api import models, utils, utils_stats, utils_telemetry
 
 import time
 
@@ -12,14 +12,20 @@ class Command(BaseCommand):
         self.stdout.write('{} - Beginning minutely tasks'.format(str(now())))
         start = time.time()
 
-        players = utils_stats.check_minecraft_server()
+        results = utils_stats.run_collectors(utils_stats.MINUTELY_COLLECTORS)
+
+        players = results['minecraft_players'] or []
         self.stdout.write('Found Minecraft players: ' + str(players))
-        users = utils_stats.check_mumble_server()
+        users = results['mumble_users'] or []
         self.stdout.write('Found Mumble users: ' + str(users))
-        tasks = utils_stats.check_shopping_list()
+        tasks = results['shopping_list'] or []
         self.stdout.write('Found shopping tasks: ' + str([x['title'] for x in tasks]))
-        tasks = utils_stats.check_maintenance_list()
+        tasks = results['maintenance_list'] or []
         self.stdout.write('Found mainenance tasks: ' + str([x['title'] for x in tasks]))
+        count = utils_stats.flush_card_scans()
+        self.stdout.write('Flushed card scans: ' + str(count))
+        count = utils_telemetry.flush_telemetry()
+        self.stdout.write('Flushed telemetry points: ' + str(count))
 
         self.stdout.write('Completed tasks in {} s'.format(
             str(time.time() - start)[:4]
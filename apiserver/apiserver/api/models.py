@@ -1,5 +1,6 @@
+from collections import Counter
 from datetime import date, datetime
-from django.db import models
+from django.db import models, transaction
 from django.contrib.auth.models import User
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
@@ -76,6 +77,52 @@ class Member(models.Model):
     def __str__(self):
         return getattr(self.user, 'username', 'None')
 
+# transaction fields the protocoin ledger is built from
+PROTOCOIN_FIELDS = {'user', 'user_id', 'protocoin'}
+
+class TransactionQuerySet(models.QuerySet):
+    '''
+    update() and bulk_create() skip the save signals that keep the
+    protocoin ledger, so apply their changes here instead
+    '''
+    def update(self, **kwargs):
+        if PROTOCOIN_FIELDS.isdisjoint(kwargs):
+            return super().update(**kwargs)
+
+        from .utils import apply_protocoin_changes, to_protocoin
+        changes = Counter()
+
+        with transaction.atomic():
+            rows = list(self.values_list('id', 'user_id', 'protocoin'))
+            count = super().update(**kwargs)
+
+            for _, user_id, protocoin in rows:
+                changes[user_id] -= to_protocoin(protocoin)
+
+            ids = [row[0] for row in rows]
+            for i in range(0, len(ids), 500):
+                updated = self.model.objects.filter(id__in=ids[i:i+500]).values_list('user_id', 'protocoin')
+                for user_id, protocoin in updated:
+                    changes[user_id] += to_protocoin(protocoin)
+
+            apply_protocoin_changes(changes)
+
+        return count
+
+    def bulk_create(self, objs, *args, **kwargs):
+        from .utils import apply_protocoin_changes, to_protocoin
+        changes = Counter()
+
+        with transaction.atomic():
+            objs = super().bulk_create(objs, *args, **kwargs)
+
+            for obj in objs:
+                changes[obj.user_id] += to_protocoin(obj.protocoin)
+
+            apply_protocoin_changes(changes)
+
+        return objs
+
 class Transaction(models.Model):
     user = models.ForeignKey(User, related_name='transactions', blank=True, null=True, on_delete=models.SET_NULL)
     recorder = models.ForeignKey(User, related_name=IGNORE, blank=True, null=True, on_delete=models.SET_NULL)
@@ -96,16 +143,49 @@ class Transaction(models.Model):
     paypal_subscr_id = models.CharField(max_length=32, blank=True, null=True)
     protocoin = models.DecimalField(max_digits=7, decimal_places=2, default=0)
 
+    vending_machine = models.CharField(max_length=32, blank=True, null=True, db_index=True)
+    vending_item = models.CharField(max_length=8, blank=True, null=True)
+
     report_type = models.TextField(blank=True, null=True)
     report_memo = models.TextField(blank=True, null=True)
 
     history = HistoricalRecords()
 
+    objects = TransactionQuerySet.as_manager()
+
     list_display = ['date', 'user', 'amount', 'protocoin', 'account_type', 'category']
     search_fields = ['date', 'user__username', 'account_type', 'category']
     def __str__(self):
         return '%s tx %s' % (getattr(self.user, 'username', 'None'), self.date)
 
+    # signals update the protocoin ledger inside the same transaction
+    def save(self, *args, **kwargs):
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            return super().delete(*args, **kwargs)
+
+class ProtocoinBalance(models.Model):
+    user = models.OneToOneField(User, related_name='protocoin_balance', on_delete=models.CASCADE)
+    balance = models.DecimalField(max_digits=9, decimal_places=2, default=0)
+
+    # no history, rebuilt from transactions
+
+    list_display = ['user', 'balance']
+    search_fields = ['user__username']
+    def __str__(self):
+        return '%s balance %s' % (self.user.username, self.balance)
+
+class ProtocoinSupply(models.Model):
+    total = models.DecimalField(max_digits=11, decimal_places=2, default=0)
+
+    # no history, single row rebuilt from transactions
+
+    list_display = ['total']
+    search_fields = ['total']
+
 class PayPalHint(models.Model):
     user = models.ForeignKey(User, related_name='paypal_hints', blank=True, null=True, on_delete=models.SET_NULL)
 
@@ -237,9 +317,41 @@ class StatsSignupCount(models.Model):
 class StatsSpaceActivity(models.Model):
     date = models.DateField(default=today_local_tz)
     card_scans = models.IntegerField()
+    member_scans = models.IntegerField(blank=True, null=True)
+
+    list_display = ['date', 'card_scans', 'member_scans']
+    search_fields = ['date', 'card_scans', 'member_scans']
+
+class VendingSlot(models.Model):
+    machine = models.CharField(max_length=32, default='pop')
+    number = models.CharField(max_length=8)
+    name = models.CharField(max_length=32)
+    short_name = models.CharField(max_length=11, blank=True, null=True)
+    color = models.CharField(max_length=16, blank=True, null=True)
+    since = models.DateField(default=today_local_tz)
+
+    history = HistoricalRecords()
+
+    list_display = ['machine', 'number', 'name', 'since']
+    search_fields = ['machine', 'number', 'name', 'since']
+    def __str__(self):
+        return '%s #%s %s' % (self.machine, self.number, self.name)
+
+class TelemetryPoint(models.Model):
+    source = models.CharField(max_length=32)
+    device = models.CharField(max_length=64)
+    time = models.DateTimeField()
+    resolution = models.CharField(max_length=8, default='raw')
+    count = models.IntegerField(default=1)
+    data = models.JSONField()
+
+    # no history
+
+    class Meta:
+        indexes = [models.Index(fields=['source', 'time'])]
 
-    list_display = ['date', 'card_scans']
-    search_fields = ['date', 'card_scans']
+    list_display = ['time', 'source', 'device', 'resolution', 'count']
+    search_fields = ['time', 'source', 'device', 'resolution']
 
 class PinballScore(models.Model):
     user = models.ForeignKey(User, related_name='scores', blank=True, null=True, on_delete=models.SET_NULL)
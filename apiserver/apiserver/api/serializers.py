@@ -125,7 +125,7 @@ class TransactionSerializer(serializers.ModelSerializer):
 
         if validated_data['protocoin'] < 0:
             user = validated_data['user']
-            current_protocoin = user.transactions.aggregate(Sum('protocoin'))['protocoin__sum'] or 0
+            current_protocoin = utils.get_protocoin_balance(user)
             new_protocoin = current_protocoin + validated_data['protocoin']
             if new_protocoin < 0:
                 raise ValidationError(dict(category='Insufficient funds. Member only has {} protocoin.'.format(current_protocoin)))
@@ -146,7 +146,7 @@ class TransactionSerializer(serializers.ModelSerializer):
         if validated_data['protocoin'] < 0:
             user = validated_data['user']
             # when updating, we need to subtract out the transaction being edited
-            current_protocoin = (user.transactions.aggregate(Sum('protocoin'))['protocoin__sum'] or 0) - instance.protocoin
+            current_protocoin = utils.get_protocoin_balance(user) - instance.protocoin
             new_protocoin = current_protocoin + validated_data['protocoin']
             if new_protocoin < 0:
                 msg = 'Negative Protocoin transaction updated:\n' + str(validated_data)
@@ -331,14 +331,10 @@ class MemberSerializer(serializers.ModelSerializer):
         return []
 
     def get_protocoin(self, obj):
-        transactions = obj.user.transactions
-        total = transactions.aggregate(Sum('protocoin'))['protocoin__sum'] or 0
-        return total
+        return utils.get_protocoin_balance(obj.user)
 
     def get_total_protocoin(self, obj):
-        transactions = models.Transaction.objects
-        total = transactions.aggregate(Sum('protocoin'))['protocoin__sum'] or 0
-        return total
+        return utils.get_protocoin_supply()
 
     def get_signup_helper(self, obj):
         if not obj.signup_helper: return None
@@ -1,15 +1,37 @@
 import logging
 logger = logging.getLogger(__name__)
 
+from collections import Counter
+
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.backends.signals import connection_created
+from django.db.models.signals import pre_save, post_save, pre_delete, post_delete
 from django.dispatch import receiver
 from simple_history.signals import (
     pre_create_historical_record,
     post_create_historical_record
 )
 
-from . import models
+from . import models, utils, utils_db, utils_stats
 from .permissions import is_admin_director
 
+# fields that make up a member's search string, see utils.gen_search_string()
+SEARCH_MEMBER_FIELDS = {'preferred_name', 'last_name', 'first_name', 'discourse_username', 'user'}
+
+# card fields that don't affect the door and lockout lists
+CARD_SEEN_FIELDS = {'last_seen', 'last_seen_at'}
+
+# member fields the door and lockout lists are built from
+MEMBER_CARD_LIST_FIELDS = [
+    'user_id', 'preferred_name', 'last_name', 'paused_date', 'is_allowed_entry', 'vetted_date', 'orientation_date',
+] + [field.attname for field in models.Member._meta.fields if field.name.endswith('_cert_date')]
+
+@receiver(connection_created, dispatch_uid='sqlite_pragmas')
+def sqlite_pragmas_callback(sender, connection, **kwargs):
+    if connection.vendor != 'sqlite': return
+    utils_db.set_pragmas(connection)
+
 def get_object_owner(obj):
     full_name = lambda member: member.preferred_name + ' ' + member.last_name
 
@@ -96,3 +118,103 @@ def post_create_historical_record_callback(
         logger.info(str(history_instance))
         logger.info(str(history_change_reason))
         logger.info(str(history_user))
+
+
+def update_search_strings_on_commit(member_ids):
+    member_ids = [x for x in member_ids if x]
+    if member_ids:
+        transaction.on_commit(lambda: utils.update_search_strings(member_ids))
+
+@receiver(post_save, sender=models.Member, dispatch_uid='member_search_save')
+@receiver(post_delete, sender=models.Member, dispatch_uid='member_search_delete')
+def member_search_callback(sender, instance, raw=False, update_fields=None, **kwargs):
+    if raw: return
+    if update_fields and not set(update_fields) & SEARCH_MEMBER_FIELDS: return
+    update_search_strings_on_commit([instance.id])
+
+@receiver(post_save, sender=User, dispatch_uid='user_search_save')
+def user_search_callback(sender, instance, raw=False, update_fields=None, **kwargs):
+    # skips the last_login update on every login
+    if raw: return
+    if update_fields and 'email' not in update_fields: return
+    member_ids = models.Member.objects.filter(user=instance).values_list('id', flat=True)
+    update_search_strings_on_commit(list(member_ids))
+
+@receiver(pre_delete, sender=User, dispatch_uid='user_search_pre_delete')
+def user_search_pre_delete_callback(sender, instance, **kwargs):
+    # member.user gets nulled without a signal, so remember who it was
+    instance._search_member_ids = list(models.Member.objects.filter(user=instance).values_list('id', flat=True))
+
+@receiver(post_delete, sender=User, dispatch_uid='user_search_delete')
+def user_search_delete_callback(sender, instance, **kwargs):
+    update_search_strings_on_commit(getattr(instance, '_search_member_ids', []))
+
+@receiver(pre_save, sender=models.StorageSpace, dispatch_uid='storage_search_pre_save')
+def storage_search_pre_save_callback(sender, instance, raw=False, **kwargs):
+    # remember the previous owner so their shelf gets removed
+    if raw or not instance.pk: return
+    instance._search_old_user_id = sender.objects.filter(pk=instance.pk).values_list('user_id', flat=True).first()
+
+@receiver(post_save, sender=models.StorageSpace, dispatch_uid='storage_search_save')
+@receiver(post_delete, sender=models.StorageSpace, dispatch_uid='storage_search_delete')
+def storage_search_callback(sender, instance, raw=False, **kwargs):
+    if raw: return
+    user_ids = {instance.user_id, getattr(instance, '_search_old_user_id', None)}
+    member_ids = models.Member.objects.filter(user_id__in=user_ids).values_list('id', flat=True)
+    update_search_strings_on_commit(list(member_ids))
+
+
+@receiver(post_save, sender=models.Card, dispatch_uid='card_list_save')
+@receiver(post_delete, sender=models.Card, dispatch_uid='card_list_delete')
+@receiver(post_delete, sender=models.Member, dispatch_uid='member_card_list_delete')
+def card_list_callback(sender, instance, raw=False, update_fields=None, **kwargs):
+    # cached door and lockout lists are keyed on last_card_change
+    if raw: return
+    if update_fields and set(update_fields) <= CARD_SEEN_FIELDS: return
+    transaction.on_commit(utils_stats.changed_card)
+
+@receiver(pre_save, sender=models.Member, dispatch_uid='member_card_list_pre_save')
+def member_card_list_pre_save_callback(sender, instance, raw=False, **kwargs):
+    # remember the fields the lists use, most member edits don't touch them
+    if raw or not instance.pk: return
+    instance._card_list_old = sender.objects.filter(pk=instance.pk).values_list(*MEMBER_CARD_LIST_FIELDS).first()
+
+@receiver(post_save, sender=models.Member, dispatch_uid='member_card_list_save')
+def member_card_list_save_callback(sender, instance, raw=False, **kwargs):
+    if raw: return
+    new = tuple(getattr(instance, field) for field in MEMBER_CARD_LIST_FIELDS)
+    if getattr(instance, '_card_list_old', None) == new: return
+    transaction.on_commit(utils_stats.changed_card)
+
+
+@receiver(post_save, dispatch_uid='stats_dirty_save')
+@receiver(post_delete, dispatch_uid='stats_dirty_delete')
+def stats_dirty_callback(sender, raw=False, **kwargs):
+    # lets run_hourly skip stats whose inputs haven't changed
+    if raw: return
+    model_name = sender.__name__
+    if model_name not in utils_stats.STATS_MODELS: return
+    transaction.on_commit(lambda: utils_stats.mark_model_changed(model_name))
+
+
+@receiver(pre_save, sender=models.Transaction, dispatch_uid='protocoin_pre_save')
+def protocoin_pre_save_callback(sender, instance, raw=False, **kwargs):
+    # remember what the transaction counted for before it was edited
+    if raw or not instance.pk: return
+    instance._protocoin_old = sender.objects.filter(pk=instance.pk).values_list('user_id', 'protocoin').first()
+
+@receiver(post_save, sender=models.Transaction, dispatch_uid='protocoin_save')
+def protocoin_save_callback(sender, instance, raw=False, **kwargs):
+    if raw: return
+    changes = Counter()
+
+    old = getattr(instance, '_protocoin_old', None)
+    if old:
+        changes[old[0]] -= utils.to_protocoin(old[1])
+    changes[instance.user_id] += utils.to_protocoin(instance.protocoin)
+
+    utils.apply_protocoin_changes(changes)
+
+@receiver(post_delete, sender=models.Transaction, dispatch_uid='protocoin_delete')
+def protocoin_delete_callback(sender, instance, **kwargs):
+    utils.apply_protocoin_changes({instance.user_id: -utils.to_protocoin(instance.protocoin)})
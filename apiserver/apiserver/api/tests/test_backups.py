@@ -0,0 +1,103 @@
+from django.test import TransactionTestCase, override_settings
+import io
+import os
+import sqlite3
+import tarfile
+import tempfile
+from unittest.mock import patch
+from django.core.cache import cache
+from django.core.management import call_command
+
+from apiserver import secrets
+from apiserver.api import models
+from apiserver.api.management.commands import generate_backups
+
+BACKUP_TOKENS = {
+    'token1': dict(name='alice.backup', backup_id='canary1', cache_key='backup1'),
+    'token2': dict(name='bob.backup', backup_id='canary2', cache_key='backup2'),
+    'token3': dict(name='null', backup_id='canary3', cache_key='backup3'),
+}
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class TestGenerateBackups(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        self.folder = tempfile.TemporaryDirectory()
+        self.data = os.path.join(self.folder.name, 'data')
+        self.backups = os.path.join(self.folder.name, 'backups')
+        self.store = os.path.join(self.folder.name, 'cache', 'store')
+
+        os.makedirs(os.path.join(self.data, 'static'))
+        self.write_data('static/photo.jpg', b'photo' * 1000)
+        self.write_data('db.sqlite3', b'not the live db')
+
+        user = models.User.objects.create(username='member.one', email='one@email.com')
+        models.Member.objects.create(user=user, first_name='Member', last_name='One', preferred_name='Member')
+
+        patches = [
+            patch.object(generate_backups, 'DATA_FOLDER', self.data),
+            patch.object(generate_backups, 'BACKUP_FOLDER', self.backups),
+            patch.object(generate_backups, 'CACHE_FOLDER', os.path.join(self.folder.name, 'cache')),
+            patch.object(secrets, 'BACKUP_TOKENS', BACKUP_TOKENS),
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def write_data(self, name, data):
+        with open(os.path.join(self.data, name), 'wb') as f:
+            f.write(data)
+
+    def run_backups(self):
+        call_command('generate_backups', stdout=io.StringIO())
+
+    def open_backup(self, cache_key):
+        return tarfile.open(os.path.join(self.backups, cache.get(cache_key)), 'r:gz')
+
+    def test_archives(self):
+        self.run_backups()
+
+        for token in ['token1', 'token2']:
+            user = BACKUP_TOKENS[token]
+
+            with self.open_backup(user['cache_key']) as tar:
+                self.assertEqual(tar.extractfile('data/static/photo.jpg').read(), b'photo' * 1000)
+                self.assertEqual(tar.extractfile('data/backup_user.txt').read(), (user['name'] + '\n').encode())
+                canary = tar.extractfile('data/static/123e4567-e89b-12d3-a456-426655440000.jpg').read().decode()
+                self.assertTrue(canary.endswith(user['backup_id'] + '\n'))
+
+                tar.extract('data/db.sqlite3', self.folder.name)
+
+            db = sqlite3.connect(os.path.join(self.folder.name, 'data/db.sqlite3'))
+            backup_id = db.execute('SELECT backup_id FROM api_metainfo WHERE id = 0').fetchone()[0]
+            members = db.execute('SELECT preferred_name FROM api_member').fetchall()
+            db.close()
+
+            self.assertEqual(backup_id + '\n', canary)
+            self.assertEqual(members, [('Member',)])
+
+        self.assertIsNone(cache.get('backup3'))
+        self.assertIn('canary3', models.MetaInfo.objects.get(id=0).backup_id)
+
+    def test_store_dedup(self):
+        self.run_backups()
+        self.assertEqual(len(os.listdir(self.store)), 1)
+        stored = os.path.join(self.store, os.listdir(self.store)[0])
+        os.utime(stored, (0, 0))
+
+        self.write_data('static/other.jpg', b'other')
+        self.run_backups()
+        self.assertEqual(len(os.listdir(self.store)), 2)
+        self.assertEqual(os.path.getmtime(stored), 0)  # not compressed again
+
+        os.remove(os.path.join(self.data, 'static/photo.jpg'))
+        self.run_backups()
+        self.assertFalse(os.path.exists(stored))
+
+        with self.open_backup('backup1') as tar:
+            self.assertNotIn('data/static/photo.jpg', tar.getnames())
+            self.assertEqual(tar.extractfile('data/static/other.jpg').read(), b'other')
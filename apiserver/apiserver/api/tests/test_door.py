@@ -0,0 +1,267 @@
+from django.test import TestCase, override_settings
+import json
+from unittest.mock import patch
+from django.core.cache import cache
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient
+
+from apiserver.api import utils, utils_stats, models
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class TestDoorList(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+
+        user = models.User.objects.create(username='door.user', email='door@email.com')
+        self.member = models.Member.objects.create(
+            user=user,
+            first_name='Door',
+            last_name='User',
+            preferred_name='Door',
+            vetted_date=utils.today_local_tz(),
+        )
+        models.Card.objects.create(user=user, card_number='0000AAAA', active_status='card_active')
+
+    def get(self, etag=None):
+        headers = {'HTTP_IF_NONE_MATCH': etag} if etag else {}
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/door/', **headers)
+        return response, len(queries)
+
+    def test_list(self):
+        response, _ = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, {'0000AAAA': 'Door U ({})'.format(self.member.id)})
+        self.assertTrue(response['ETag'].startswith('"door-'))
+
+    def test_not_modified(self):
+        response, _ = self.get()
+        etag = response['ETag']
+
+        response, num_queries = self.get(etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        self.assertEqual(num_queries, 0)
+
+    def test_cached(self):
+        self.get()
+        response, num_queries = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(num_queries, 0)
+
+    def test_changed_card(self):
+        response, _ = self.get()
+        etag = response['ETag']
+
+        self.member.paused_date = utils.today_local_tz()
+        self.member.save()
+        utils_stats.changed_card()  # on_commit doesn't fire in TestCase
+
+        response, _ = self.get(etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(response.data, {})
+
+    def test_member_edits(self):
+        with patch('django.db.transaction.on_commit', lambda func: func()), \
+                patch.object(utils_stats, 'changed_card') as mock_changed:
+            self.member.phone = '555-1234'
+            self.member.public_bio = 'hello'
+            self.member.save()
+            self.assertFalse(mock_changed.called)
+
+            self.member.lathe_cert_date = utils.today_local_tz()
+            self.member.save()
+            self.assertEqual(mock_changed.call_count, 1)
+
+            self.member.delete()
+            self.assertEqual(mock_changed.call_count, 2)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class TestCardChanges(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+
+        user = models.User.objects.create(username='door.user', email='door@email.com')
+        self.member = models.Member.objects.create(
+            user=user,
+            first_name='Door',
+            last_name='User',
+            preferred_name='Door',
+            vetted_date=utils.today_local_tz(),
+        )
+        self.card = models.Card.objects.create(user=user, card_number='0000AAAA', active_status='card_active')
+
+    def changes(self, since='', name='door'):
+        response = self.client.get('/{}/changes/'.format(name), {'since': since})
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_full_without_version(self):
+        data = self.changes()
+        self.assertTrue(data['full'])
+        self.assertIn('0000AAAA', data['cards'])
+
+    def test_no_changes(self):
+        version = self.changes()['version']
+        data = self.changes(version)
+        self.assertFalse(data['full'])
+        self.assertEqual(data['changed'], {})
+        self.assertEqual(data['revoked'], [])
+
+    def test_added(self):
+        version = self.changes()['version']
+        models.Card.objects.create(user=self.member.user, card_number='0000BBBB', active_status='card_active')
+
+        data = self.changes(version)
+        self.assertFalse(data['full'])
+        self.assertEqual(list(data['changed'].keys()), ['0000BBBB'])
+        self.assertEqual(data['revoked'], [])
+
+    def test_paused(self):
+        version = self.changes()['version']
+        self.member.paused_date = utils.today_local_tz()
+        self.member.save()
+
+        data = self.changes(version)
+        self.assertEqual(data['changed'], {})
+        self.assertEqual(data['revoked'], ['0000AAAA'])
+
+    def test_renumbered(self):
+        version = self.changes(name='lockout')['version']
+        self.card.card_number = '0000CCCC'
+        self.card.save()
+
+        data = self.changes(version, name='lockout')
+        self.assertEqual(list(data['changed'].keys()), ['0000CCCC'])
+        self.assertEqual(data['changed']['0000CCCC']['name'], 'Door User')
+        self.assertEqual(data['revoked'], ['0000AAAA'])
+
+    def test_bad_version(self):
+        for since in ['garbage', '999999-999999']:
+            data = self.changes(since)
+            self.assertTrue(data['full'])
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class TestLockoutList(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+
+        for i in range(10):
+            user = models.User.objects.create(username='lockout.user{}'.format(i), email='lockout{}@email.com'.format(i))
+            models.Member.objects.create(
+                user=user,
+                first_name='Lockout',
+                last_name='User{}'.format(i),
+                preferred_name='Lockout',
+                vetted_date=utils.today_local_tz() if i % 2 else None,
+                lathe_cert_date=utils.today_local_tz(),
+                tormach_cnc_cert_date=utils.today_local_tz() if i % 3 else None,
+                paused_date=utils.today_local_tz() if i == 9 else None,
+            )
+            models.Card.objects.create(user=user, card_number='0000{:04d}'.format(i), active_status='card_active')
+
+    def test_authorization(self):
+        response = self.client.get('/lockout/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data), 9)
+
+        authorization = response.data['00000001']
+        self.assertEqual(authorization['name'], 'Lockout User1')
+        self.assertTrue(authorization['common'])
+        self.assertTrue(authorization['lathe'])
+        self.assertTrue(authorization['cnc'])
+        self.assertTrue(authorization['tormach_cnc'])
+        self.assertFalse(authorization['mill'])
+
+        # not vetted, certs don't count
+        authorization = response.data['00000002']
+        self.assertFalse(authorization['common'])
+        self.assertFalse(authorization['lathe'])
+
+    def test_one_query(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get('/lockout/')
+        self.assertEqual(len(queries), 1)
+
+        response = self.client.get('/lockout/', HTTP_IF_NONE_MATCH=self.client.get('/lockout/')['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class TestCardChangePublish(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    @patch('apiserver.api.utils.mqtt_publish')
+    def test_publish_retained(self, mock_publish):
+        with patch('apiserver.secrets.MQTT_WRITER_PASSWORD', 'password'):
+            version = utils_stats.changed_card()
+
+        topic, message = mock_publish.call_args[0]
+        self.assertEqual(topic, 'spaceport/cards/version')
+        self.assertTrue(mock_publish.call_args[1]['retain'])
+
+        message = json.loads(message)
+        self.assertEqual(message['last_card_change'], version)
+        self.assertEqual(message['history_version'], utils.get_card_history_version())
+
+    @patch('apiserver.api.utils.mqtt_publish')
+    def test_no_mqtt(self, mock_publish):
+        with patch('apiserver.secrets.MQTT_WRITER_PASSWORD', ''):
+            utils_stats.changed_card()
+
+        self.assertFalse(mock_publish.called)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class TestCardScans(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+
+        for i in range(2):
+            user = models.User.objects.create(username='scan.user{}'.format(i), email='scan{}@email.com'.format(i))
+            models.Member.objects.create(user=user, first_name='Scan', last_name='User', preferred_name='Scan')
+            models.Card.objects.create(user=user, card_number='1111000{}'.format(i), active_status='card_active')
+
+        # second card for the first member
+        models.Card.objects.create(user=models.User.objects.get(username='scan.user0'), card_number='11110002', active_status='card_active')
+
+    def scan(self, card_number):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post('/door/{}/seen/'.format(card_number))
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_counts(self):
+        for card_number in ['11110000', '11110000', '11110001', '11110002']:
+            self.scan(card_number)
+
+        self.assertEqual(cache.get('card_scans'), 3)
+        self.assertEqual(cache.get('member_scans'), 2)
+
+        utils_stats.flush_card_scans()
+        activity = models.StatsSpaceActivity.objects.get(date=utils.today_local_tz())
+        self.assertEqual(activity.card_scans, 3)
+        self.assertEqual(activity.member_scans, 2)
+
+    def test_recount_matches(self):
+        for card_number in ['11110000', '11110001', '11110002']:
+            self.scan(card_number)
+
+        cache.set('card_scans', 99)
+        utils_stats.calc_card_scans()
+        self.assertEqual(cache.get('card_scans'), 3)
+        self.assertEqual(cache.get('member_scans'), 2)
+
+    def test_scan_queries(self):
+        self.assertEqual(self.scan('11110000'), 2)  # card lookup, update
+        self.assertFalse(models.Card.history.filter(card_number='11110000', history_type='~').exists())
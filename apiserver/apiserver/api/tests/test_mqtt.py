@@ -0,0 +1,76 @@
+from django.test import TestCase
+import time
+import paho.mqtt.client as mqtt
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+
+from apiserver.api import utils_mqtt
+
+
+class FakeInfo:
+    def __init__(self, rc):
+        self.rc = rc
+
+
+class FakeClient:
+    def __init__(self):
+        self.published = []
+        self.on_connect = None
+        self.on_disconnect = None
+
+    def connect_async(self, host, port, keepalive):
+        pass
+
+    def loop_start(self):
+        self.on_connect(self, None, {}, 0)
+
+    def publish(self, topic, message, qos, retain):
+        self.published.append((topic, message, qos, retain))
+        return FakeInfo(mqtt.MQTT_ERR_SUCCESS)
+
+
+class TestPublisher(TestCase):
+    def test_publish(self):
+        client = FakeClient()
+        publisher = utils_mqtt.Publisher(client_factory=lambda: client)
+
+        publisher.publish('spaceport/test', 'one')
+        publisher.publish('spaceport/test', 'two', qos=1, retain=True)
+        self.assertTrue(publisher.flush())
+
+        self.assertEqual(client.published, [
+            ('spaceport/test', 'one', 0, False),
+            ('spaceport/test', 'two', 1, True),
+        ])
+        self.assertEqual(publisher.metrics(), dict(depth=0, sent=2, dropped=0, connected=True))
+
+    def test_queue_full(self):
+        publisher = utils_mqtt.Publisher(maxsize=2)
+        publisher.start = lambda: None  # never sends
+
+        with self.assertLogs('apiserver.api.utils_mqtt', level='WARNING') as logs:
+            self.assertTrue(publisher.publish('spaceport/one', 'one'))
+            self.assertTrue(publisher.publish('spaceport/two', 'two'))
+            self.assertFalse(publisher.publish('spaceport/three', 'three'))
+            self.assertTrue(publisher.publish('spaceport/four', 'four', qos=1))
+
+        # the evicted message is the one logged, not the new one
+        self.assertIn('spaceport/three', logs.output[0])
+        self.assertIn('spaceport/one', logs.output[1])
+
+        messages = [publisher.queue.get_nowait()[1] for _ in range(2)]
+        self.assertEqual(messages, ['two', 'four'])
+        self.assertEqual(publisher.metrics()['dropped'], 2)
+
+    def test_one_publisher_per_process(self):
+        class SlowPublisher:
+            def __init__(self):
+                time.sleep(0.01)  # widen the race
+
+        with patch.object(utils_mqtt, 'Publisher', SlowPublisher), \
+                patch.object(utils_mqtt, 'publisher', None), \
+                patch.object(utils_mqtt, 'publisher_pid', None):
+            with ThreadPoolExecutor(10) as executor:
+                publishers = list(executor.map(lambda i: utils_mqtt.get_publisher(), range(10)))
+
+        self.assertEqual(len(set(map(id, publishers))), 1)
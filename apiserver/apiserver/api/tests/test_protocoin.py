@@ -0,0 +1,265 @@
+from django.test import TestCase, TransactionTestCase, override_settings
+import io
+from decimal import Decimal
+from unittest.mock import patch
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.db.utils import OperationalError
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient
+
+from apiserver.api import utils, utils_db, models
+
+
+def add_tx(user, protocoin):
+    return models.Transaction.objects.create(
+        user=user,
+        protocoin=protocoin,
+        amount=0,
+        account_type='Protocoin',
+        category='Other',
+    )
+
+def ledger(user):
+    return models.ProtocoinBalance.objects.get(user=user).balance
+
+
+class TestProtocoinLedger(TestCase):
+    def setUp(self):
+        self.users = []
+        for name in ['alice', 'bob']:
+            user = models.User.objects.create(username=name, email=name + '@email.com')
+            models.Member.objects.create(user=user, first_name=name.title(), last_name='Coin', preferred_name=name.title())
+            self.users.append(user)
+
+        self.alice, self.bob = self.users
+
+    def test_create_edit_delete(self):
+        tx = add_tx(self.alice, 10)
+        add_tx(self.alice, -2.35)  # views pass floats
+        self.assertEqual(ledger(self.alice), Decimal('7.65'))
+
+        tx.protocoin = 20
+        tx.save()
+        self.assertEqual(ledger(self.alice), Decimal('17.65'))
+
+        tx.user = self.bob
+        tx.save()
+        self.assertEqual(ledger(self.alice), Decimal('-2.35'))
+        self.assertEqual(ledger(self.bob), Decimal('20.00'))
+
+        tx.delete()
+        self.assertEqual(ledger(self.bob), Decimal('0.00'))
+
+    def test_missing_row_recounted(self):
+        add_tx(self.alice, 5)
+        models.ProtocoinBalance.objects.all().delete()
+        models.ProtocoinSupply.objects.all().delete()
+
+        self.assertEqual(utils.get_protocoin_balance(self.alice), Decimal('5.00'))
+        self.assertEqual(utils.get_protocoin_supply(), Decimal('5.00'))
+        self.assertFalse(models.ProtocoinBalance.objects.exists())  # reads don't write
+        self.assertFalse(models.ProtocoinSupply.objects.exists())
+
+        add_tx(self.alice, 1)
+        self.assertEqual(ledger(self.alice), Decimal('6.00'))
+
+    def test_bulk_paths(self):
+        models.Transaction.objects.bulk_create([
+            models.Transaction(user=self.alice, protocoin=10, amount=0),
+            models.Transaction(user=self.bob, protocoin=3, amount=0),
+            models.Transaction(user=None, protocoin=1, amount=0),
+        ])
+        self.assertEqual(ledger(self.alice), Decimal('10.00'))
+        self.assertEqual(ledger(self.bob), Decimal('3.00'))
+        self.assertEqual(utils.get_protocoin_supply(), Decimal('14.00'))
+
+        models.Transaction.objects.filter(user=self.alice).update(user=self.bob)
+        self.assertEqual(ledger(self.alice), Decimal('0.00'))
+        self.assertEqual(ledger(self.bob), Decimal('13.00'))
+
+        models.Transaction.objects.filter(user=None).update(protocoin=5)
+        self.assertEqual(utils.get_protocoin_supply(), Decimal('18.00'))
+
+        models.Transaction.objects.update(memo='untouched ledger')
+        self.assertEqual(ledger(self.bob), Decimal('13.00'))
+
+    def test_vend_balance_single_row(self):
+        add_tx(self.alice, 10)
+        models.Card.objects.create(user=self.alice, card_number='0000BEEF', active_status='card_active')
+
+        with CaptureQueriesContext(connection) as queries:
+            response = APIClient().get('/protocoin/0000BEEF/card_vend_balance/')
+
+        self.assertEqual(response.data['balance'], 10.0)
+        self.assertFalse(any('SUM(' in q['sql'] for q in queries))
+
+    def test_supply(self):
+        add_tx(self.alice, 10)
+        tx = add_tx(None, 2.5)
+        self.assertEqual(utils.get_protocoin_supply(), Decimal('12.50'))
+
+        tx.user = self.bob
+        tx.save()
+        add_tx(self.bob, -1)
+        self.assertEqual(utils.get_protocoin_supply(), Decimal('11.50'))
+
+        tx.delete()
+        self.assertEqual(utils.get_protocoin_supply(), Decimal('9.00'))
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_supply_cache_invalidated(self):
+        cache.clear()
+        add_tx(self.alice, 10)
+        self.assertEqual(utils.get_protocoin_supply(), Decimal('10.00'))
+
+        # TestCase never commits, run the invalidation right away
+        with patch('django.db.transaction.on_commit', lambda func: func()):
+            add_tx(self.bob, 5)
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(utils.get_protocoin_supply(), Decimal('15.00'))
+            self.assertEqual(utils.get_protocoin_supply(), Decimal('15.00'))
+        self.assertEqual(len(queries), 1)
+
+    def test_user_no_sums(self):
+        add_tx(self.alice, 10)
+        add_tx(self.bob, 10)
+        client = APIClient()
+        client.force_authenticate(user=self.alice)
+
+        with CaptureQueriesContext(connection) as queries:
+            response = client.get('/user/')
+
+        self.assertEqual(response.data['member']['protocoin'], Decimal('10.00'))
+        self.assertEqual(response.data['member']['total_protocoin'], Decimal('20.00'))
+        self.assertFalse(any('SUM(' in q['sql'] for q in queries))
+
+    def test_reconcile(self):
+        add_tx(self.alice, 10)
+        add_tx(self.bob, 3)
+        models.ProtocoinBalance.objects.filter(user=self.bob).update(balance=99)
+
+        out = io.StringIO()
+        call_command('reconcile_protocoin', stdout=out)
+        self.assertIn('Found 1 mismatched balances', out.getvalue())
+        self.assertEqual(ledger(self.bob), Decimal('99.00'))
+
+        models.ProtocoinSupply.objects.update(total=0)
+        call_command('reconcile_protocoin', '--fix', stdout=out)
+        self.assertEqual(ledger(self.bob), Decimal('3.00'))
+        self.assertIn('Total supply mismatched', out.getvalue())
+        self.assertEqual(utils.get_protocoin_supply(), Decimal('13.00'))
+
+        out = io.StringIO()
+        call_command('reconcile_protocoin', stdout=out)
+        self.assertIn('Found 0 mismatched balances', out.getvalue())
+        self.assertIn('Total supply matches', out.getvalue())
+
+
+@patch('time.sleep')
+class TestAtomicRetry(TestCase):
+    def setUp(self):
+        utils_db.retry_metrics.clear()
+
+    def test_retries_until_free(self, sleep):
+        errors = [OperationalError('database is locked')] * 2
+
+        @utils_db.atomic_retry
+        def flaky():
+            if errors:
+                raise errors.pop()
+            return 'done'
+
+        self.assertEqual(flaky(), 'done')
+        self.assertEqual(sleep.call_count, 2)
+        self.assertLessEqual(sleep.call_args_list[1][0][0], utils_db.RETRY_BASE_DELAY * 2)
+        self.assertEqual(utils_db.retry_metrics['flaky_retried'], 2)
+
+    def test_other_errors_raised(self, sleep):
+        @utils_db.atomic_retry
+        def broken():
+            raise OperationalError('no such table: nope')
+
+        with self.assertRaises(OperationalError):
+            broken()
+        sleep.assert_not_called()
+
+    def test_gives_up(self, sleep):
+        user = models.User.objects.create(username='vend.user', email='vend@email.com')
+        models.Member.objects.create(user=user, first_name='Vend', last_name='User', preferred_name='Vend')
+        models.Card.objects.create(user=user, card_number='0000CAFE', active_status='card_active')
+
+        with patch('apiserver.api.utils.get_protocoin_balance', side_effect=OperationalError('database is locked')):
+            response = APIClient().post('/protocoin/0000CAFE/card_vend_request/', {'number': 1, 'balance': 0, 'amount': 1}, format='json')
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(sleep.call_count, utils_db.RETRY_ATTEMPTS - 1)
+        self.assertEqual(utils_db.retry_metrics['card_vend_request_failed'], 1)
+        self.assertFalse(models.Transaction.objects.exists())
+
+
+class TestImmediateAtomic(TransactionTestCase):
+    def test_begin_immediate(self):
+        with CaptureQueriesContext(connection) as queries:
+            with utils_db.immediate_atomic():
+                models.MetaInfo.objects.count()
+
+        self.assertEqual(queries[0]['sql'], 'BEGIN IMMEDIATE')
+        self.assertFalse(connection.in_atomic_block)
+        self.assertFalse(connection.begin_immediate)
+
+        # plain atomic() is unchanged
+        with CaptureQueriesContext(connection) as queries:
+            with transaction.atomic():
+                models.MetaInfo.objects.count()
+        self.assertEqual(queries[0]['sql'], 'BEGIN')
+
+    def test_rollback(self):
+        with self.assertRaises(ValueError):
+            with utils_db.immediate_atomic():
+                models.MetaInfo.objects.create(backup_id='1')
+                raise ValueError()
+
+        self.assertFalse(models.MetaInfo.objects.exists())
+
+    @patch('time.sleep')
+    def test_side_effects_after_commit(self, sleep):
+        errors = [OperationalError('database is locked')]
+
+        @utils_db.atomic_retry
+        def report():
+            response = APIClient().post('/protocoin/printer_report/', {'uuid': '', 'user_name': 'nobody'}, format='json')
+            if errors:
+                raise errors.pop()  # locked after the view queued its alert
+            return response
+
+        with patch('apiserver.api.utils.alert_tanner') as alert:
+            self.assertEqual(report().status_code, 200)
+
+        self.assertEqual(alert.call_count, 1)
+
+    def test_busy_timeout(self):
+        def get_timeout():
+            with connection.cursor() as cursor:
+                cursor.execute('PRAGMA busy_timeout')
+                return cursor.fetchone()[0]
+
+        before = get_timeout()
+
+        @utils_db.atomic_retry
+        def inside():
+            return get_timeout()
+
+        self.assertEqual(inside(), utils_db.RETRY_BUSY_TIMEOUT)
+        self.assertEqual(get_timeout(), before)
+
+
+class TestSqlitePragmas(TestCase):
+    def test_connection(self):
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA synchronous')
+            self.assertEqual(cursor.fetchone()[0], 1)  # NORMAL
+            cursor.execute('PRAGMA cache_size')
+            self.assertEqual(cursor.fetchone()[0], -32000)
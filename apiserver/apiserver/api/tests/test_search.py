@@ -0,0 +1,250 @@
+from django.test import TestCase, override_settings
+import random
+from collections import OrderedDict
+from unittest.mock import patch
+from django.core.cache import cache
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from fuzzywuzzy import fuzz, process
+from rest_framework.test import APIClient
+
+from apiserver.api import utils, utils_search, models
+
+
+def linear_search(search_strings, search):
+    # reference implementation, the old SearchViewSet scan
+    choices = search_strings.keys()
+
+    results = [x for x in choices if x.startswith(search)]
+    results += [x for x in choices if search in x]
+
+    if len(results) == 0 and len(search) >= 3 and '@' not in search:
+        fuzzy_results = process.extract(search, choices, limit=20, scorer=fuzz.token_set_ratio)
+        results += [x[0] for x in fuzzy_results]
+
+    return list(OrderedDict.fromkeys(results))[:20]
+
+
+FIRST_NAMES = ['john', 'jon', 'joan', 'jane', 'janet', 'alex', 'alexander', 'sam', 'samantha', 'tanner', 'pat', 'kent', 'murray', 'emrah']
+LAST_NAMES = ['doe', 'dough', 'smith', 'smithers', 'collin', 'collins', 'nguyen', 'o\'brien', 'van der berg', 'lee']
+
+def gen_search_strings(num):
+    rng = random.Random(1234)
+    search_strings = {}
+
+    for member_id in range(1, num + 1):
+        first = rng.choice(FIRST_NAMES)
+        last = rng.choice(LAST_NAMES)
+        string = '{} {} | {} {} | {}.{}@email.com | {}'.format(
+            first, last, first, last, first, last, member_id,
+        )
+        if rng.random() < 0.3:
+            string += ' | ' + rng.choice('ABCDE') + str(rng.randint(1, 40))
+
+        search_strings[string.lower()] = member_id
+
+    return search_strings
+
+
+class TestSearchIndex(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.search_strings = gen_search_strings(500)
+        cls.index = utils_search.SearchIndex(cls.search_strings)
+
+    def assertSameAsLinear(self, search):
+        expected = linear_search(self.search_strings, search)
+        self.assertEqual(self.index.search(search), expected, search)
+
+    def test_prefix(self):
+        for search in ['j', 'jo', 'john', 'john d', 'samantha smithers | samantha']:
+            self.assertSameAsLinear(search)
+
+    def test_substring(self):
+        for search in ['e', 'mi', 'ith', 'collin', '@email', 'o\'b', ' | 4', 'berg |']:
+            self.assertSameAsLinear(search)
+
+    def test_shelf_and_id(self):
+        for search in ['a1', 'c33', '| 123', '499']:
+            self.assertSameAsLinear(search)
+
+    def test_no_match(self):
+        for search in ['q', 'zz', 'xyz@', 'qq']:
+            self.assertSameAsLinear(search)
+
+    def test_fuzzy_small(self):
+        index = utils_search.SearchIndex(gen_search_strings(15))
+        expected = linear_search(index.search_strings, 'jhon doe')
+        self.assertEqual(index.search('jhon doe'), expected)
+
+    def test_fuzzy_same_as_linear(self):
+        for search in ['jhon doe', 'jhon', 'tanenr colin', 'samanta', 'murry', 'alxe', 'ngyuen']:
+            self.assertSameAsLinear(search)
+
+    def test_fuzzy_misspelled_large(self):
+        search_strings = gen_search_strings(3000)
+        index = utils_search.SearchIndex(search_strings)
+        rng = random.Random(4321)
+
+        for _ in range(40):
+            name = '{} {}'.format(rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES))
+            chars = list(name)
+            i = rng.randrange(len(chars) - 1)
+            edit = rng.choice(['swap', 'drop', 'double', 'replace'])
+            if edit == 'swap':
+                chars[i], chars[i + 1] = chars[i + 1], chars[i]
+            elif edit == 'drop':
+                del chars[i]
+            elif edit == 'double':
+                chars.insert(i, chars[i])
+            else:
+                chars[i] = rng.choice('aeiouxyz')
+            search = ''.join(chars)
+
+            expected = linear_search(search_strings, search)
+            self.assertEqual(index.search(search), expected, search)
+
+    def test_fuzzy_pruned(self):
+        scored = []
+        token_set_ratio = fuzz.token_set_ratio
+
+        def counting_ratio(*args, **kwargs):
+            scored.append(args[1])
+            return token_set_ratio(*args, **kwargs)
+
+        for search in ['jhon', 'smtih', 'tanenr colin', 'jnae smtih', 'xqzv']:
+            scored.clear()
+            with patch.object(utils_search.fuzz, 'token_set_ratio', counting_ratio):
+                results = self.index.search(search)
+
+            self.assertEqual(results, linear_search(self.search_strings, search))
+            self.assertLess(len(scored), len(self.index) / 2, search)
+
+    def test_fuzzy(self):
+        results = self.index.search('tanenr colin')
+        self.assertEqual(len(results), 20)
+        self.assertTrue(all('tanner' in x or 'colli' in x for x in results))
+
+    def test_search_ids(self):
+        ids = self.index.search_ids('john')
+        self.assertEqual(ids, [self.search_strings[x] for x in linear_search(self.search_strings, 'john')])
+
+    def test_empty(self):
+        index = utils_search.SearchIndex({})
+        self.assertEqual(index.search('john'), [])
+        self.assertEqual(index.search(''), [])
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class TestSearchQueries(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        helper = models.User.objects.create(username='helper.user', email='helper@email.com')
+        models.Member.objects.create(user=helper, first_name='Helper', last_name='User', preferred_name='Helper')
+
+        for i in range(25):
+            user = models.User.objects.create(username='search.user{}'.format(i), email='search{}@email.com'.format(i))
+            models.Member.objects.create(
+                user=user,
+                first_name='Search',
+                last_name='User{}'.format(i),
+                preferred_name='Search',
+                vetted_date=utils.today_local_tz(),
+                signup_helper=helper,
+            )
+            models.StorageSpace.objects.create(user=user, shelf_id='A{}'.format(i), classification='SHELF')
+
+        cls.user = models.User.objects.get(username='search.user0')
+
+    def setUp(self):
+        cache.clear()
+        utils.gen_search_strings()
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+        self.client.post('/search/', {'q': 'search'}, format='json')  # warm up
+
+    def search(self, q):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post('/search/', {'q': q}, format='json')
+        self.assertEqual(response.status_code, 200)
+        return response, len(queries)
+
+    def test_results_ranked(self):
+        response, _ = self.search('search user1')
+        names = [r['member']['last_name'] for r in response.data['results']]
+        self.assertEqual(names[0], 'User1')
+        self.assertEqual(set(names), {'User1'} | {'User1{}'.format(i) for i in range(10)})
+
+        storage = response.data['results'][0]['member']['storage']
+        self.assertEqual(storage[0]['shelf_id'], 'A1')
+        self.assertEqual(storage[0]['member_name'], 'Search User1')
+
+    def test_constant_queries(self):
+        _, one_hit = self.search('user24')
+        _, many_hits = self.search('search')
+
+        self.assertEqual(one_hit, many_hits)
+        self.assertEqual(many_hits, 2)  # members, storage
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class TestSearchStringUpdates(TestCase):
+    def setUp(self):
+        cache.clear()
+        utils.search_index = None
+
+        for name in ['alice', 'bob']:
+            user = models.User.objects.create(username=name, email=name + '@email.com')
+            models.Member.objects.create(user=user, first_name=name.title(), last_name='Smith', preferred_name=name.title())
+
+        self.alice = models.Member.objects.get(user__username='alice')
+        self.bob = models.Member.objects.get(user__username='bob')
+        utils.gen_search_strings()
+
+    def search_ids(self, q):
+        return utils.get_search_index().search_ids(q)
+
+    def test_rename(self):
+        self.alice.preferred_name = 'Alicia'
+        self.alice.save()
+        utils.update_search_strings([self.alice.id])
+
+        self.assertEqual(self.search_ids('alicia'), [self.alice.id])
+        self.assertEqual(len(utils.get_cached_search_strings()[1]), 2)
+
+    def test_unchanged_keeps_version(self):
+        version, _ = utils.get_cached_search_strings()
+        utils.update_search_strings([self.alice.id, self.bob.id])
+        self.assertEqual(utils.get_cached_search_strings()[0], version)
+
+    def test_new_and_deleted(self):
+        user = models.User.objects.create(username='carol', email='carol@email.com')
+        carol = models.Member.objects.create(user=user, first_name='Carol', last_name='Jones', preferred_name='Carol')
+        utils.update_search_strings([carol.id])
+        self.assertEqual(self.search_ids('carol'), [carol.id])
+
+        bob_id = self.bob.id
+        self.bob.delete()
+        utils.update_search_strings([bob_id])
+        self.assertEqual(self.search_ids('bob@'), [])
+        self.assertEqual(sorted(utils.get_cached_search_strings()[1].values()), sorted([self.alice.id, carol.id]))
+
+    def test_storage_moved(self):
+        shelf = models.StorageSpace.objects.create(user=self.alice.user, shelf_id='Z9')
+        utils.update_search_strings([self.alice.id])
+        self.assertEqual(self.search_ids('z9'), [self.alice.id])
+
+        shelf.user = self.bob.user
+        shelf.save()
+        utils.update_search_strings([self.alice.id, self.bob.id])
+        self.assertEqual(self.search_ids('z9'), [self.bob.id])
+
+    def test_rebuild_reports_drift(self):
+        self.alice.preferred_name = 'Alicia'
+        self.alice.save()
+
+        with self.assertLogs('apiserver.api.utils', level='WARNING') as logs:
+            utils.gen_search_strings()
+        self.assertIn('drifted by 2 entries', logs.output[0])
+        self.assertEqual(self.search_ids('alicia'), [self.alice.id])
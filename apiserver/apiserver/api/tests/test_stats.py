@@ -0,0 +1,516 @@
+from django.test import TestCase, override_settings
+import datetime
+import time
+import threading
+import json
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+from django.core.cache import cache
+from django.core.handlers.asgi import ASGIRequest
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from apiserver.api import utils, utils_stats, utils_stream, models
+
+
+class TestMemberCounts(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        today = utils.today_local_tz()
+        statuses = ['Current', 'Prepaid', 'Due', 'Overdue', 'Expired Member']
+
+        for i in range(20):
+            user = models.User.objects.create(username='count.user{}'.format(i), email='count{}@email.com'.format(i))
+            models.Member.objects.create(
+                user=user,
+                first_name='Count',
+                last_name='User',
+                preferred_name='Count',
+                status=statuses[i % 5],
+                paused_date=today if i % 7 == 0 else None,
+                vetted_date=today if i % 2 else None,
+                application_date=today - datetime.timedelta(days=30 * i),
+            )
+
+            # subscribers paid last through PayPal subscription
+            models.Transaction.objects.create(
+                user=user,
+                amount=55,
+                number_of_membership_months=1,
+                date=today - datetime.timedelta(days=60),
+                paypal_txn_type='subscr_payment',
+            )
+            if i % 3 == 0:
+                models.Transaction.objects.create(
+                    user=user,
+                    amount=55,
+                    number_of_membership_months=1,
+                    date=today - datetime.timedelta(days=30),
+                    paypal_txn_type='web_accept',
+                )
+            # not a membership payment, ignored
+            models.Transaction.objects.create(
+                user=user,
+                amount=10,
+                number_of_membership_months=0,
+                date=today,
+                paypal_txn_type='web_accept',
+            )
+
+    def test_counts(self):
+        with CaptureQueriesContext(connection) as queries:
+            counts = utils_stats.calc_member_counts()
+        self.assertEqual(len(queries), 1)
+
+        # not paused: i not in (0, 7, 14)
+        active = [i for i in range(20) if i % 7]
+        self.assertEqual(counts['member_count'], len([i for i in active if i % 5 != 4]))
+        self.assertEqual(counts['green_count'], len([i for i in active if i % 5 in (0, 1)]))
+        self.assertEqual(counts['vetted_count'], len([i for i in active if i % 2]))
+        self.assertEqual(counts['six_month_plus_count'], len([i for i in active if 30 * i >= 183]))
+        self.assertEqual(counts['subscriber_count'], len([i for i in active if i % 3]))
+
+
+class TestRetainCounts(TestCase):
+    def setUp(self):
+        for i in range(12):
+            user = models.User.objects.create(username='retain.user{}'.format(i), email='retain{}@email.com'.format(i))
+            models.Member.objects.create(
+                user=user,
+                first_name='Retain',
+                last_name='User',
+                preferred_name='Retain',
+                application_date=datetime.date(2023, 1 + i % 3, 10 + i),
+                paused_date=datetime.date(2023, 6, 1) if i % 4 == 0 else None,
+                vetted_date=datetime.date(2023, 6, 1) if i % 2 else None,
+            )
+
+        for month in [1, 2, 3, 4]:
+            models.StatsSignupCount.objects.create(month=datetime.date(2023, month, 1), signup_count=4)
+
+    def test_counts(self):
+        with CaptureQueriesContext(connection) as queries:
+            active_count = utils_stats.calc_retain_counts()
+        self.assertEqual(len(queries), 3)  # aggregate, months, bulk update
+        self.assertEqual(active_count, 9)
+
+        counts = {e.month.month: (e.retain_count, e.vetted_count) for e in models.StatsSignupCount.objects.all()}
+        self.assertEqual(counts, {
+            1: (3, 2),  # 0 3 6 9
+            2: (3, 2),  # 1 4 7 10
+            3: (3, 2),  # 2 5 8 11
+            4: (0, 0),
+        })
+
+    def test_unchanged(self):
+        utils_stats.calc_retain_counts()
+
+        with CaptureQueriesContext(connection) as queries:
+            utils_stats.calc_retain_counts()
+        self.assertEqual(len(queries), 2)  # nothing to write
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class TestDrinkSales(TestCase):
+    def setUp(self):
+        cache.clear()
+        today = utils.today_local_tz()
+        self.today = today
+
+        for number, name in [('1', 'Coke'), ('2', 'Root Beer')]:
+            models.VendingSlot.objects.create(number=number, name=name, color='red', since=datetime.date(1970, 1, 1))
+        models.VendingSlot.objects.create(number='2', name='Fanta', color='orange', since=today - datetime.timedelta(days=10))
+        models.VendingSlot.objects.create(number='3', name='Crush Pop', color='orange', since=datetime.date(1970, 1, 1))
+        models.VendingSlot.objects.create(number='3', name='Dr Pepper', short_name='Dr. Pepper', since=datetime.date(2000, 1, 1))
+
+        self.user = models.User.objects.create(username='drink.user', email='drink@email.com')
+        self.member = models.Member.objects.create(user=self.user, first_name='Drink', last_name='User', preferred_name='Drink')
+        models.Card.objects.create(user=self.user, card_number='22220000', active_status='card_active')
+
+        def vend(number, days_ago, machine='pop'):
+            models.Transaction.objects.create(
+                user=self.user,
+                amount=0,
+                protocoin=-1,
+                category='Snacks',
+                memo='Protocoin - Purchase spent ₱ 1.0 on {} vending machine item #{}'.format(machine, number),
+                date=today - datetime.timedelta(days=days_ago),
+                vending_machine=machine,
+                vending_item=number,
+            )
+
+        for days_ago in [1, 20, 30, 400]:
+            vend('1', days_ago)
+        for days_ago in [5, 6, 15]:
+            vend('2', days_ago)
+        for days_ago in range(8):
+            vend('3', days_ago)
+        vend('1', 2, machine='snack')
+
+    def test_drink_sales(self):
+        with CaptureQueriesContext(connection) as queries:
+            utils_stats.calc_drink_sales()
+        self.assertEqual(len(queries), 2)  # slots, sales
+
+        sales = {x['name']: x['count'] for x in cache.get('drinks_6mo')}
+        self.assertEqual(sales, {'Coke': 3, 'Root Beer': 1, 'Fanta': 2, 'Dr Pepper': 8})
+
+    def test_favourite_drink(self):
+        response = APIClient().get('/pinball/22220000/get_name/')
+        self.assertEqual(response.data['drink'], 'Dr. Pepper')
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class TestStatsRegistry(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.calls = []
+
+        def fake_stat(name):
+            return lambda: self.calls.append(name)
+
+        def broken_stat():
+            raise ValueError('broken')
+
+        registry = [
+            dict(name='always', func=fake_stat('always'), models=[], max_age=0),
+            dict(name='members', func=fake_stat('members'), models=['Member'], max_age=utils_stats.DAY),
+            dict(name='sessions', func=fake_stat('sessions'), models=['Session', 'Course'], max_age=utils_stats.DAY),
+            dict(name='broken', func=broken_stat, models=['Member'], max_age=utils_stats.DAY),
+        ]
+
+        patcher = patch.multiple(utils_stats, STATS_REGISTRY=registry, STATS_MODELS={'Member', 'Session', 'Course'})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def run_stats(self):
+        self.calls = []
+        with self.assertLogs('apiserver.api.utils_stats', level='ERROR'):
+            timings = utils_stats.run_stats()
+        return sorted(self.calls), timings
+
+    def test_first_run(self):
+        calls, timings = self.run_stats()
+        self.assertEqual(calls, ['always', 'members', 'sessions'])
+        self.assertEqual(len(timings), 4)
+        self.assertEqual([t['name'] for t in timings if not t['ok']], ['broken'])
+
+    def test_skips_fresh(self):
+        self.run_stats()
+        calls, timings = self.run_stats()
+        self.assertEqual(calls, ['always'])
+        self.assertEqual(sorted(t['name'] for t in timings), ['always', 'broken'])  # failed stats retry
+
+        utils_stats.mark_model_changed('Course')
+        calls, _ = self.run_stats()
+        self.assertEqual(calls, ['always', 'sessions'])
+
+    def test_max_age(self):
+        self.run_stats()
+        cache.set('stats_ran_sessions', time.time() - utils_stats.DAY)
+        calls, _ = self.run_stats()
+        self.assertIn('sessions', calls)
+
+    def test_ignored_model(self):
+        utils_stats.mark_model_changed('PinballScore')
+        self.assertIsNone(cache.get('stats_model_changed_PinballScore'))
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class TestCollectors(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_run_collectors(self):
+        def slow():
+            time.sleep(1)
+            return 'slow'
+
+        def broken():
+            raise ValueError('broken')
+
+        collectors = [('fast', lambda: 'fast'), ('slow', slow), ('broken', broken)]
+
+        start = time.time()
+        with self.assertLogs('apiserver.api.utils_stats', level='ERROR') as logs:
+            results = utils_stats.run_collectors(collectors, deadline=0.2)
+
+        self.assertLess(time.time() - start, 1)
+        self.assertEqual(results, dict(fast='fast', slow=None, broken=None))
+        self.assertEqual(len(logs.output), 2)
+
+    def test_abandoned_collector(self):
+        stop = threading.Event()
+        self.addCleanup(stop.set)
+        utils_stats.run_collectors([('hung', stop.wait)], deadline=0.1)
+
+        hung = [t for t in threading.enumerate() if t.name == 'collector_hung']
+        self.assertEqual(len(hung), 1)
+        self.assertTrue(hung[0].daemon)
+
+    def test_session_per_thread(self):
+        sessions = utils_stats.run_collectors([(str(i), utils_stats.get_http) for i in range(2)])
+        self.assertIsNot(sessions['0'], sessions['1'])
+        self.assertIn('http://', sessions['0'].adapters)
+
+    def test_last_good_value(self):
+        utils_stats.set_collected('minecraft_players', ['alice'])
+        collected_at = utils_stats.get_collected_at(['minecraft_players'])
+
+        with patch('apiserver.secrets.MINECRAFT', 'mc.example.com'), \
+                patch.object(utils_stats.get_http(), 'get', side_effect=ConnectionError('down')), \
+                self.assertLogs('apiserver.api.utils_stats', level='ERROR'):
+            self.assertEqual(utils_stats.check_minecraft_server(), [])
+
+        response = APIClient().get('/stats/')
+        self.assertEqual(response.json()['minecraft_players'], ['alice'])
+        self.assertEqual(response.json()['collected_at']['minecraft_players'], collected_at['minecraft_players'])
+        self.assertIsNone(response.json()['collected_at']['shopping_list'])
+
+    def test_unchanged_keeps_version(self):
+        self.assertTrue(utils_stats.set_collected('minecraft_players', ['alice']))
+        version = utils_stats.get_stats_version()
+
+        self.assertFalse(utils_stats.set_collected('minecraft_players', ['alice']))
+        self.assertEqual(utils_stats.get_stats_version(), version)
+
+        self.assertTrue(utils_stats.set_collected('minecraft_players', ['bob']))
+        self.assertNotEqual(utils_stats.get_stats_version(), version)
+
+    def test_forum_pages(self):
+        def get_page(page):
+            items = [{'days_visited': page * 10 + i} for i in range(10)] if page < 3 else []
+            return {'directory_items': items, 'meta': {'total_rows_directory_items': 25}}
+
+        with patch('apiserver.secrets.FORUM_READ_API_KEY', 'key'), \
+                patch.object(utils_stats, 'get_forum_directory_page', side_effect=get_page) as mock_get:
+            utils_stats.calc_forum_activity()
+
+        self.assertEqual(sorted(x.args[0] for x in mock_get.call_args_list), [0, 1, 2])
+        results = cache.get('forums_visit_1mo')
+        self.assertEqual(len(results), 30)
+        self.assertEqual(results[0], {'member': 1, 'days_visited': 29})
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class TestStatsResponse(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        utils_stats.set_stats({'alarm': {'armed': True}, 'autoscan': '1234'})
+
+    def get(self, etag=None, user=None):
+        self.client.force_authenticate(user=user)
+        headers = {'HTTP_IF_NONE_MATCH': etag} if etag else {}
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/stats/', **headers)
+        return response, len(queries)
+
+    def test_not_modified(self):
+        response, _ = self.get()
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+
+        response, num_queries = self.get(etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        self.assertEqual(num_queries, 0)
+
+    def test_changed_stat(self):
+        response, _ = self.get()
+        etag = response['ETag']
+
+        utils_stats.set_stat('sign', 'hello')
+        response, _ = self.get(etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(response.json()['sign'], 'hello')
+
+    def test_unrelated_writes(self):
+        response, _ = self.get()
+        etag = response['ETag']
+
+        # not in the blob, or hidden from anonymous viewers
+        utils_stats.set_stat('alarm', {'armed': False})
+        utils_stats.set_stats({'card_scans_2020-01-01': 5})
+
+        response, _ = self.get(etag)
+        self.assertEqual(response.status_code, 304)
+
+        utils_stats.set_device_stat('track', 'LASER', {'username': 'alice'})
+        response, _ = self.get(etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['track'], {'LASER': {'username': 'alice'}})
+
+    def test_tiers(self):
+        member = models.User.objects.create(username='stats.member', email='member@email.com')
+        admin = models.User.objects.create(username='stats.admin', email='admin@email.com', is_staff=True)
+        for user in [member, admin]:
+            models.Member.objects.create(user=user, first_name='Stats', last_name='User', preferred_name='Stats')
+
+        anonymous, _ = self.get()
+        self.assertNotIn('alarm', anonymous.json())
+
+        response, _ = self.get(user=member)
+        self.assertEqual(response.json()['alarm'], {'armed': True})
+        self.assertNotIn('autoscan', response.json())
+        self.assertNotEqual(response['ETag'], anonymous['ETag'])
+
+        response, _ = self.get(user=admin)
+        self.assertEqual(response.json()['autoscan'], '1234')
+
+
+def parse_events(sent):
+    events = []
+    for message in sent:
+        body = message.get('body', b'').decode()
+        if not body.startswith('event: '):
+            continue
+        lines = body.strip().split('\n')
+        events.append((lines[0][len('event: '):], json.loads(lines[-1][len('data: '):])))
+    return events
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class TestStatsStream(TestCase):
+    def setUp(self):
+        cache.clear()
+        utils_stats.set_stats({'alarm': {'armed': True}, 'sign': 'before'})
+
+    def stream(self, steps):
+        scope = {
+            'type': 'http',
+            'method': 'GET',
+            'path': '/stats/stream/',
+            'root_path': '',
+            'query_string': b'',
+            'headers': [],
+            'client': ('127.0.0.1', 12345),
+            'server': ('testserver', 80),
+        }
+        sent = []
+
+        async def run():
+            disconnected = asyncio.Event()
+
+            async def receive():
+                await disconnected.wait()
+                return {'type': 'http.disconnect'}
+
+            async def send(message):
+                sent.append(message)
+
+            async def wait_for_events(num):
+                for _ in range(200):
+                    if len(parse_events(sent)) >= num:
+                        return
+                    await asyncio.sleep(0.01)
+
+            task = asyncio.ensure_future(utils_stream.stats_stream(scope, receive, send))
+            for step, num in steps:
+                step()
+                await wait_for_events(num)
+            disconnected.set()
+            await task
+
+        with patch.object(utils_stream, 'broadcaster', utils_stream.Broadcaster(poll_interval=0.01)):
+            asyncio.run(run())
+
+        return sent
+
+    def test_snapshot_then_changes(self):
+        sent = self.stream([
+            (lambda: None, 1),
+            (lambda: utils_stats.set_stat('alarm', {'armed': False}), 1),
+            (lambda: utils_stats.set_stat('sign', 'after'), 2),
+        ])
+
+        self.assertEqual(sent[0]['status'], 200)
+        self.assertIn((b'content-type', b'text/event-stream'), sent[0]['headers'])
+
+        events = parse_events(sent)
+        self.assertEqual(events[0][0], 'stats')
+        self.assertEqual(events[0][1]['sign'], 'before')
+        self.assertTrue(events[0][1]['at_protospace'])
+        self.assertNotIn('alarm', events[0][1])
+
+        # the alarm change is hidden from anonymous subscribers
+        self.assertEqual(events[1:], [('changed', {'sign': 'after'})])
+
+    def test_slow_subscriber_dropped(self):
+        subscriber = utils_stream.Subscriber('anonymous')
+        for i in range(utils_stream.SUBSCRIBER_QUEUE_SIZE):
+            self.assertTrue(subscriber.push('changed', i, {'sign': i}))
+
+        self.assertFalse(subscriber.push('changed', 'full', {'sign': 'full'}))
+        self.assertEqual(subscriber.queue.qsize(), 1)
+        self.assertIsNone(subscriber.queue.get_nowait())
+
+    def test_query_string_token(self):
+        user = models.User.objects.create(username='stream.member', email='stream@email.com')
+        models.Member.objects.create(user=user, first_name='Stream', last_name='Member', preferred_name='Stream')
+        token = Token.objects.create(user=user)
+
+        def tier(query_string):
+            scope = {'type': 'http', 'method': 'GET', 'path': '/stats/stream/', 'query_string': query_string, 'headers': []}
+            return utils_stream.get_request_tier(ASGIRequest(scope, None))
+
+        self.assertEqual(tier(b''), 'anonymous')
+        self.assertEqual(tier(b'token=nope'), 'anonymous')
+        self.assertEqual(tier('token={}'.format(token.key).encode()), 'member')
+
+    def test_connections_closed(self):
+        with patch.object(utils_stream, 'close_old_connections') as mock_close:
+            self.stream([(lambda: None, 1)])
+
+        # before and after the tier lookup at least
+        self.assertGreaterEqual(mock_close.call_count, 2)
+
+    def test_extra_not_shared(self):
+        first = utils_stream.Subscriber('anonymous')
+        first.extra['at_protospace'] = True
+        second = utils_stream.Subscriber('anonymous')
+
+        second.push('stats', 1, {'sign': 'hi'})
+        self.assertEqual(second.queue.get_nowait(), ('stats', 1, {'sign': 'hi'}))
+
+
+# telemetry points buffer in the cache too, keep locmem from culling
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'OPTIONS': {'MAX_ENTRIES': 10000}}})
+class TestDeviceStats(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_concurrent_posts(self):
+        def post(thread):
+            client = APIClient()
+            for i in range(10):
+                client.post('/stats/track/', {'name': 'DEVICE{}'.format(thread), 'username': 'user.{}'.format(i)}, format='json')
+                client.post('/stats/solar_data/', {'user': 'solar {}'.format(thread), 'power': i}, format='json')
+
+        with ThreadPoolExecutor(20) as executor:
+            list(executor.map(post, range(20)))
+
+        stats = utils_stats.get_stats()
+        self.assertEqual(len(stats['track']), 20)
+        self.assertTrue(all(device['username'] == 'user.9' for device in stats['track'].values()))
+        self.assertEqual(len(stats['solar']['users']), 20)
+        self.assertEqual(stats['solar']['total'], 20 * 9)
+
+    def test_device_order_and_lookup(self):
+        utils_stats.set_device_stat('printer3d', 'ord2', {'state': 'Idle'})
+        utils_stats.set_device_stat('printer3d', 'p1s1', {'state': 'Printing'})
+        utils_stats.set_device_stat('printer3d', 'ord2', {'state': 'Printing'})
+
+        stats = utils_stats.get_device_stats(['printer3d', 'scanner3d'])
+        self.assertEqual(list(stats['printer3d']), ['ord2', 'p1s1'])
+        self.assertEqual(stats['printer3d']['ord2'], {'state': 'Printing'})
+        self.assertEqual(stats['scanner3d'], {})
+        self.assertEqual(utils_stats.get_device_stat('printer3d', 'p1s1'), {'state': 'Printing'})
+
+    def test_stale_solar_excluded(self):
+        utils_stats.set_device_stat('solar', 'old', dict(power=100, time=time.time() - 3600))
+        utils_stats.set_device_stat('solar', 'new', dict(power=5, time=time.time()))
+        self.assertEqual(utils_stats.get_stats()['solar']['total'], 5)
@@ -0,0 +1,99 @@
+from django.test import TestCase, override_settings
+import time
+from datetime import timedelta
+from unittest.mock import patch
+from django.core.cache import cache
+from django.utils.timezone import now
+from rest_framework.test import APIClient
+
+from apiserver.api import utils_stats, utils_telemetry, models
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class TestTelemetryBuffer(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_flush_lags_one_run(self):
+        for power in [1, 2, 3]:
+            utils_stats.set_device_stat('solar', 'roof', dict(power=power, time=time.time()))
+        self.assertEqual(models.TelemetryPoint.objects.count(), 0)
+
+        self.assertEqual(utils_telemetry.flush_telemetry(), 0)
+        utils_telemetry.record('balloon', 'protoballoon', dict(altitude=100))
+
+        self.assertEqual(utils_telemetry.flush_telemetry(), 3)
+        powers = [p.data['power'] for p in models.TelemetryPoint.objects.order_by('id')]
+        self.assertEqual(powers, [1, 2, 3])
+
+        self.assertEqual(utils_telemetry.flush_telemetry(), 1)
+        self.assertEqual(utils_telemetry.flush_telemetry(), 0)
+        self.assertEqual(models.TelemetryPoint.objects.count(), 4)
+
+    def test_cache_down(self):
+        with patch.object(cache, 'incr', side_effect=ValueError):
+            utils_telemetry.record('printer3d', 'ord2', dict(progress=50))
+
+        point = models.TelemetryPoint.objects.get()
+        self.assertEqual((point.source, point.device, point.data), ('printer3d', 'ord2', dict(progress=50)))
+
+
+class TestTelemetryRollup(TestCase):
+    def add_point(self, at, power, state='On'):
+        models.TelemetryPoint.objects.create(source='solar', device='roof', time=at, data=dict(power=power, state=state))
+
+    def test_rollup(self):
+        hour = (now() - timedelta(days=8)).replace(minute=0, second=0, microsecond=0)
+        self.add_point(hour + timedelta(minutes=5), 10, 'On')
+        self.add_point(hour + timedelta(minutes=35), 20, 'Off')
+        self.add_point(hour + timedelta(minutes=65), 30)
+        self.add_point(now(), 40)
+
+        self.assertEqual(utils_telemetry.rollup_telemetry(), 2)
+
+        rollups = models.TelemetryPoint.objects.filter(resolution='hour').order_by('time')
+        self.assertEqual([r.data for r in rollups], [dict(power=15, state='Off'), dict(power=30, state='On')])
+        self.assertEqual([r.count for r in rollups], [2, 1])
+        self.assertEqual(rollups[0].time, hour)
+
+        self.assertEqual(models.TelemetryPoint.objects.filter(resolution='raw').count(), 1)
+        self.assertEqual(utils_telemetry.rollup_telemetry(), 0)
+
+
+class TestTelemetryQuery(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        for minutes, device in [(90, 'roof'), (30, 'roof'), (20, 'shed'), (10, 'roof')]:
+            models.TelemetryPoint.objects.create(
+                source='solar',
+                device=device,
+                time=now() - timedelta(minutes=minutes),
+                data=dict(power=minutes),
+            )
+
+    def test_range(self):
+        start = time.time() - 3600
+        response = self.client.get('/stats/telemetry/', {'source': 'solar', 'start': start})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([p['data']['power'] for p in response.data], [30, 20, 10])
+
+        response = self.client.get('/stats/telemetry/', {'source': 'solar', 'start': start, 'device': 'roof'})
+        self.assertEqual([p['data']['power'] for p in response.data], [30, 10])
+
+    def test_invalid(self):
+        response = self.client.get('/stats/telemetry/', {'source': 'nope'})
+        self.assertEqual(response.status_code, 400)
+
+        response = self.client.get('/stats/telemetry/', {'source': 'solar', 'start': 'yesterday'})
+        self.assertEqual(response.status_code, 400)
+
+        response = self.client.get('/stats/telemetry/', {'source': 'track'})
+        self.assertEqual(response.status_code, 403)
+
+    def test_out_of_range(self):
+        for start in ['1e300', '-1e300', 'nan', 'inf', '-1']:
+            response = self.client.get('/stats/telemetry/', {'source': 'solar', 'start': start})
+            self.assertEqual(response.status_code, 400, start)
+
+        response = self.client.get('/stats/telemetry/', {'source': 'solar', 'start': 0, 'end': 'nan'})
+        self.assertEqual(response.status_code, 400)
@@ -0,0 +1,215 @@
+from django.test import TestCase, override_settings
+import json
+import re
+import hashlib
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from unittest.mock import patch
+from django.core.cache import cache
+
+from rest_framework.test import APIClient
+
+from apiserver.api import utils_todo, utils_stats
+
+
+class FakeVikunja:
+    '''
+    Just enough of the Vikunja API for utils_todo, records every request
+    '''
+    def __init__(self):
+        self.requests = []
+        self.statuses = []
+        self.etags = True
+        self.projects = {
+            'Consumables': dict(id=1, view_id=11, tasks=[]),
+            'Maintenance': dict(id=2, view_id=21, tasks=[]),
+        }
+        self.next_task_id = 100
+
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                fake.handle(self, 'GET')
+
+            def do_PUT(self):
+                fake.handle(self, 'PUT')
+
+            def do_POST(self):
+                fake.handle(self, 'POST')
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{}/api/v1/'.format(self.server.server_port)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def get_project(self, project_id):
+        for title, project in self.projects.items():
+            if project['id'] == project_id:
+                return project
+        return None
+
+    def respond(self, handler, status, data=None, headers={}):
+        body = json.dumps(data).encode() if data is not None else b''
+        self.statuses.append(status)
+        handler.send_response(status)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Content-Length', str(len(body)))
+        for name, value in headers.items():
+            handler.send_header(name, value)
+        handler.end_headers()
+        handler.wfile.write(body)
+
+    def handle(self, handler, method):
+        url = urlparse(handler.path)
+        path = url.path.replace('/api/v1/', '', 1)
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+        length = int(handler.headers.get('Content-Length') or 0)
+        data = json.loads(handler.rfile.read(length)) if length else None
+
+        self.requests.append((method, path))
+
+        if method == 'GET' and path == 'projects':
+            search = params.get('s', '')
+            projects = [
+                dict(id=p['id'], title=title, views=[dict(id=p['view_id'])])
+                for title, p in self.projects.items() if search in title
+            ]
+            return self.respond(handler, 200, projects)
+
+        match = re.match(r'projects/(\d+)/views/(\d+)/tasks$', path)
+        if method == 'GET' and match:
+            project = self.get_project(int(match.group(1)))
+            if not project or project['view_id'] != int(match.group(2)):
+                return self.respond(handler, 404, dict(message='Not found'))
+            tasks = sorted(project['tasks'], key=lambda t: t['position'])
+            if params.get('s'):
+                tasks = [t for t in tasks if params['s'] in t['title']]
+            if not self.etags:
+                return self.respond(handler, 200, tasks)
+            etag = '"{}"'.format(hashlib.md5(json.dumps(tasks).encode()).hexdigest())
+            if handler.headers.get('If-None-Match') == etag:
+                return self.respond(handler, 304, headers={'ETag': etag})
+            return self.respond(handler, 200, tasks, headers={'ETag': etag})
+
+        match = re.match(r'projects/(\d+)/tasks$', path)
+        if method == 'PUT' and match:
+            project = self.get_project(int(match.group(1)))
+            if not project:
+                return self.respond(handler, 404, dict(message='Not found'))
+            self.next_task_id += 1
+            task = dict(
+                id=self.next_task_id,
+                title=data['title'],
+                position=data['position'],
+                done=False,
+                created='2026-01-01T00:00:00Z',
+                labels=None,
+            )
+            project['tasks'].append(task)
+            return self.respond(handler, 200, task)
+
+        match = re.match(r'tasks/(\d+)/position$', path)
+        if method == 'POST' and match:
+            for project in self.projects.values():
+                for task in project['tasks']:
+                    if task['id'] == int(match.group(1)):
+                        task['position'] = data['position']
+                        return self.respond(handler, 200, task)
+            return self.respond(handler, 404, dict(message='Not found'))
+
+        return self.respond(handler, 404, dict(message='Not found'))
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class TestTodo(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.vikunja = FakeVikunja()
+        self.vikunja.start()
+        self.addCleanup(self.vikunja.stop)
+
+        for name, value in [('TODO_API_URL', self.vikunja.url), ('TODO_API_KEY', 'key')]:
+            patcher = patch('apiserver.secrets.' + name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_project_ids_cached(self):
+        utils_todo.get_task_list('Consumables')
+        utils_todo.get_task_list('Consumables')
+
+        self.assertEqual(self.vikunja.requests, [
+            ('GET', 'projects'),
+            ('GET', 'projects/1/views/11/tasks'),
+            ('GET', 'projects/1/views/11/tasks'),
+        ])
+
+    def test_session_per_thread(self):
+        sessions = utils_stats.run_collectors([(str(i), utils_todo.get_session) for i in range(2)])
+        self.assertIsNot(sessions['0'], sessions['1'])
+        self.assertIs(utils_todo.get_session(), utils_todo.get_session())
+
+    def test_project_moved(self):
+        utils_todo.get_task_list('Consumables')
+        self.vikunja.projects['Consumables'].update(id=3, view_id=31)
+        self.vikunja.requests = []
+
+        with self.assertLogs('apiserver.api.utils_todo', level='INFO'):
+            self.assertEqual(utils_todo.get_task_list('Consumables'), [])
+
+        self.assertEqual(self.vikunja.requests, [
+            ('GET', 'projects/1/views/11/tasks'),
+            ('GET', 'projects'),
+            ('GET', 'projects/3/views/31/tasks'),
+        ])
+
+    def test_add_task_or_bump(self):
+        utils_todo.add_task_or_bump('Consumables', 'Paper towels')
+        utils_todo.add_task_or_bump('Consumables', 'Glue')
+        utils_todo.add_task_or_bump('Consumables', 'Paper towels')
+
+        tasks = utils_todo.get_task_list('Consumables')
+        self.assertEqual([t['title'] for t in tasks], ['Paper towels', 'Glue'])
+        self.assertEqual(self.vikunja.requests.count(('GET', 'projects')), 1)
+
+    def test_conditional_get(self):
+        utils_todo.add_task_or_bump('Maintenance', 'Fix door')
+        self.vikunja.statuses = []
+
+        first = utils_todo.get_task_list('Maintenance')
+        second = utils_todo.get_task_list('Maintenance')
+
+        self.assertEqual(first, second)
+        self.assertEqual(self.vikunja.statuses, [200, 304])
+
+    def test_unchanged_list_not_rewritten(self):
+        utils_todo.add_task_or_bump('Consumables', 'Paper towels')
+
+        for etags in [True, False]:
+            cache.clear()
+            self.vikunja.etags = etags
+
+            utils_stats.check_shopping_list()
+            version = utils_stats.get_versions(['shopping_list'])['shopping_list']
+
+            with patch.object(utils_stats.cache, 'set_many', wraps=utils_stats.cache.set_many) as mock_set_many:
+                utils_stats.check_shopping_list()
+            written = [key for call in mock_set_many.call_args_list for key in call.args[0]]
+            self.assertNotIn('shopping_list', written)
+
+            utils_todo.add_task_or_bump('Consumables', 'Glue {}'.format(etags))
+            utils_stats.check_shopping_list()
+            response = APIClient().get('/stats/')
+
+            self.assertEqual(len(response.json()['shopping_list']), len(self.vikunja.projects['Consumables']['tasks']))
+            self.assertNotEqual(response.json()['versions']['shopping_list'], version)
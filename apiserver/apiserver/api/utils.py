@@ -6,6 +6,7 @@ import json
 import requests
 import time
 from datetime import datetime, timedelta
+from decimal import Decimal
 from rest_framework.exceptions import ValidationError
 from rest_framework.views import exception_handler
 from dateutil import relativedelta
@@ -16,15 +17,15 @@ from bleach.sanitizer import Cleaner
 from PyPDF2 import PdfFileWriter, PdfFileReader
 from reportlab.pdfgen import canvas
 from reportlab.lib.pagesizes import letter
-import paho.mqtt.publish as publish
 
-from django.db.models import Sum
+from django.db import transaction
+from django.db.models import Sum, F
 from django.core.cache import cache
 from django.utils.timezone import now, pytz
 from django.utils.translation import ugettext_lazy as _
 from oidc_provider.lib.claims import ScopeClaims
 
-from . import models, serializers, utils_ldap, utils_stats, utils_auth, utils, utils_email
+from . import models, serializers, utils_ldap, utils_stats, utils_auth, utils, utils_email, utils_search, utils_mqtt
 from .. import settings, secrets
 
 STATIC_FOLDER = 'data/static/'
@@ -62,29 +63,14 @@ def spaceporter_host(message):
     except BaseException as e:
         logger.error('Problem with bot: ' + str(e))
 
-def mqtt_publish(topic, message):
+def mqtt_publish(topic, message, retain=False, qos=0):
     if not secrets.MQTT_WRITER_PASSWORD:
         return False
 
     if settings.DEBUG:
         topic = 'dev_' + topic
-        client_id='dev_spaceport'
-    else:
-        client_id='spaceport'
 
-    try:
-        publish.single(
-            topic,
-            message,
-            hostname='webhost.protospace.ca',
-            port=8883,
-            client_id=client_id,
-            auth=dict(username='writer', password=secrets.MQTT_WRITER_PASSWORD),
-            tls=dict(ca_certs='/etc/ssl/certs/ISRG_Root_X1.pem'),
-            keepalive=5,  # timeout
-        )
-    except BaseException as e:
-        logger.error('Problem sending MQTT message: ' + str(e))
+    return utils_mqtt.get_publisher().publish(topic, message, qos=qos, retain=retain)
 
 
 def num_months_spanned(d1, d2):
@@ -178,37 +164,207 @@ def tally_membership_months(member, fake_date=None):
     return True
 
 
+search_index = None  # per-process, see get_search_index()
+
+SEARCH_STRINGS_TIMEOUT = 60*60*24  # old versions expire, hourly rebuild refreshes
+
+def gen_search_string(member):
+    string = '{} {} | {} {}'.format(
+        member.preferred_name,
+        member.last_name,
+        member.first_name,
+        member.last_name,
+    )
+
+    string += ' | ' + member.user.email
+
+    if member.discourse_username:
+        string += ' | ' + member.discourse_username
+
+    string += ' | ' + str(member.id)
+
+    for s in member.user.storage.all():
+        string += ' | ' + s.shelf_id
+
+    return string.lower()
+
+def get_cached_search_strings():
+    '''
+    Return the current version and its search strings, None if evicted
+
+    Each version is stored under its own key and only published by flipping
+    search_strings_version once fully written, so readers in other processes
+    never see a half-built dict.
+    '''
+    version = cache.get('search_strings_version')
+    if not version:
+        return None, None
+
+    return version, cache.get('search_strings_' + version)
+
+def set_search_strings(search_strings):
+    version = '{:.6f}'.format(time.time())
+    cache.set('search_strings_' + version, search_strings, SEARCH_STRINGS_TIMEOUT)
+    cache.set('search_strings_version', version)
+    return version
+
 def gen_search_strings():
     '''
     Generate a cache dict of names to member ids for rapid string matching
+
+    Members are patched in by update_search_strings() as they change, so this
+    full rebuild is also a consistency check that reports drift.
     '''
     start = time.time()
 
+    members = models.Member.objects.filter(user__isnull=False).order_by('-expire_date')
+    members = members.select_related('user').prefetch_related('user__storage')
+
     search_strings = {}
-    for m in models.Member.objects.order_by('-expire_date').prefetch_related('user__storage'):
-        string = '{} {} | {} {}'.format(
-            m.preferred_name,
-            m.last_name,
-            m.first_name,
-            m.last_name,
-        )
+    for m in members:
+        search_strings[gen_search_string(m)] = m.id
 
-        string += ' | ' + m.user.email
+    _, cached = get_cached_search_strings()
+    if cached is not None and cached != search_strings:
+        drift = set(cached.items()) ^ set(search_strings.items())
+        logger.warning('Search strings drifted by %s entries, replacing.', len(drift))
 
-        if m.discourse_username:
-            string += ' | ' + m.discourse_username
+    version = set_search_strings(search_strings)
 
-        string += ' | ' + str(m.id)
+    global search_index
+    search_index = utils_search.SearchIndex(search_strings, version)
 
-        for s in m.user.storage.all():
-            string += ' | ' + s.shelf_id
+    logger.info('Generated search strings in %s s.', time.time() - start)
 
-        string = string.lower()
-        search_strings[string] = m.id
+    return search_index
 
-    cache.set('search_strings', search_strings)
+def update_search_strings(member_ids):
+    '''
+    Patch only the given members' search strings into a new version
 
-    logger.info('Generated search strings in %s s.', time.time() - start)
+    Changed members keep their rank and new members go first until the next
+    full rebuild sorts them. Two processes patching at the same moment can lose
+    an update, which the hourly gen_search_strings() reports and repairs.
+    '''
+    member_ids = set(member_ids)
+
+    _, search_strings = get_cached_search_strings()
+
+    if search_strings is None and search_index is not None:
+        search_strings = search_index.search_strings
+
+    if search_strings is None:
+        gen_search_strings()
+        return
+
+    members = models.Member.objects.filter(id__in=member_ids, user__isnull=False)
+    members = members.select_related('user').prefetch_related('user__storage')
+
+    new_strings = {m.id: gen_search_string(m) for m in members}
+    existing_ids = set(search_strings.values())
+
+    patched = {}
+    for member_id, string in new_strings.items():
+        if member_id not in existing_ids:
+            patched[string] = member_id
+
+    for string, member_id in search_strings.items():
+        if member_id not in member_ids:
+            patched[string] = member_id
+        elif member_id in new_strings:
+            patched[new_strings.pop(member_id)] = member_id
+
+    if list(patched.items()) == list(search_strings.items()):
+        return
+
+    set_search_strings(patched)
+    logger.info('Updated search strings for member IDs: %s', sorted(member_ids))
+
+def get_search_index():
+    '''
+    Return this process's search index, rebuilding it only when another
+    process has changed the search strings
+    '''
+    global search_index
+
+    version, search_strings = cache.get('search_strings_version'), None
+
+    if search_index is not None and version and search_index.version == version:
+        return search_index
+
+    if version:
+        search_strings = cache.get('search_strings_' + version)
+
+    if search_strings is None:
+        if search_index is not None:
+            # don't stall the search on an eviction, serve what we have
+            logger.warning('Search strings missing from cache, using version %s.', search_index.version)
+            return search_index
+
+        return gen_search_strings() # init cache
+
+    search_index = utils_search.SearchIndex(search_strings, version)
+    logger.info('Loaded search index version %s.', version)
+
+    return search_index
+
+CARD_CHANGES_LIMIT = 1000
+
+def get_card_history_version():
+    '''
+    Position in the Card and Member history tables, both only ever grow
+    '''
+    HistoricalCard = models.Card.history.model
+    HistoricalMember = models.Member.history.model
+
+    card_history = HistoricalCard.objects.order_by('-history_id').values_list('history_id', flat=True).first()
+    member_history = HistoricalMember.objects.order_by('-history_id').values_list('history_id', flat=True).first()
+
+    return '{}-{}'.format(card_history or 0, member_history or 0)
+
+def parse_card_history_version(version):
+    try:
+        card_history, member_history = [int(x) for x in version.split('-')]
+    except (AttributeError, ValueError):
+        return None
+
+    return card_history, member_history
+
+def get_changed_card_numbers(since, until):
+    '''
+    Card numbers whose entry could have changed between two history versions
+
+    Returns None if the versions are unusable or too far apart, the caller
+    should send a full list instead.
+    '''
+    HistoricalCard = models.Card.history.model
+    HistoricalMember = models.Member.history.model
+
+    since = parse_card_history_version(since)
+    until = parse_card_history_version(until)
+    if not since or not until:
+        return None
+
+    if since[0] > until[0] or since[1] > until[1]:
+        return None  # from the future, database was restored
+
+    card_history = HistoricalCard.objects.filter(history_id__gt=since[0], history_id__lte=until[0])
+    member_history = HistoricalMember.objects.filter(history_id__gt=since[1], history_id__lte=until[1])
+
+    if card_history.count() + member_history.count() > CARD_CHANGES_LIMIT:
+        return None
+
+    card_ids = set(card_history.values_list('id', flat=True))
+    user_ids = set(member_history.values_list('user_id', flat=True))
+    user_ids.discard(None)
+
+    # include old numbers of renumbered cards and cards of deleted users
+    card_numbers = set(HistoricalCard.objects.filter(id__in=card_ids).values_list('card_number', flat=True))
+    card_numbers |= set(HistoricalCard.objects.filter(user_id__in=user_ids).values_list('card_number', flat=True))
+    card_numbers |= set(models.Card.objects.filter(user_id__in=user_ids).values_list('card_number', flat=True))
+    card_numbers.discard(None)
+
+    return card_numbers
 
 
 LARGE_SIZE = 1080
@@ -478,10 +634,8 @@ def register_user(data, user):
 
     if data['request_id']: utils_stats.set_progress(data['request_id'], 'Done!')
 
-    gen_search_strings()
-
-    cache.set('sign', 'Welcome to Protospace, {}!'.format(data['preferred_name']))
-    cache.set('vestaboard', 'Welcome to Protospace, {}!'.format(data['preferred_name']))
+    utils_stats.set_stat('sign', 'Welcome to Protospace, {}!'.format(data['preferred_name']))
+    utils_stats.set_stat('vestaboard', 'Welcome to Protospace, {}!'.format(data['preferred_name']))
 
 
 BLANK_FORM = 'misc/blank_member_form.pdf'
@@ -557,6 +711,76 @@ def log_transaction(tx):
 
     logging.info(msg)
 
+def to_protocoin(value):
+    # views create transactions with floats, round like the DecimalField does
+    return Decimal(str(value or 0)).quantize(Decimal('0.01'))
+
+def update_protocoin_balance(user_id):
+    '''
+    Recount a user's balance from their transactions into the ledger
+    '''
+    transactions = models.Transaction.objects.filter(user_id=user_id)
+    balance = transactions.aggregate(Sum('protocoin'))['protocoin__sum'] or 0
+    models.ProtocoinBalance.objects.update_or_create(user_id=user_id, defaults=dict(balance=balance))
+    return to_protocoin(balance)
+
+PROTOCOIN_SUPPLY_ID = 1
+PROTOCOIN_SUPPLY_TIMEOUT = 60
+
+def update_protocoin_supply():
+    '''
+    Recount the total protocoin in circulation into its single row
+    '''
+    total = models.Transaction.objects.aggregate(Sum('protocoin'))['protocoin__sum'] or 0
+    models.ProtocoinSupply.objects.update_or_create(id=PROTOCOIN_SUPPLY_ID, defaults=dict(total=total))
+    transaction.on_commit(lambda: cache.delete('protocoin_supply'))
+    return to_protocoin(total)
+
+def apply_protocoin_changes(changes):
+    '''
+    Add each user's change in protocoin to their ledger balance and the
+    total supply, missing rows get recounted instead
+    '''
+    for user_id, change in changes.items():
+        if not user_id or not change:
+            continue
+
+        balances = models.ProtocoinBalance.objects.filter(user_id=user_id)
+        if not balances.update(balance=F('balance') + change):
+            update_protocoin_balance(user_id)
+
+    # transactions without a user still count towards the supply
+    total_change = sum(changes.values())
+    if total_change:
+        supply = models.ProtocoinSupply.objects.filter(id=PROTOCOIN_SUPPLY_ID)
+        if not supply.update(total=F('total') + total_change):
+            update_protocoin_supply()
+        transaction.on_commit(lambda: cache.delete('protocoin_supply'))
+
+def get_protocoin_balance(user):
+    balance = models.ProtocoinBalance.objects.filter(user=user).values_list('balance', flat=True).first()
+
+    if balance is None:
+        # reads never write, the row is made by the next transaction
+        # or by reconcile_protocoin --fix
+        balance = models.Transaction.objects.filter(user=user).aggregate(Sum('protocoin'))['protocoin__sum']
+        balance = to_protocoin(balance)
+
+    return balance
+
+def get_protocoin_supply():
+    total = cache.get('protocoin_supply')
+    if total is not None:
+        return total
+
+    total = models.ProtocoinSupply.objects.filter(id=PROTOCOIN_SUPPLY_ID).values_list('total', flat=True).first()
+    if total is None:
+        total = to_protocoin(models.Transaction.objects.aggregate(Sum('protocoin'))['protocoin__sum'])
+
+    # short timeout in case a read raced the invalidation
+    cache.set('protocoin_supply', total, PROTOCOIN_SUPPLY_TIMEOUT)
+    return total
+
 
 class CustomScopeClaims(ScopeClaims):
     info_vikunja_scope = (
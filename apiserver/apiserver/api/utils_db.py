@@ -0,0 +1,126 @@
+import logging
+logger = logging.getLogger(__name__)
+
+import time
+import random
+import functools
+from collections import Counter
+from contextlib import contextmanager
+from django.db import transaction
+from django.db.utils import OperationalError
+from rest_framework import exceptions
+
+RETRY_ATTEMPTS = 4
+RETRY_BASE_DELAY = 0.1
+RETRY_MAX_DELAY = 2.0
+# instead of the 20 s connection timeout, so every attempt fits in
+# gunicorn's 30 s worker timeout
+RETRY_BUSY_TIMEOUT = 3000
+
+retry_metrics = Counter()
+
+# applied to every new SQLite connection, see signals.py
+SQLITE_PRAGMAS = [
+    ('journal_mode', 'WAL'),  # readers and the writer don't block each other
+    ('synchronous', 'NORMAL'),  # safe with WAL, only fsyncs on checkpoint
+    ('cache_size', -32000),  # in KiB, per connection
+    ('mmap_size', 256 * 1024 * 1024),
+    ('temp_store', 'MEMORY'),
+]
+
+
+class DatabaseBusy(exceptions.APIException):
+    status_code = 503
+    default_detail = 'Database is busy, please try again.'
+    default_code = 'database_busy'
+
+
+def set_pragmas(connection):
+    with connection.cursor() as cursor:
+        for name, value in SQLITE_PRAGMAS:
+            cursor.execute('PRAGMA {} = {}'.format(name, value))
+
+def is_locked(e):
+    return 'locked' in str(e) or 'busy' in str(e)
+
+@contextmanager
+def immediate_atomic():
+    '''
+    atomic() that takes SQLite's write lock up front with BEGIN IMMEDIATE,
+    so lock contention shows up when the transaction starts instead of at
+    the first write or commit
+    '''
+    connection = transaction.get_connection()
+
+    # needs apiserver.sqlite_backend, nested blocks are already in one
+    if not hasattr(connection, 'begin_immediate') or connection.in_atomic_block:
+        with transaction.atomic():
+            yield
+        return
+
+    connection.begin_immediate = True
+    try:
+        with transaction.atomic():
+            connection.begin_immediate = False
+            yield
+    finally:
+        connection.begin_immediate = False
+
+@contextmanager
+def busy_timeout(ms):
+    '''
+    Temporarily change how long SQLite waits for a lock before raising
+    'database is locked'
+    '''
+    connection = transaction.get_connection()
+
+    if connection.vendor != 'sqlite' or connection.in_atomic_block:
+        yield
+        return
+
+    with connection.cursor() as cursor:
+        cursor.execute('PRAGMA busy_timeout')
+        old = cursor.fetchone()[0]
+        cursor.execute('PRAGMA busy_timeout = {:d}'.format(ms))
+
+    try:
+        yield
+    finally:
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA busy_timeout = {:d}'.format(old))
+
+def atomic_retry(func=None, attempts=RETRY_ATTEMPTS, base_delay=RETRY_BASE_DELAY, max_delay=RETRY_MAX_DELAY):
+    '''
+    Run func in an immediate transaction, retrying with jittered
+    exponential backoff while the database is locked
+
+    func may run more than once, so side effects outside the database
+    belong in transaction.on_commit(). Raises DatabaseBusy (503) once the
+    attempts run out.
+    '''
+    if func is None:
+        return functools.partial(atomic_retry, attempts=attempts, base_delay=base_delay, max_delay=max_delay)
+
+    name = func.__name__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        for attempt in range(1, attempts + 1):
+            try:
+                with busy_timeout(RETRY_BUSY_TIMEOUT), immediate_atomic():
+                    return func(*args, **kwargs)
+            except OperationalError as e:
+                if not is_locked(e):
+                    raise
+
+                if attempt == attempts:
+                    retry_metrics[name + '_failed'] += 1
+                    logger.error('Database locked, giving up on {} after {} attempts. Metrics: {}'.format(name, attempts, dict(retry_metrics)))
+                    raise DatabaseBusy()
+
+                retry_metrics[name + '_retried'] += 1
+                delay = random.uniform(0, min(max_delay, base_delay * 2 ** (attempt - 1)))
+                logger.warning('Database locked in {}, retrying in {:.2f} s ({}/{})'.format(name, delay, attempt, attempts))
+                time.sleep(delay)
+
+    return wrapper
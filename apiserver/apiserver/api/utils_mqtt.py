@@ -0,0 +1,177 @@
+import logging
+logger = logging.getLogger(__name__)
+
+import os
+import time
+import queue
+import atexit
+import threading
+import paho.mqtt.client as mqtt
+
+from apiserver import secrets, settings
+
+MQTT_HOST = 'webhost.protospace.ca'
+MQTT_PORT = 8883
+MQTT_CA_CERTS = '/etc/ssl/certs/ISRG_Root_X1.pem'
+MQTT_KEEPALIVE = 60
+MQTT_QUEUE_SIZE = 1000
+METRICS_INTERVAL = 60
+EXIT_FLUSH_TIMEOUT = 5
+
+
+def gen_client():
+    client_id = 'dev_spaceport' if settings.DEBUG else 'spaceport'
+    client_id += '_{}'.format(os.getpid())  # broker kicks duplicate IDs
+
+    client = mqtt.Client(client_id=client_id)
+    client.username_pw_set('writer', secrets.MQTT_WRITER_PASSWORD)
+    client.tls_set(ca_certs=MQTT_CA_CERTS)
+    client.reconnect_delay_set(min_delay=1, max_delay=60)
+    return client
+
+
+class Publisher:
+    '''
+    Long-lived MQTT connection for one process
+
+    publish() only enqueues, a worker thread sends the messages once the
+    client is connected. paho reconnects on its own. When the queue is full
+    new QoS 0 messages are dropped, QoS 1+ messages make room by dropping
+    the oldest message instead.
+    '''
+    def __init__(self, client_factory=gen_client, maxsize=MQTT_QUEUE_SIZE):
+        self.client_factory = client_factory
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.connected = threading.Event()
+        self.lock = threading.Lock()
+        self.client = None
+        self.thread = None
+        self.sent = 0
+        self.dropped = 0
+        self.last_metrics = time.time()
+
+    def metrics(self):
+        return dict(
+            depth=self.queue.qsize(),
+            sent=self.sent,
+            dropped=self.dropped,
+            connected=self.connected.is_set(),
+        )
+
+    def start(self):
+        with self.lock:
+            if self.thread:
+                return
+
+            self.client = self.client_factory()
+            self.client.on_connect = self.on_connect
+            self.client.on_disconnect = self.on_disconnect
+            self.client.connect_async(MQTT_HOST, MQTT_PORT, keepalive=MQTT_KEEPALIVE)
+            self.client.loop_start()
+
+            self.thread = threading.Thread(target=self.run, name='mqtt-publisher', daemon=True)
+            self.thread.start()
+
+    def on_connect(self, client, userdata, flags, rc):
+        if rc == 0:
+            logger.info('MQTT connected.')
+            self.connected.set()
+        else:
+            logger.error('Problem connecting to MQTT: ' + mqtt.connack_string(rc))
+
+    def on_disconnect(self, client, userdata, rc):
+        self.connected.clear()
+        if rc != 0:
+            logger.warning('MQTT disconnected unexpectedly, reconnecting.')
+
+    def publish(self, topic, message, qos=0, retain=False):
+        self.start()
+        item = (topic, message, qos, retain)
+
+        try:
+            self.queue.put_nowait(item)
+            return True
+        except queue.Full:
+            pass
+
+        if qos:
+            try:
+                evicted = self.queue.get_nowait()
+                self.queue.task_done()
+                self.queue.put_nowait(item)
+                self.drop(evicted[0])
+                return True
+            except (queue.Empty, queue.Full):
+                pass
+
+        self.drop(topic)
+        return False
+
+    def drop(self, topic):
+        self.dropped += 1
+        logger.warning('MQTT queue full, dropped message to {}. Metrics: {}'.format(topic, self.metrics()))
+
+    def send(self, topic, message, qos, retain):
+        while True:
+            self.connected.wait()
+            info = self.client.publish(topic, message, qos=qos, retain=retain)
+
+            if info.rc == mqtt.MQTT_ERR_SUCCESS:
+                self.sent += 1
+                return
+
+            if info.rc != mqtt.MQTT_ERR_NO_CONN:
+                logger.error('Problem sending MQTT message: ' + mqtt.error_string(info.rc))
+                return
+
+            # lost the connection between the wait and the publish
+            self.connected.clear()
+
+    def run(self):
+        while True:
+            topic, message, qos, retain = self.queue.get()
+
+            try:
+                self.send(topic, message, qos, retain)
+            except BaseException as e:
+                logger.error('Problem sending MQTT message: {} - {}'.format(e.__class__.__name__, str(e)))
+            finally:
+                self.queue.task_done()
+
+            if time.time() - self.last_metrics > METRICS_INTERVAL:
+                self.last_metrics = time.time()
+                logger.info('MQTT publisher metrics: {}'.format(self.metrics()))
+
+    def flush(self, timeout=EXIT_FLUSH_TIMEOUT):
+        if not self.thread:
+            return True
+
+        deadline = time.time() + timeout
+        while self.queue.unfinished_tasks and time.time() < deadline:
+            time.sleep(0.05)
+
+        return not self.queue.unfinished_tasks
+
+
+publisher = None
+publisher_pid = None
+publisher_lock = threading.Lock()
+
+def get_publisher():
+    global publisher, publisher_pid
+
+    # threads don't survive a fork, each worker needs its own
+    if publisher is None or publisher_pid != os.getpid():
+        with publisher_lock:
+            # another thread may have made it while we waited
+            if publisher is None or publisher_pid != os.getpid():
+                publisher = Publisher()
+                publisher_pid = os.getpid()
+
+    return publisher
+
+@atexit.register
+def flush_on_exit():
+    # management commands exit right after publishing
+    if publisher is not None and publisher_pid == os.getpid():
+        publisher.flush()
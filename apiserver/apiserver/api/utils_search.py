@@ -0,0 +1,229 @@
+import logging
+logger = logging.getLogger(__name__)
+
+import math
+import heapq
+import itertools
+from collections import Counter
+from fuzzywuzzy import fuzz, utils as fuzz_utils
+
+NUM_RESULTS = 20
+NGRAM_SIZE = 3
+TRIE_DEPTH = 8
+
+
+def ngrams(string, n):
+    return {string[i:i+n] for i in range(len(string) - n + 1)}
+
+
+class TrieNode:
+    __slots__ = ('children', 'indexes')
+
+    def __init__(self):
+        self.children = {}
+        self.indexes = []
+
+
+class FuzzyQuery:
+    __slots__ = ('tokens', 'length', 'char_counts')
+
+    def __init__(self, processed):
+        # what token_set_ratio() compares when nothing is shared
+        self.tokens = set(processed.split())
+        sorted_tokens = ' '.join(sorted(self.tokens))
+        self.length = len(sorted_tokens)
+        self.char_counts = Counter(sorted_tokens)
+
+
+class SearchIndex:
+    '''
+    In-process index over the search strings generated by gen_search_strings()
+
+    Matches are returned in the same order as a linear scan over the strings:
+    prefix matches first, then substring matches, then fuzzy matches only if
+    nothing else matched. Indexes into self.choices are kept in insertion
+    order so every posting list is already sorted by rank.
+    '''
+    def __init__(self, search_strings, version=None):
+        self.version = version
+        self.search_strings = search_strings
+        self.choices = list(search_strings.keys())
+
+        # prefix trie, each node lists the strings passing through it
+        self.trie = TrieNode()
+
+        # posting lists for every 1, 2 and 3 character gram so that
+        # substring queries of any length can be pruned to candidates
+        self.postings = {}
+
+        # token_set_ratio() inputs for bounding fuzzy scores
+        self.processed = []
+        self.tokens = []
+        self.lengths = []
+        self.char_counts = []
+        self.token_postings = {}
+        self.length_buckets = {}
+
+        for index, string in enumerate(self.choices):
+            node = self.trie
+            for char in string[:TRIE_DEPTH]:
+                node = node.children.setdefault(char, TrieNode())
+                node.indexes.append(index)
+
+            for n in range(1, NGRAM_SIZE + 1):
+                for gram in ngrams(string, n):
+                    self.postings.setdefault(gram, []).append(index)
+
+            processed = fuzz_utils.full_process(string, force_ascii=True)
+            tokens = set(processed.split())
+            sorted_tokens = ' '.join(sorted(tokens))
+            self.processed.append(processed)
+            self.tokens.append(tokens)
+            self.lengths.append(len(sorted_tokens))
+            self.char_counts.append(Counter(sorted_tokens))
+            for token in tokens:
+                self.token_postings.setdefault(token, []).append(index)
+            self.length_buckets.setdefault(len(sorted_tokens), []).append(index)
+
+    def __len__(self):
+        return len(self.choices)
+
+    def prefix_matches(self, search, limit):
+        node = self.trie
+        for char in search[:TRIE_DEPTH]:
+            node = node.children.get(char)
+            if not node:
+                return []
+
+        results = []
+        for index in node.indexes:
+            if len(results) >= limit:
+                break
+            # trie is depth limited, so long searches need verifying
+            if self.choices[index].startswith(search):
+                results.append(index)
+
+        return results
+
+    def substring_matches(self, search, limit, exclude=()):
+        n = min(len(search), NGRAM_SIZE)
+        grams = ngrams(search, n)
+
+        candidates = None
+        for gram in grams:
+            posting = self.postings.get(gram)
+            if not posting:
+                return []
+            if candidates is None or len(posting) < len(candidates):
+                candidates = posting
+
+        results = []
+        for index in candidates:
+            if len(results) >= limit:
+                break
+            if index in exclude:
+                continue
+            if search in self.choices[index]:
+                results.append(index)
+
+        return results
+
+    def fuzzy_bound(self, query, index):
+        '''
+        Upper bound on token_set_ratio(query, choice). Each ratio() is
+        2 * matching chars / total length, and matching chars can't exceed
+        the shorter string or the characters both strings have in common.
+        '''
+        tokens = self.tokens[index]
+        length = self.lengths[index]
+        counts = self.char_counts[index]
+        sect = query.tokens & tokens
+
+        if not sect:
+            # only the two token strings get compared
+            overlap = sum(min(n, counts[c]) for c, n in query.char_counts.items())
+            return 200 * overlap / (query.length + length)
+
+        # the intersection against either side is known exactly or by length
+        sorted_sect = ' '.join(sorted(sect))
+        combined = (sorted_sect + ' ' + ' '.join(sorted(query.tokens - sect))).strip()
+        overlap = sum(min(n, counts[c]) for c, n in Counter(combined).items())
+
+        return max(
+            fuzz.ratio(sorted_sect, combined),
+            200 * len(sorted_sect) / (len(sorted_sect) + length),
+            200 * overlap / (len(combined) + length),
+        )
+
+    def fuzzy_matches(self, search, limit):
+        '''
+        Same results as process.extract() with token_set_ratio over every
+        string, ties kept in index order. Strings are scored best bound
+        first and skipped once their bound can't beat the current top
+        limit, so most of them are never scored.
+        '''
+        processed = fuzz_utils.full_process(fuzz_utils.full_process(search), force_ascii=True)
+        if not fuzz_utils.validate_string(processed):
+            return self.choices[:limit]  # everything scores 0
+
+        query = FuzzyQuery(processed)
+
+        shared = set()
+        for token in query.tokens:
+            shared.update(self.token_postings.get(token, []))
+
+        # (-bound, first index, order, length bucket or None)
+        order = itertools.count()
+        heap = [(-self.fuzzy_bound(query, i), i, next(order), None) for i in shared]
+        for length, indexes in self.length_buckets.items():
+            bound = 200 * min(query.length, length) / (query.length + length) if length else 0
+            heap.append((-bound, indexes[0], next(order), length))
+        heapq.heapify(heap)
+
+        best = []  # min heap of (score, -index), worst kept first
+        while heap:
+            bound, index, _, length = heapq.heappop(heap)
+            max_score = math.floor(0.5 - bound + 1e-9)  # at least what intr() rounds to
+
+            if len(best) >= limit:
+                if max_score < best[0][0]:
+                    break
+                if (max_score, -index) < best[0]:
+                    continue  # ties only win with a lower index
+
+            if length is not None:
+                for i in self.length_buckets[length]:
+                    if i not in shared:
+                        heapq.heappush(heap, (-self.fuzzy_bound(query, i), i, next(order), None))
+                continue
+
+            score = fuzz.token_set_ratio(processed, self.processed[index], full_process=False)
+            if len(best) < limit:
+                heapq.heappush(best, (score, -index))
+            else:
+                heapq.heappushpop(best, (score, -index))
+
+        return [self.choices[-i] for _, i in sorted(best, reverse=True)]
+
+    def search(self, search, limit=NUM_RESULTS):
+        '''
+        Return up to limit matching search strings in rank order
+        '''
+        if not len(search):
+            return []
+
+        results = self.prefix_matches(search, limit)
+
+        if len(results) < limit:
+            results += self.substring_matches(search, limit - len(results), exclude=set(results))
+
+        results = [self.choices[i] for i in results]
+
+        if len(results) == 0 and len(search) >= 3 and '@' not in search and len(self):
+            # then get fuzzy matches, but not for emails
+            results = self.fuzzy_matches(search, limit)
+
+        return results
+
+    def search_ids(self, search, limit=NUM_RESULTS):
+        return [self.search_strings[x] for x in self.search(search, limit)]
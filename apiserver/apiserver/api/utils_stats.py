@@ -2,16 +2,23 @@ import logging
 logger = logging.getLogger(__name__)
 
 import time
+import json
+import hashlib
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date, datetime, timedelta
 import requests
-from django.db.models import Prefetch, Count, Q
-from django.db.models.functions import TruncWeek
+from django.db.models import Count, Q, Subquery, OuterRef
+from django.db.models.functions import TruncWeek, TruncMonth
 from django.core.cache import cache
+from django.db import connection
 from django.utils.timezone import now, pytz
 from apiserver.api import models, utils
+from apiserver.api.permissions import is_admin_director
 from apiserver import secrets
 
-from . import utils_todo
+from . import utils_todo, utils_telemetry
 
 DEFAULTS = {
     'last_card_change': time.time(),
@@ -27,6 +34,7 @@ DEFAULTS = {
     'bay_110_temp': None,
     'minecraft_players': [],
     'card_scans': 0,
+    'member_scans': 0,
     'track': {},
     'alarm': {},
     'sign': '',
@@ -57,12 +65,259 @@ EXTRAS = {
 }
 
 
+def stats_version_key(key):
+    return 'stats_version_' + key
+
+def bump_stats_versions(keys):
+    now_ms = int(time.time() * 1000)
+    versions = {}
+
+    try:
+        for key in keys:
+            cache.add(stats_version_key(key), now_ms)
+            versions[key] = cache.incr(stats_version_key(key))
+    except ValueError:
+        return None  # cache is down
+
+    return versions
+
+def served_stat(key):
+    '''
+    The /stats/ key a cache key shows up under, or None if it isn't shown
+    '''
+    if key in SERVED_STATS:
+        return key
+
+    # a collector's content hash and time are shown with it
+    for prefix in ['version_', 'collected_at_']:
+        if key.startswith(prefix) and key[len(prefix):] in COLLECTED_KEYS:
+            return key[len(prefix):]
+
+    return None
+
+def get_stats_version(tier='admin'):
+    '''
+    Version of the /stats/ keys this tier sees, only changes when one of
+    them is written
+    '''
+    keys = [key for key in SERVED_STATS if key not in HIDDEN_STATS[tier]]
+    versions = cache.get_many([stats_version_key(key) for key in keys])
+    versions = {key: versions.get(stats_version_key(key)) for key in keys}
+
+    missing = [key for key, version in versions.items() if version is None]
+    if missing:
+        bumped = bump_stats_versions(missing)
+        if bumped is None:
+            return None
+        versions.update(bumped)
+
+    string = ','.join(str(versions[key]) for key in keys)
+    return hashlib.sha1(string.encode()).hexdigest()[:16]
+
+def set_stats(values):
+    '''
+    Write keys shown by /stats/ and bump their versions so cached responses
+    that include them get rebuilt
+    '''
+    cache.set_many(values)
+
+    stats = {served_stat(key) for key in values} - {None}
+    bump_stats_versions(sorted(stats))
+
+def set_stat(key, value):
+    set_stats({key: value})
+
+# stats that are dicts of devices, each device posts on its own
+DEVICE_STATS = ['track', 'printer3d', 'scanner3d', 'solar']
+SOLAR_RECENT = 1800
+
+def device_key(key, device, kind='device'):
+    # device names come from clients, hash them into valid memcached keys
+    digest = hashlib.sha1(str(device).encode()).hexdigest()[:16]
+    return '{}_{}_{}'.format(key, kind, digest)
+
+def set_device_stat(key, device, value):
+    '''
+    Set one device's entry of a device stat without reading or writing the
+    others, so concurrent posts from different devices can't lose updates
+
+    New devices get a slot in the stat's index from an atomic counter.
+    '''
+    if cache.add(device_key(key, device, 'known'), True):
+        cache.add(key + '_slots', 0)
+
+        try:
+            slot = cache.incr(key + '_slots')
+            cache.set('{}_slot_{}'.format(key, slot), device)
+        except ValueError:
+            pass  # cache is down
+
+    cache.set(device_key(key, device), value)
+    bump_stats_versions([key])
+    utils_telemetry.record(key, device, value)
+
+def get_device_stat(key, device):
+    return cache.get(device_key(key, device))
+
+def get_device_stats(keys):
+    '''
+    Assemble the device stats into dicts by device name, takes three cache
+    round trips no matter how many stats or devices
+    '''
+    slot_counts = cache.get_many([key + '_slots' for key in keys])
+
+    slot_keys = {}
+    for key in keys:
+        count = slot_counts.get(key + '_slots', 0)
+        for i in range(1, count + 1):
+            slot_keys['{}_slot_{}'.format(key, i)] = key
+
+    slots = cache.get_many(slot_keys.keys())
+
+    device_keys = {}
+    for slot_key, key in slot_keys.items():  # keeps the order devices were first seen
+        if slot_key in slots:
+            device = slots[slot_key]
+            device_keys[device_key(key, device)] = (key, device)
+
+    values = cache.get_many(device_keys.keys())
+
+    result = {key: {} for key in keys}
+    for cache_key, (key, device) in device_keys.items():
+        if cache_key in values:
+            result[key][device] = values[cache_key]
+
+    return result
+
+def calc_solar(users):
+    if not users:
+        return {}
+
+    # total of users that posted within a while of the latest one
+    latest = max(user['time'] for user in users.values())
+    total = sum(user['power'] for user in users.values() if latest - user['time'] < SOLAR_RECENT)
+
+    return dict(users=users, total=total)
+
+# keep-alive connections for the collectors below, Sessions aren't
+# thread-safe so each thread gets its own
+http_local = threading.local()
+
+def get_http():
+    if not hasattr(http_local, 'session'):
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=10)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        http_local.session = session
+
+    return http_local.session
+
+COLLECTOR_DEADLINE = 40
+FORUM_PAGE_WORKERS = 4
+
+def set_collected(key, value):
+    '''
+    Store a collector's value with when it was collected, on failure the
+    last good value stays
+
+    The value is only rewritten when its content hash (the key's version)
+    changes. Returns whether it changed.
+    '''
+    version = hashlib.sha1(json.dumps(value, sort_keys=True, default=str).encode()).hexdigest()[:12]
+    collected_at = time.time()
+
+    # touch() makes sure the value itself wasn't evicted
+    if cache.get('version_' + key) == version and cache.touch(key):
+        # no version bump, cached /stats/ responses keep the older time
+        cache.set('collected_at_' + key, collected_at)
+        return False
+
+    set_stats({key: value, 'version_' + key: version, 'collected_at_' + key: collected_at})
+    return True
+
+def get_collected_at(keys):
+    collected_at = cache.get_many(['collected_at_' + key for key in keys])
+    return {key: collected_at.get('collected_at_' + key) for key in keys}
+
+def get_versions(keys):
+    versions = cache.get_many(['version_' + key for key in keys])
+    return {key: versions.get('version_' + key) for key in keys}
+
+def run_collectors(collectors, deadline=COLLECTOR_DEADLINE):
+    '''
+    Run the collectors concurrently, returns their results by name
+
+    Collectors still running at the deadline are abandoned and their result
+    is None. They run in daemon threads so a hung one can't keep the
+    process alive into the next cron run.
+    '''
+    results = {}
+    errors = {}
+
+    def run(name, func):
+        try:
+            results[name] = func()
+        except BaseException as e:
+            errors[name] = e
+
+    threads = {}
+    for name, func in collectors:
+        threads[name] = threading.Thread(target=run, args=(name, func), name='collector_' + name, daemon=True)
+        threads[name].start()
+
+    end = time.time() + deadline
+    for thread in threads.values():
+        thread.join(max(0, end - time.time()))
+
+    finished = {}
+    for name, thread in threads.items():
+        if thread.is_alive():
+            logger.error('Collector {} missed the {} s deadline.'.format(name, deadline))
+            finished[name] = None
+        elif name in errors:
+            e = errors[name]
+            logger.error('Problem running collector {}: {} - {}'.format(name, e.__class__.__name__, str(e)))
+            finished[name] = None
+        else:
+            finished[name] = results.get(name)
+
+    return finished
+
 def changed_card():
     '''
     Called whenever the card list could change, ie. cards added, modified, or
     user status becoming overdue by 3 months
     '''
-    cache.set('last_card_change', time.time())
+    last_card_change = time.time()
+    set_stat('last_card_change', last_card_change)
+    publish_card_change(last_card_change)
+    return last_card_change
+
+def publish_card_change(last_card_change):
+    '''
+    Tell door and lockout controllers to refetch, retained so they get the
+    latest version as soon as they subscribe
+    '''
+    if not secrets.MQTT_WRITER_PASSWORD:
+        return
+
+    message = dict(
+        last_card_change=last_card_change,
+        history_version=utils.get_card_history_version(),
+    )
+    utils.mqtt_publish('spaceport/cards/version', json.dumps(message), retain=True, qos=1)
+
+def get_last_card_change():
+    '''
+    Version of the card lists, shared by all processes
+    '''
+    last_card_change = cache.get('last_card_change')
+
+    if not last_card_change:
+        last_card_change = changed_card()
+
+    return last_card_change
 
 def calc_next_events():
     sessions = models.Session.objects
@@ -85,71 +340,67 @@ def calc_next_events():
     ).count()
 
     if member_meeting:
-        cache.set('next_meeting', member_meeting.datetime)
+        set_stat('next_meeting', member_meeting.datetime)
     else:
-        cache.set('next_meeting', None)
+        set_stat('next_meeting', None)
 
     if monthly_clean:
-        cache.set('next_clean', monthly_clean.datetime)
+        set_stat('next_clean', monthly_clean.datetime)
     else:
-        cache.set('next_clean', None)
+        set_stat('next_clean', None)
 
     if next_class:
-        cache.set('next_class', dict(datetime=next_class.datetime, id=next_class.id, name=next_class.course.name))
+        set_stat('next_class', dict(datetime=next_class.datetime, id=next_class.id, name=next_class.course.name))
     else:
-        cache.set('next_class', None)
+        set_stat('next_class', None)
 
     if prev_class:
-        cache.set('prev_class', dict(datetime=prev_class.datetime, id=prev_class.id, name=prev_class.course.name))
+        set_stat('prev_class', dict(datetime=prev_class.datetime, id=prev_class.id, name=prev_class.course.name))
     else:
-        cache.set('prev_class', None)
+        set_stat('prev_class', None)
 
-    cache.set('upcoming_classes', upcoming_classes_count)
+    set_stat('upcoming_classes', upcoming_classes_count)
 
 def calc_member_counts():
-    members = models.Member.objects
-    not_paused = members.filter(paused_date__isnull=True)
-
-    num_current = not_paused.filter(status='Current').count()
-    num_prepaid = not_paused.filter(status='Prepaid').count()
-    num_due = not_paused.filter(status='Due').count()
-    num_overdue = not_paused.filter(status='Overdue').count()
-
-    member_count = num_current + num_prepaid + num_due + num_overdue
-    paused_count = members.count() - member_count
-    green_count = num_current + num_prepaid
-
     six_months_ago = utils.today_local_tz() - timedelta(days=183)
-    six_month_plus_count = not_paused.filter(application_date__lte=six_months_ago).count()
 
-    vetted_count = not_paused.filter(vetted_date__isnull=False).count()
+    latest_membership_tx = models.Transaction.objects.filter(
+        user=OuterRef('user'),
+    ).exclude(
+        number_of_membership_months=0,
+    ).exclude(
+        number_of_membership_months__isnull=True,
+    ).order_by('-date', '-id').values('paypal_txn_type')[:1]
+
+    not_paused = Q(paused_date__isnull=True)
 
-    related_membership_tx = Prefetch(
-        'user__transactions',
-        queryset=models.Transaction.objects.exclude(
-            number_of_membership_months=0,
-        ).exclude(
-            number_of_membership_months__isnull=True,
-        ),
+    counts = models.Member.objects.annotate(
+        latest_membership_txn_type=Subquery(latest_membership_tx),
+    ).aggregate(
+        total=Count('id'),
+        num_current=Count('id', filter=not_paused & Q(status='Current')),
+        num_prepaid=Count('id', filter=not_paused & Q(status='Prepaid')),
+        num_due=Count('id', filter=not_paused & Q(status='Due')),
+        num_overdue=Count('id', filter=not_paused & Q(status='Overdue')),
+        six_month_plus_count=Count('id', filter=not_paused & Q(application_date__lte=six_months_ago)),
+        vetted_count=Count('id', filter=not_paused & Q(vetted_date__isnull=False)),
+        subscriber_count=Count('id', filter=not_paused & Q(latest_membership_txn_type='subscr_payment')),
     )
 
-    subscriber_count = 0
-    for member in not_paused.prefetch_related(related_membership_tx):
-        if not member.user.transactions.count():
-            continue
-        if member.user.transactions.latest('date').paypal_txn_type == 'subscr_payment':
-            subscriber_count += 1
+    member_count = counts['num_current'] + counts['num_prepaid'] + counts['num_due'] + counts['num_overdue']
+    paused_count = counts['total'] - member_count
+    green_count = counts['num_current'] + counts['num_prepaid']
 
-    cache.set('member_count', member_count)
-    cache.set('paused_count', paused_count)
-    cache.set('green_count', green_count)
+    set_stat('member_count', member_count)
+    set_stat('paused_count', paused_count)
+    set_stat('green_count', green_count)
 
     return dict(
         member_count=member_count,
         green_count=green_count,
-        six_month_plus_count=six_month_plus_count,
-        vetted_count=vetted_count,
-        subscriber_count=subscriber_count,
+        six_month_plus_count=counts['six_month_plus_count'],
+        vetted_count=counts['vetted_count'],
+        subscriber_count=counts['subscriber_count'],
     )
 
 def calc_signup_counts():
@@ -162,36 +413,47 @@ def calc_signup_counts():
     return num_new_members
 
 def calc_retain_counts():
-    signup_counts = models.StatsSignupCount.objects.all()
+    months = models.Member.objects.annotate(
+        month=TruncMonth('application_date'),
+    ).values('month').annotate(
+        retain_count=Count('id', filter=Q(paused_date__isnull=True)),
+        vetted_count=Count('id', filter=Q(vetted_date__isnull=False)),
+    ).order_by()
 
-    all_members = models.Member.objects
-    active_members = all_members.filter(paused_date__isnull=True)
-    vetted_members = all_members.filter(vetted_date__isnull=False)
+    counts = {}
+    active_count = 0
 
-    for entry in signup_counts:
-        date = entry.month
-        active_new_members = active_members.filter(
-            application_date__month=date.month, application_date__year=date.year
-        )
-        vetted_new_members = vetted_members.filter(
-            application_date__month=date.month, application_date__year=date.year
-        )
+    for month in months:
+        active_count += month['retain_count']
+        if month['month']:
+            key = (month['month'].year, month['month'].month)
+            counts[key] = (month['retain_count'], month['vetted_count'])
+
+    changed = []
+
+    for entry in models.StatsSignupCount.objects.all():
+        retain_count, vetted_count = counts.get((entry.month.year, entry.month.month), (0, 0))
+
+        if entry.retain_count == retain_count and entry.vetted_count == vetted_count:
+            continue
+
+        entry.retain_count = retain_count
+        entry.vetted_count = vetted_count
+        changed.append(entry)
 
-        entry.retain_count = active_new_members.count()
-        entry.vetted_count = vetted_new_members.count()
-        entry.save()
+    models.StatsSignupCount.objects.bulk_update(changed, ['retain_count', 'vetted_count'])
 
-    return active_members.count()
+    return active_count
 
 def check_minecraft_server():
     if secrets.MINECRAFT:
         url = 'https://api.minetools.eu/ping/' + secrets.MINECRAFT
 
         try:
-            r = requests.get(url, timeout=5)
+            r = get_http().get(url, timeout=5)
             r.raise_for_status()
             players = [x['name'] for x in r.json()['players']['sample']]
-            cache.set('minecraft_players', players)
+            set_collected('minecraft_players', players)
             return players
         except BaseException as e:
             logger.error('Problem checking Minecraft: {} - {}'.format(e.__class__.__name__, str(e)))
@@ -203,10 +465,10 @@ def check_mumble_server():
         url = secrets.MUMBLE
 
         try:
-            r = requests.get(url, timeout=5)
+            r = get_http().get(url, timeout=5)
             r.raise_for_status()
             users = r.text.split()
-            cache.set('mumble_users', users)
+            set_collected('mumble_users', users)
             return users
         except BaseException as e:
             logger.error('Problem checking Mumble: {} - {}'.format(e.__class__.__name__, str(e)))
@@ -225,7 +487,7 @@ def check_shopping_list():
                     created=task['created'],
                     labels=labels,
                 ))
-            cache.set('shopping_list', shopping_list)
+            set_collected('shopping_list', shopping_list)
             return tasks
         except BaseException as e:
             logger.error('Problem checking Shopping List: {} - {}'.format(e.__class__.__name__, str(e)))
@@ -244,143 +506,184 @@ def check_maintenance_list():
                     created=task['created'],
                     labels=labels,
                 ))
-            cache.set('maintenance_list', maintenance_list)
+            set_collected('maintenance_list', maintenance_list)
             return tasks
         except BaseException as e:
             logger.error('Problem checking Maintenance List: {} - {}'.format(e.__class__.__name__, str(e)))
 
     return []
 
+# network-bound stats run concurrently by run_minutely
+MINUTELY_COLLECTORS = [
+    ('minecraft_players', check_minecraft_server),
+    ('mumble_users', check_mumble_server),
+    ('shopping_list', check_shopping_list),
+    ('maintenance_list', check_maintenance_list),
+]
+
+COLLECTED_KEYS = ['minecraft_players', 'mumble_users', 'shopping_list', 'maintenance_list', 'forums_visit_1mo']
+
+# everything /stats/ can show, each has its own version
+SERVED_STATS = list(DEFAULTS) + [key for key in COLLECTED_KEYS if key not in DEFAULTS]
+
+# keys left out of /stats/ for each tier of viewer
+HIDDEN_STATS = {
+    'anonymous': ['alarm', 'autoscan'],
+    'member': ['autoscan'],
+    'admin': [],
+}
+
+def get_tier(user):
+    if not user or not user.is_authenticated:
+        return 'anonymous'
+    elif not is_admin_director(user):
+        return 'member'
+    else:
+        return 'admin'
+
+def get_stats(tier='admin'):
+    stats = DEFAULTS.copy()
+    stats.update(cache.get_many(DEFAULTS.keys()))
+
+    device_stats = get_device_stats(DEVICE_STATS)
+    device_stats['solar'] = calc_solar(device_stats['solar'])
+    stats.update(device_stats)
+
+    for key in HIDDEN_STATS[tier]:
+        stats.pop(key, None)
+
+    stats['collected_at'] = get_collected_at(COLLECTED_KEYS)
+    stats['versions'] = get_versions(COLLECTED_KEYS)
+    return stats
+
+SCAN_COUNTER_TIMEOUT = 60*60*48
+
+def incr_daily_count(name, date):
+    key = '{}_{}'.format(name, date)
+    cache.add(key, 0, SCAN_COUNTER_TIMEOUT)
+
+    try:
+        count = cache.incr(key)
+    except ValueError:
+        return None  # cache is down, calc_card_scans() will fix it
+
+    set_stat(name, count)
+    return count
+
+def count_card_scan(card_id, member_id):
+    '''
+    Called on every door scan, only touches the cache
+    '''
+    date = utils.today_local_tz()
+
+    if cache.add('card_seen_{}_{}'.format(date, card_id), True, SCAN_COUNTER_TIMEOUT):
+        incr_daily_count('card_scans', date)
+
+    if cache.add('member_seen_{}_{}'.format(date, member_id), True, SCAN_COUNTER_TIMEOUT):
+        incr_daily_count('member_scans', date)
+
+def flush_card_scans():
+    date = utils.today_local_tz()
+    card_scans = cache.get('card_scans_{}'.format(date))
+    member_scans = cache.get('member_scans_{}'.format(date))
+
+    if card_scans is None:
+        return None
+
+    models.StatsSpaceActivity.objects.update_or_create(
+        date=date,
+        defaults=dict(card_scans=card_scans, member_scans=member_scans),
+    )
+
+    return card_scans
+
 def calc_card_scans():
+    '''
+    Recount today's scans from the database in case the counters drifted
+    '''
     date = utils.today_local_tz()
     dt = datetime.combine(date, datetime.min.time())
     midnight = utils.DISPLAY_TZ.localize(dt)
 
-    cards = models.Card.objects
-    count = cards.filter(last_seen__gte=midnight).count()
+    cards = models.Card.objects.filter(last_seen__gte=midnight)
+    card_scans = cards.count()
+    member_scans = cards.exclude(user__isnull=True).values('user').distinct().count()
 
-    cache.set('card_scans', count)
+    set_stats({
+        'card_scans': card_scans,
+        'member_scans': member_scans,
+    })
+    cache.set_many({
+        'card_scans_{}'.format(date): card_scans,
+        'member_scans_{}'.format(date): member_scans,
+    }, SCAN_COUNTER_TIMEOUT)
 
     models.StatsSpaceActivity.objects.update_or_create(
         date=date,
-        defaults=dict(card_scans=count),
+        defaults=dict(card_scans=card_scans, member_scans=member_scans),
     )
 
-def calc_drink_sales():
-    six_months_ago = utils.today_local_tz() - timedelta(days=183)
-
-    drinks_since = {
-        '1970-01-01': {
-            '1': 'Coke',
-            '2': 'Coke Zero',
-            '3': 'Root Beer',
-            '4': 'Iced Tea',
-            '5': 'Crush Pop',
-            '6': 'Dr Pepper',
-            '7': 'Arizona Tea',
-            '8': 'Cherry Coke',
-        },
-        '2025-04-01': {
-            '1': 'Coke',
-            '2': 'Coke Zero',
-            '3': 'Root Beer',
-            '4': 'Iced Tea',
-            '5': 'Fanta',
-            '6': 'Dr Pepper',
-            '7': 'Arizona Tea',
-            '8': 'Cherry Coke',
-        },
-        '2026-01-08': {
-            '1': 'Coke',
-            '2': 'Coke Zero',
-            '3': 'Root Beer',
-            '4': 'Iced Tea',
-            '5': 'Fanta',
-            '6': 'Dr Pepper',
-            '7': 'Diet Coke',
-            '8': 'Cherry Coke',
-        },
-        '2026-01-19': {
-            '1': 'Coke',
-            '2': 'Coke Zero',
-            '3': 'Root Beer',
-            '4': 'Iced Tea',
-            '5': 'Fanta',
-            '6': 'Dr Pepper',
-            '7': 'Diet Coke',
-            '8': 'Brisk Iced Tea',
-        },
-        '2026-02-01': {
-            '1': 'Coke',
-            '2': 'Coke Zero',
-            '3': 'Root Beer',
-            '4': 'Iced Tea',
-            '5': 'Fanta',
-            '6': 'Dr Pepper',
-            '7': 'Brisk Iced Tea',
-            '8': 'Diet Coke',
-        },
-        '2026-02-11': {
-            '1': 'Coke',
-            '2': 'Coke Zero',
-            '3': 'Root Beer',
-            '4': 'Lime Bubly',
-            '5': 'Fanta',
-            '6': 'Dr Pepper',
-            '7': 'Brisk Iced Tea',
-            '8': 'Diet Coke',
-        },
-    }
+def get_vending_slots(machine='pop'):
+    '''
+    Return each slot number's VendingSlot history, oldest first
+    '''
+    slots = {}
+    for slot in models.VendingSlot.objects.filter(machine=machine).order_by('since', 'id'):
+        slots.setdefault(slot.number, []).append(slot)
+    return slots
+
+def find_vending_slot(slots, number, date):
+    found = None
+    for slot in slots.get(number, []):
+        if slot.since > date:
+            break
+        found = slot
+    return found
+
+def count_drinks(transactions, since=None, machine='pop', slots=None):
+    '''
+    Count vends of each VendingSlot with one grouped query
+    '''
+    if slots is None:
+        slots = get_vending_slots(machine)
 
-    colors = {
-        'Coke': '#e7223a',
-        'Coke Zero': 'black',
-        'Root Beer': '#9a4423',
-        'Iced Tea': '#1582ae',
-        'Crush Pop': '#d77a2d',
-        'Fanta': '#ffd700',
-        'Dr Pepper': '#6f0e21',
-        'Arizona Tea': '#3fad96',
-        'Cherry Coke': '#ab316e',
-        'Diet Coke': '#c8b560',
-        'Brisk Iced Tea': '#f07e05',
-        'Lime Bubly': '#00ff00',
-    }
+    sales = transactions.filter(vending_machine=machine)
+    if since:
+        sales = sales.filter(date__gte=since)
 
-    txs = models.Transaction.objects
-    drink_counts = {}
-    sorted_dates = sorted(drinks_since.keys())
+    sales = sales.values('date', 'vending_item').annotate(count=Count('id')).order_by()
 
-    for i, start_date_str in enumerate(sorted_dates):
-        start_date = datetime.strptime(start_date_str, '%Y-%m-%d').date()
+    counts = Counter()
+    for sale in sales:
+        slot = find_vending_slot(slots, sale['vending_item'], sale['date'])
+        if slot:
+            counts[slot] += sale['count']
 
-        end_date = None
-        if i + 1 < len(sorted_dates):
-            end_date_str = sorted_dates[i + 1]
-            end_date = datetime.strptime(end_date_str, '%Y-%m-%d').date()
+    return counts
 
-        # If the period is entirely before the 6-month window, skip it.
-        if end_date and end_date <= six_months_ago:
-            continue
+def calc_drink_sales():
+    six_months_ago = utils.today_local_tz() - timedelta(days=183)
 
-        drinks_mapping = drinks_since[start_date_str]
-        for name in drinks_mapping.values():
-            drink_counts.setdefault(name, 0)
+    slots = get_vending_slots('pop')
+    drink_counts = {}
+    colors = {}
 
-        query_start_date = max(start_date, six_months_ago)
+    # list every drink stocked in the window, even without sales
+    stocked = []
+    for history in slots.values():
+        for slot, replacement in zip(history, history[1:] + [None]):
+            if replacement and replacement.since <= six_months_ago:
+                continue  # replaced before the window
+            stocked.append(slot)
 
-        date_filter = Q(date__gte=query_start_date)
-        if end_date:
-            # The range is up to, but not including, the next start date.
-            date_filter &= Q(date__lt=end_date)
+    for slot in sorted(stocked, key=lambda x: (x.since, x.number)):
+        drink_counts.setdefault(slot.name, 0)
+        colors.setdefault(slot.name, slot.color or 'grey')
 
-        for number, name in drinks_mapping.items():
-            count = txs.filter(
-                date_filter,
-                category='Snacks',
-                memo__contains='pop vending machine item #' + number,
-            ).count()
-            drink_counts[name] += count
+    txs = models.Transaction.objects.filter(category='Snacks')
+    for slot, count in count_drinks(txs, since=six_months_ago, slots=slots).items():
+        drink_counts[slot.name] = drink_counts.get(slot.name, 0) + count
+        colors.setdefault(slot.name, slot.color or 'grey')
 
     results = [{'name': name, 'count': count, 'fill': colors[name]} for name, count in drink_counts.items()]
     cache.set('drinks_6mo', results)
@@ -496,37 +799,37 @@ def calc_cert_distribution():
 
     cache.set('cert_dist', results)
 
-def calc_forum_activity():
-    if not secrets.FORUM_READ_API_KEY:
-        cache.set('forums_visit_1mo', [])
-        return
-
-    page = 0
-    all_items = []
-    total_rows = 1
-
+def get_forum_directory_page(page):
     headers = {'Api-Key': secrets.FORUM_READ_API_KEY, 'Api-Username': 'System'}
-    base_url = "https://forum.protospace.ca/directory_items.json"
+    url = 'https://forum.protospace.ca/directory_items.json'
     params = {
         'group': 'protospace_members',
         'order': 'days_visited',
         'period': 'monthly',
+        'page': page,
     }
 
+    r = get_http().get(url, params=params, headers=headers, timeout=10)
+    r.raise_for_status()
+    return r.json()
+
+def calc_forum_activity():
+    if not secrets.FORUM_READ_API_KEY:
+        cache.set('forums_visit_1mo', [])
+        return
+
     try:
-        while len(all_items) < total_rows:
-            params['page'] = page
-            r = requests.get(base_url, params=params, headers=headers, timeout=10)
-            r.raise_for_status()
-            data = r.json()
+        # first page tells us how many more to fetch
+        data = get_forum_directory_page(0)
+        all_items = data.get('directory_items', [])
+        total_rows = data.get('meta', {}).get('total_rows_directory_items', 0)
 
-            items = data.get('directory_items', [])
-            if not items:
-                break
+        if all_items and len(all_items) < total_rows:
+            num_pages = -(-total_rows // len(all_items))
 
-            all_items.extend(items)
-            total_rows = data.get('meta', {}).get('total_rows_directory_items', 0)
-            page += 1
+            with ThreadPoolExecutor(max_workers=FORUM_PAGE_WORKERS) as executor:
+                for data in executor.map(get_forum_directory_page, range(1, num_pages)):
+                    all_items.extend(data.get('directory_items', []))
 
         days_visited_list = [item['days_visited'] for item in all_items]
         days_visited_list.sort(reverse=True)
@@ -534,10 +837,112 @@ def calc_forum_activity():
             {'member': index + 1, 'days_visited': value}
             for index, value in enumerate(days_visited_list)
         ]
-        cache.set('forums_visit_1mo', results)
+        set_collected('forums_visit_1mo', results)
     except BaseException as e:
         logger.error('Problem checking Forum Activity: {} - {}'.format(e.__class__.__name__, str(e)))
-        cache.set('forums_visit_1mo', [])
+
+
+def record_member_counts():
+    counts = calc_member_counts()
+
+    # do this hourly in case an admin causes a change
+    models.StatsMemberCount.objects.update_or_create(
+        date=utils.today_local_tz(),
+        defaults=dict(
+            member_count=counts['member_count'],
+            green_count=counts['green_count'],
+            six_month_plus_count=counts['six_month_plus_count'],
+            vetted_count=counts['vetted_count'],
+            subscriber_count=counts['subscriber_count'],
+        ),
+    )
+
+def record_signup_counts():
+    signup_count = calc_signup_counts()
+
+    models.StatsSignupCount.objects.update_or_create(
+        month=utils.today_local_tz().replace(day=1),
+        defaults=dict(signup_count=signup_count),
+    )
+
+
+HOUR = 60*60
+DAY = 24*HOUR
+STATS_WORKERS = 4
+
+# stats recomputed by run_hourly, a stat only runs when one of its models
+# changed since its last run or it's older than max_age
+STATS_REGISTRY = [
+    dict(name='next_events', func=calc_next_events, models=[], max_age=0),
+    dict(name='member_counts', func=record_member_counts, models=['Member', 'Transaction'], max_age=6*HOUR),
+    dict(name='signup_counts', func=record_signup_counts, models=['Member'], max_age=6*HOUR),
+    dict(name='drink_sales', func=calc_drink_sales, models=['Transaction', 'VendingSlot'], max_age=DAY),
+    dict(name='card_scans', func=calc_card_scans, models=[], max_age=0),
+    dict(name='dues_dist', func=calc_dues_distribution, models=['Member'], max_age=DAY),
+    dict(name='year_dist', func=calc_year_distribution, models=['Member'], max_age=DAY),
+    dict(name='cert_dist', func=calc_cert_distribution, models=['Member'], max_age=DAY),
+    dict(name='year_attendance', func=calc_year_attendance, models=['Training', 'Session', 'Course', 'Member'], max_age=DAY),
+    dict(name='forum_activity', func=calc_forum_activity, models=[], max_age=0),
+    dict(name='classes_week', func=calc_classes_week, models=['Session', 'Course'], max_age=DAY),
+    dict(name='search_strings', func=lambda: utils.gen_search_strings(), models=['Member', 'User', 'StorageSpace'], max_age=DAY),
+]
+
+STATS_MODELS = set(model for stat in STATS_REGISTRY for model in stat['models'])
+
+def mark_model_changed(model_name):
+    '''
+    Called from signals whenever a model a stat depends on is saved
+    '''
+    if model_name in STATS_MODELS:
+        cache.set('stats_model_changed_' + model_name, time.time())
+
+def get_stale_stats(force=False):
+    if force:
+        return list(STATS_REGISTRY)
+
+    keys = ['stats_ran_' + stat['name'] for stat in STATS_REGISTRY]
+    keys += ['stats_model_changed_' + model for model in STATS_MODELS]
+    times = cache.get_many(keys)
+
+    stale = []
+    for stat in STATS_REGISTRY:
+        ran = times.get('stats_ran_' + stat['name'])
+        changed = [times.get('stats_model_changed_' + model, 0) for model in stat['models']]
+
+        if not ran or time.time() - ran >= stat['max_age'] or max(changed, default=0) >= ran:
+            stale.append(stat)
+
+    return stale
+
+def run_stat(stat):
+    start = time.time()
+
+    try:
+        stat['func']()
+        cache.set('stats_ran_' + stat['name'], start)
+        return dict(name=stat['name'], seconds=time.time() - start, ok=True)
+    except BaseException as e:
+        logger.exception('Problem calculating stat {}: {} - {}'.format(stat['name'], e.__class__.__name__, str(e)))
+        return dict(name=stat['name'], seconds=time.time() - start, ok=False)
+    finally:
+        connection.close()  # each thread opens its own
+
+def run_stats(force=False):
+    '''
+    Recompute stale stats concurrently, returns the timing of each one
+    '''
+    stale = get_stale_stats(force)
+
+    with ThreadPoolExecutor(max_workers=STATS_WORKERS) as executor:
+        timings = list(executor.map(run_stat, stale))
+
+    cache.set('stats_timings', dict(
+        ran_at=time.time(),
+        timings=timings,
+        skipped=[s['name'] for s in STATS_REGISTRY if s not in stale],
+    ))
+
+    return timings
 
 
 def get_progress(request_id):
@@ -0,0 +1,206 @@
+import logging
+logger = logging.getLogger(__name__)
+
+import json
+import asyncio
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
+from django.db import close_old_connections
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.exceptions import AuthenticationFailed
+
+from apiserver.api import utils, utils_stats
+
+STREAM_PATH = '/stats/stream/'
+POLL_INTERVAL = 0.5
+KEEPALIVE_INTERVAL = 15
+SUBSCRIBER_QUEUE_SIZE = 50
+
+
+def with_connections(func, *args):
+    # outside Django's request cycle nothing else expires the worker
+    # thread's persistent database connection
+    close_old_connections()
+    try:
+        return func(*args)
+    finally:
+        close_old_connections()
+
+def to_thread(func, *args):
+    # cache and database calls block, keep them off the event loop
+    return sync_to_async(with_connections, thread_sensitive=False)(func, *args)
+
+def encode_event(event, version, data):
+    message = 'event: {}\n'.format(event)
+    if version:
+        message += 'id: {}\n'.format(version)
+    message += 'data: {}\n\n'.format(json.dumps(data, default=str))
+    return message.encode()
+
+
+class Subscriber:
+    def __init__(self, tier, extra=None):
+        self.hidden = utils_stats.HIDDEN_STATS[tier]
+        self.extra = dict(extra or {})
+        self.queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        self.needs_snapshot = True
+
+    def push(self, event, version, stats):
+        data = {k: v for k, v in stats.items() if k not in self.hidden}
+        if event == 'stats':
+            data.update(self.extra)
+        elif not data:
+            return True
+
+        try:
+            self.queue.put_nowait((event, version, data))
+            return True
+        except asyncio.QueueFull:
+            # too slow to keep up, the client reconnects for a fresh snapshot
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(None)
+            return False
+
+
+class Broadcaster:
+    '''
+    Watches the stats version for this process and pushes the stats that
+    changed to every subscriber
+
+    Only one poll loop runs no matter how many subscribers there are. It
+    stops once the last one leaves.
+    '''
+    def __init__(self, poll_interval=POLL_INTERVAL):
+        self.poll_interval = poll_interval
+        self.subscribers = set()
+        self.version = None
+        self.stats = None
+        self.task = None
+
+    def subscribe(self, tier, extra=None):
+        subscriber = Subscriber(tier, extra)
+        self.subscribers.add(subscriber)
+
+        if not self.task or self.task.done():
+            self.stats = None
+            self.task = asyncio.ensure_future(self.run())
+
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        self.subscribers.discard(subscriber)
+
+    async def poll(self):
+        changed = {}
+        version = await to_thread(utils_stats.get_stats_version)
+
+        if self.stats is None or version != self.version:
+            stats = await to_thread(utils_stats.get_stats)
+            old_stats = self.stats or {}
+            changed = {k: v for k, v in stats.items() if k not in old_stats or old_stats[k] != v}
+            self.version, self.stats = version, stats
+
+        for subscriber in list(self.subscribers):
+            if subscriber.needs_snapshot:
+                subscriber.needs_snapshot = False
+                ok = subscriber.push('stats', self.version, self.stats)
+            elif changed:
+                ok = subscriber.push('changed', self.version, changed)
+            else:
+                continue
+
+            if not ok:
+                logger.warning('Stats stream subscriber too slow, dropped.')
+                self.unsubscribe(subscriber)
+
+    async def run(self):
+        while self.subscribers:
+            try:
+                await self.poll()
+            except Exception as e:
+                logger.error('Problem polling stats for stream: {} - {}'.format(e.__class__.__name__, str(e)))
+
+            await asyncio.sleep(self.poll_interval)
+
+
+broadcaster = Broadcaster()
+
+def get_request_tier(request):
+    # browser EventSource can't set headers, so the token can also come
+    # from the query string: /stats/stream/?token=<key>
+    authentication = TokenAuthentication()
+    token = request.GET.get('token')
+
+    try:
+        if token and not request.META.get('HTTP_AUTHORIZATION'):
+            auth = authentication.authenticate_credentials(token)
+        else:
+            auth = authentication.authenticate(request)
+    except AuthenticationFailed:
+        auth = None
+
+    return utils_stats.get_tier(auth[0] if auth else None)
+
+async def send_response(send, status, body=b''):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'text/plain')],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+async def stats_stream(scope, receive, send):
+    '''
+    Server-sent events of /stats/ as they change, a full snapshot is sent
+    first then only the keys that changed
+    '''
+    if scope['method'] != 'GET':
+        await send_response(send, 405, b'Method not allowed.')
+        return
+
+    request = ASGIRequest(scope, None)
+    tier = await to_thread(get_request_tier, request)
+    at_protospace = utils.is_request_from_protospace(request)
+
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [
+            (b'content-type', b'text/event-stream'),
+            (b'cache-control', b'no-cache'),
+            (b'x-accel-buffering', b'no'),  # stop nginx from holding events
+        ],
+    })
+
+    subscriber = broadcaster.subscribe(tier, dict(at_protospace=at_protospace))
+    disconnect = asyncio.ensure_future(wait_for_disconnect(receive))
+
+    try:
+        while not disconnect.done():
+            get = asyncio.ensure_future(subscriber.queue.get())
+            await asyncio.wait([get, disconnect], timeout=KEEPALIVE_INTERVAL, return_when=asyncio.FIRST_COMPLETED)
+
+            if not get.done():
+                get.cancel()
+                if not disconnect.done():
+                    await send({'type': 'http.response.body', 'body': b': keepalive\n\n', 'more_body': True})
+                continue
+
+            item = get.result()
+            if item is None:
+                break
+
+            await send({'type': 'http.response.body', 'body': encode_event(*item), 'more_body': True})
+
+        if not disconnect.done():
+            await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        broadcaster.unsubscribe(subscriber)
+        disconnect.cancel()
+
+async def wait_for_disconnect(receive):
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return
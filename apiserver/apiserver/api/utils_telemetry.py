@@ -0,0 +1,159 @@
+import logging
+logger = logging.getLogger(__name__)
+
+import time
+from datetime import datetime, timedelta
+from django.core.cache import cache
+from django.db import transaction
+from django.utils.timezone import now, pytz
+
+from apiserver.api import models
+
+POINT_TIMEOUT = 60*60*24
+FLUSH_LOCK_TIMEOUT = 50
+SAVE_BATCH_SIZE = 500
+RAW_RETENTION = timedelta(days=7)
+QUERY_LIMIT = 5000
+MAX_TIMESTAMP = 253402300799  # 9999-12-31, the last time datetime can hold
+
+
+def to_datetime(timestamp):
+    return datetime.fromtimestamp(timestamp, tz=pytz.UTC)
+
+def save_points(points):
+    models.TelemetryPoint.objects.bulk_create([
+        models.TelemetryPoint(
+            source=point['source'],
+            device=point['device'],
+            time=to_datetime(point['time']),
+            data=point['data'],
+        ) for point in points
+    ], batch_size=SAVE_BATCH_SIZE)
+
+def record(source, device, data):
+    '''
+    Record a telemetry point, it's buffered in the cache and written to the
+    database in batches by flush_telemetry() so device posts stay cheap
+    '''
+    point = dict(source=source, device=str(device)[:64], time=time.time(), data=data)
+    cache.add('telemetry_count', 0)
+
+    try:
+        slot = cache.incr('telemetry_count')
+    except ValueError:
+        save_points([point])  # cache is down, write straight through
+        return
+
+    cache.set('telemetry_point_{}'.format(slot), point, POINT_TIMEOUT)
+
+def flush_telemetry():
+    '''
+    Move buffered points into the database, returns how many were saved
+
+    Only slots claimed before the previous flush are moved, a writer may
+    still be between its incr() and set() on the newest ones.
+    '''
+    count = cache.get('telemetry_count')
+    if count is None:
+        return 0
+
+    if not cache.add('telemetry_flush_lock', True, FLUSH_LOCK_TIMEOUT):
+        return 0
+
+    try:
+        flushed = cache.get('telemetry_flushed', 0)
+        upto = cache.get('telemetry_flush_upto', 0)
+
+        if flushed > count:  # counter was evicted and restarted
+            flushed, upto = 0, 0
+        upto = min(upto, count)
+
+        keys = ['telemetry_point_{}'.format(i) for i in range(flushed + 1, upto + 1)]
+        points = cache.get_many(keys)
+        save_points([points[key] for key in keys if key in points])
+
+        cache.delete_many(keys)
+        cache.set_many({'telemetry_flushed': upto, 'telemetry_flush_upto': count})
+        return len(points)
+    finally:
+        cache.delete('telemetry_flush_lock')
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+def merge_data(datas):
+    '''
+    Combine a bucket's points into one, numbers are averaged and anything
+    else keeps its latest value
+    '''
+    merged = dict(datas[-1])
+
+    for key, value in merged.items():
+        values = [data.get(key) for data in datas]
+        if all(is_number(x) for x in values):
+            merged[key] = round(sum(values) / len(values), 2)
+
+    return merged
+
+def rollup_telemetry():
+    '''
+    Downsample raw points older than the retention into hourly points,
+    returns how many hourly points were created
+    '''
+    cutoff = now() - RAW_RETENTION
+    cutoff = cutoff.replace(minute=0, second=0, microsecond=0)
+
+    raw = models.TelemetryPoint.objects.filter(resolution='raw', time__lt=cutoff)
+    buckets = {}
+
+    for point in raw.order_by('time').iterator():
+        hour = point.time.replace(minute=0, second=0, microsecond=0)
+        bucket = buckets.setdefault((point.source, point.device, hour), [])
+        bucket.append(point)
+
+    rollups = []
+    for (source, device, hour), points in buckets.items():
+        datas = [p.data for p in points]
+
+        if all(isinstance(data, dict) for data in datas):
+            data = merge_data(datas)
+        else:
+            data = datas[-1]
+
+        rollups.append(models.TelemetryPoint(
+            source=source,
+            device=device,
+            time=hour,
+            resolution='hour',
+            count=sum(p.count for p in points),
+            data=data,
+        ))
+
+    with transaction.atomic():
+        models.TelemetryPoint.objects.bulk_create(rollups, batch_size=SAVE_BATCH_SIZE)
+        raw.delete()
+
+    return len(rollups)
+
+def get_points(source, start, end, device=None):
+    points = models.TelemetryPoint.objects.filter(
+        source=source,
+        time__gte=to_datetime(start),
+        time__lt=to_datetime(end),
+    )
+
+    if device:
+        points = points.filter(device=device)
+
+    # newest points win when the range is too big
+    points = points.order_by('-time')[:QUERY_LIMIT]
+
+    return [
+        dict(
+            time=p.time.timestamp(),
+            device=p.device,
+            resolution=p.resolution,
+            count=p.count,
+            data=p.data,
+        ) for p in list(points)[::-1]
+    ]
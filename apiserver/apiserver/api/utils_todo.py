@@ -2,7 +2,8 @@ import logging
 logger = logging.getLogger(__name__)
 
 import requests
-import json
+import time
+import threading
 
 #breakpoint()
 
@@ -17,6 +18,28 @@ if __name__ == '__main__':
     sys.path.append('../..')
 
 from apiserver import secrets
+from django.conf import settings
+
+PROJECT_ID_TTL = 60*60*24
+TASKS_TTL = 60*60*24
+
+# keep-alive connections to Vikunja, the stats collectors call in from
+# several threads and Sessions aren't thread-safe so each gets its own
+session_local = threading.local()
+
+# used when running standalone without Django's cache
+local_cache = {}
+
+
+class NotFound(Exception):
+    pass
+
+
+def get_session():
+    if not hasattr(session_local, 'session'):
+        session_local.session = requests.Session()
+
+    return session_local.session
 
 
 def is_configured():
@@ -29,10 +52,12 @@ def api_put_task(project_id, position, title):
     url = secrets.TODO_API_URL + 'projects/{}/tasks'.format(project_id)
 
     try:
-        r = requests.put(url=url, headers=headers, json=data, timeout=20)
+        r = get_session().put(url=url, headers=headers, json=data, timeout=20)
+        if r.status_code == 404:
+            raise NotFound(url)
         r.raise_for_status()
         return r.json()
-    except KeyboardInterrupt:
+    except (KeyboardInterrupt, NotFound):
         raise
     except BaseException as e:
         logger.error('Todo API error {} - {} - {}'.format(url, e.__class__.__name__, str(e)))
@@ -45,7 +70,7 @@ def api_find_projects(project_name):
     params = {'s': project_name}
 
     try:
-        r = requests.get(url=url, headers=headers, timeout=20)
+        r = get_session().get(url=url, headers=headers, params=params, timeout=20)
         r.raise_for_status()
         return r.json()
     except KeyboardInterrupt:
@@ -60,7 +85,7 @@ def api_get_project(project_id):
     url = secrets.TODO_API_URL + 'projects/{}'.format(project_id)
 
     try:
-        r = requests.get(url=url, headers=headers, timeout=20)
+        r = get_session().get(url=url, headers=headers, timeout=20)
         r.raise_for_status()
         return r.json()
     except KeyboardInterrupt:
@@ -75,11 +100,32 @@ def api_get_tasks(project_id, view_id, search='', filter=''):
     params = {'s': search, 'filter': filter}
     url = secrets.TODO_API_URL + 'projects/{}/views/{}/tasks'.format(project_id, view_id)
 
+    # full lists are fetched conditionally so unchanged ones skip the body
+    cache_key = None if search or filter else 'todo_tasks_{}_{}'.format(project_id, view_id)
+    cached = get_cached(cache_key) if cache_key else None
+
+    if cached:
+        if cached['etag']:
+            headers['If-None-Match'] = cached['etag']
+        if cached['last_modified']:
+            headers['If-Modified-Since'] = cached['last_modified']
+
     try:
-        r = requests.get(url=url, headers=headers, params=params, timeout=20)
+        r = get_session().get(url=url, headers=headers, params=params, timeout=20)
+        if r.status_code == 404:
+            raise NotFound(url)
+        if r.status_code == 304 and cached:
+            return cached['tasks']
         r.raise_for_status()
-        return r.json()
-    except KeyboardInterrupt:
+        tasks = r.json()
+
+        etag = r.headers.get('ETag')
+        last_modified = r.headers.get('Last-Modified')
+        if cache_key and (etag or last_modified):
+            set_cached(cache_key, dict(etag=etag, last_modified=last_modified, tasks=tasks), TASKS_TTL)
+
+        return tasks
+    except (KeyboardInterrupt, NotFound):
         raise
     except BaseException as e:
         logger.error('Todo API error {} - {} - {}'.format(url, e.__class__.__name__, str(e)))
@@ -92,7 +138,7 @@ def api_post_position(task_id, view_id, position):
     url = secrets.TODO_API_URL + 'tasks/{}/position'.format(task_id)
 
     try:
-        r = requests.post(url=url, headers=headers, json=data, timeout=20)
+        r = get_session().post(url=url, headers=headers, json=data, timeout=20)
         r.raise_for_status()
         return r.json()
     except KeyboardInterrupt:
@@ -102,52 +148,93 @@ def api_post_position(task_id, view_id, position):
         return None
 
 
-def add_task_or_bump(project_name, title):
-    # adds a task to the beginning of a project
-    # if the task is already exists and is not finished, bumps it to the top
-    # if it's already at the top, does nothing
+def get_cached(key):
+    if settings.configured:
+        from django.core.cache import cache
+        return cache.get(key)
 
-    logging.info('Adding task: %s, project: %s.', title, project_name)
+    value, expires = local_cache.get(key, (None, 0))
+    return value if expires > time.time() else None
+
+
+def set_cached(key, value, timeout):
+    if settings.configured:
+        from django.core.cache import cache
+        cache.set(key, value, timeout)
+    else:
+        local_cache[key] = (value, time.time() + timeout)
 
-    if not is_configured():
-        raise Exception('Vikunja integration not configured.')
 
-    projects = api_find_projects(project_name)
+def find_project(project_name, refresh=False):
+    # returns (project_id, view_id), cached since they rarely change
+
+    ids = None if refresh else get_cached('todo_project_' + project_name)
+    if ids:
+        return ids
+
+    projects = api_find_projects(project_name) or []
 
     for project in projects:
         if project['title'] == project_name:
-            project_id = project['id']
-            view_id = project['views'][0]['id']
+            ids = (project['id'], project['views'][0]['id'])
             break
     else:  # for
         raise Exception('Project not found.')
 
-    all_tasks = api_get_tasks(project_id, view_id)
+    set_cached('todo_project_' + project_name, ids, PROJECT_ID_TTL)
+    return ids
 
-    if len(all_tasks) == 0:
-        logger.info('Task list empty, adding.')
-        api_put_task(project_id, 1024, title)
-        return True
 
-    top_task = all_tasks[0]
-    same_tasks = api_get_tasks(project_id, view_id, search=title, filter='done = false')
+def with_project(project_name, func):
+    # calls func(project_id, view_id), looking the IDs up again if the
+    # cached ones are gone
 
-    if top_task['title'] == title and top_task['done'] == False:
-        logger.info('Task already at the top, returning.')
-        return
+    try:
+        return func(*find_project(project_name))
+    except NotFound:
+        logger.info('Project %s not found, refreshing IDs.', project_name)
+        return func(*find_project(project_name, refresh=True))
 
-    top_position = top_task['position'] / 2.0
 
-    for task in same_tasks:
-        if task['title'] == title:
-            api_post_position(task['id'], view_id, top_position)
-            logger.info('Existing task found, bumping.')
+def add_task_or_bump(project_name, title):
+    # adds a task to the beginning of a project
+    # if the task is already exists and is not finished, bumps it to the top
+    # if it's already at the top, does nothing
+
+    logging.info('Adding task: %s, project: %s.', title, project_name)
+
+    if not is_configured():
+        raise Exception('Vikunja integration not configured.')
+
+    def bump(project_id, view_id):
+        all_tasks = api_get_tasks(project_id, view_id)
+
+        if len(all_tasks) == 0:
+            logger.info('Task list empty, adding.')
+            api_put_task(project_id, 1024, title)
             return True
 
-    logger.info('Existing task not found, adding.')
+        top_task = all_tasks[0]
+        same_tasks = api_get_tasks(project_id, view_id, search=title, filter='done = false')
+
+        if top_task['title'] == title and top_task['done'] == False:
+            logger.info('Task already at the top, returning.')
+            return
 
-    api_put_task(project_id, top_position, title)
-    return True
+        top_position = top_task['position'] / 2.0
+
+        for task in same_tasks:
+            if task['title'] == title:
+                api_post_position(task['id'], view_id, top_position)
+                logger.info('Existing task found, bumping.')
+                return True
+
+        logger.info('Existing task not found, adding.')
+
+        api_put_task(project_id, top_position, title)
+        return True
+
+    return with_project(project_name, bump)
 
 
 def get_task_list(project_name):
@@ -158,19 +245,7 @@ def get_task_list(project_name):
     if not is_configured():
         raise Exception('Vikunja integration not configured.')
 
-    projects = api_find_projects(project_name)
-
-    for project in projects:
-        if project['title'] == project_name:
-            project_id = project['id']
-            view_id = project['views'][0]['id']
-            break
-    else:  # for
-        raise Exception('Project not found.')
-
-    all_tasks = api_get_tasks(project_id, view_id)
-
-    return all_tasks
+    return with_project(project_name, api_get_tasks)
 
 
 
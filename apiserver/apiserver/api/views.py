@@ -5,7 +5,6 @@ from django.contrib.auth.models import User, Group
 from django.shortcuts import get_object_or_404, redirect
 from django.db import transaction
 from django.db.models import Max, F, Count, Q, Sum, Subquery, OuterRef
-from django.db.utils import OperationalError
 from django.utils.crypto import constant_time_compare
 from django.http import HttpResponse, Http404, FileResponse, HttpResponseServerError
 from django.core.files.base import File
@@ -15,12 +14,11 @@ from rest_framework import viewsets, views, mixins, generics, exceptions, status
 from rest_framework.decorators import action, api_view
 from rest_framework.permissions import BasePermission, IsAuthenticated, SAFE_METHODS, IsAuthenticatedOrReadOnly
 from rest_framework.response import Response
+from rest_framework.renderers import JSONRenderer
 from rest_auth.views import PasswordChangeView, PasswordResetView, PasswordResetConfirmView, LoginView
 from rest_auth.registration.views import RegisterView
 from oidc_provider.views import AuthorizeView
 from oidc_provider.models import Client as OIDCClient
-from fuzzywuzzy import fuzz, process
-from collections import OrderedDict
 from dateutil import relativedelta
 from PIL import Image, ImageDraw, ImageFont, ImageOps, JpegImagePlugin
 import icalendar
@@ -31,8 +29,9 @@ import xmltodict
 import json
 import base64
 import binascii
+from collections import Counter
 
-from . import models, serializers, utils, utils_paypal, utils_stats, utils_ldap, utils_email, utils_mediawiki, utils_todo
+from . import models, serializers, utils, utils_db, utils_paypal, utils_stats, utils_telemetry, utils_ldap, utils_email, utils_mediawiki, utils_todo
 from .permissions import (
     is_admin_director,
     AllowMetadata,
@@ -72,41 +71,34 @@ class SearchViewSet(Base, Retrieve):
         else:
             return serializers.SearchSerializer
 
+    def get_results(self, queryset, result_ids):
+        # fetch all hits at once, then put them back in ranked order
+        members = queryset.in_bulk(result_ids)
+
+        try:
+            return [members[x] for x in result_ids]
+        except KeyError as e:
+            raise models.Member.DoesNotExist(
+                f"Member matching query does not exist: {e}\n**** You may need to regenerate search strings with python manage.py run_hourly ****"
+            ) from e
+
     def get_queryset(self):
-        queryset = models.Member.objects.all()
+        queryset = models.Member.objects.select_related(
+            'user',
+            'signup_helper__member',
+        ).prefetch_related(
+            'user__storage',
+        )
         search = self.request.data.get('q', '').lower()
         sort = self.request.data.get('sort', '').lower()
 
-        if not cache.touch('search_strings'):
-            utils.gen_search_strings() # init cache
-
-        search_strings = cache.get('search_strings', {})
-
         if len(search):
-            choices = search_strings.keys()
-
-            # get exact starts with matches
-            results = [x for x in choices if x.startswith(search)]
-            # then get exact substring matches
-            results += [x for x in choices if search in x]
-
-            if len(results) == 0 and len(search) >= 3 and '@' not in search:
-                # then get fuzzy matches, but not for emails
-                fuzzy_results = process.extract(search, choices, limit=20, scorer=fuzz.token_set_ratio)
-                results += [x[0] for x in fuzzy_results]
+            # exact starts with matches, then exact substring matches,
+            # then fuzzy matches
+            search_index = utils.get_search_index()
+            result_ids = search_index.search_ids(search)
 
-            # remove dupes, truncate list
-            results = list(OrderedDict.fromkeys(results))[:20]
-
-            result_ids = [search_strings[x] for x in results]
-            try:
-                result_objects = [queryset.get(id=x) for x in result_ids]
-            except models.Member.DoesNotExist as e:
-                raise models.Member.DoesNotExist(
-                    f"{e}\n**** You may need to regenerate search strings with python manage.py run_hourly ****"
-                ) from e
-
-            queryset = result_objects
+            queryset = self.get_results(queryset, result_ids)
             logging.info('Search for: {}, results: {}'.format(search, len(queryset)))
         elif self.action == 'create':
             if sort == 'recently_vetted':
@@ -938,27 +930,96 @@ class PingView(views.APIView):
         return Response(dict(app_version=settings.APP_VERSION))
 
 
-class DoorViewSet(viewsets.ViewSet, List):
-    def list(self, request):
+class CardListViewSet(viewsets.ViewSet, List):
+    '''
+    Card list that is only rebuilt when last_card_change changes
+
+    Controllers that send back the ETag get a 304 without any DB work, or
+    they can poll changes/ to get only the cards that changed.
+
+    Subclasses set card_list_func, called with the card numbers to limit
+    the list to or None for every card.
+    '''
+    card_list_name = None
+    card_list_func = None
+
+    def gen_card_list(self, card_numbers=None):
+        return self.card_list_func(card_numbers)
+
+    def check_auth(self, request):
         auth_token = request.META.get('HTTP_AUTHORIZATION', '')
         if secrets.DOOR_API_TOKEN and not constant_time_compare(auth_token, 'Bearer ' + secrets.DOOR_API_TOKEN):
             raise exceptions.PermissionDenied()
 
-        cards = models.Card.objects.filter(active_status='card_active').select_related('user__member')
-        active_member_cards = {}
+    def get_card_list(self, version):
+        cache_key = '{}_cards'.format(self.card_list_name)
+        cached = cache.get(cache_key)
 
-        for card in cards:
-            member = card.user.member
-            if member.paused_date: continue
-            if not member.vetted_date: continue
-            if not member.is_allowed_entry: continue
+        if cached and cached['version'] == version:
+            return cached['cards']
 
-            active_member_cards[card.card_number] = '{} ({})'.format(
-                member.preferred_name + ' ' + member.last_name[0],
-                member.id,
-            )
+        card_list = self.gen_card_list()
+        cache.set(cache_key, dict(version=version, cards=card_list))
+        return card_list
+
+    def list(self, request):
+        self.check_auth(request)
+
+        version = utils_stats.get_last_card_change()
+        etag = '"{}-{}"'.format(self.card_list_name, version)
+        headers = {'ETag': etag}
+
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH', '')
+        if etag in [x.strip() for x in if_none_match.split(',')]:
+            return Response(status=drfstatus.HTTP_304_NOT_MODIFIED, headers=headers)
+
+        return Response(self.get_card_list(version), headers=headers)
+
+    @action(detail=False, methods=['get'])
+    def changes(self, request):
+        self.check_auth(request)
+
+        history_version = utils.get_card_history_version()
+        since = request.query_params.get('since', '')
+
+        if since == history_version:
+            return Response(dict(version=history_version, full=False, changed={}, revoked=[]))
+
+        card_numbers = utils.get_changed_card_numbers(since, history_version)
+
+        if card_numbers is None:
+            card_list = self.get_card_list(utils_stats.get_last_card_change())
+            return Response(dict(version=history_version, full=True, cards=card_list))
+
+        changed = self.gen_card_list(card_numbers) if card_numbers else {}
+        revoked = sorted(card_numbers - changed.keys())
+
+        return Response(dict(version=history_version, full=False, changed=changed, revoked=revoked))
 
-        return Response(active_member_cards)
+
+def gen_door_list(card_numbers=None):
+    cards = models.Card.objects.filter(active_status='card_active').select_related('user__member')
+    if card_numbers is not None:
+        cards = cards.filter(card_number__in=card_numbers)
+
+    active_member_cards = {}
+
+    for card in cards:
+        member = card.user.member
+        if member.paused_date: continue
+        if not member.vetted_date: continue
+        if not member.is_allowed_entry: continue
+
+        active_member_cards[card.card_number] = '{} ({})'.format(
+            member.preferred_name + ' ' + member.last_name[0],
+            member.id,
+        )
+
+    return active_member_cards
+
+class DoorViewSet(CardListViewSet):
+    card_list_name = 'door'
+    card_list_func = staticmethod(gen_door_list)
 
     @action(detail=True, methods=['post'])
     def seen(self, request, pk=None):
@@ -966,9 +1027,10 @@ class DoorViewSet(viewsets.ViewSet, List):
         if secrets.DOOR_API_TOKEN and not constant_time_compare(auth_token, 'Bearer ' + secrets.DOOR_API_TOKEN):
             raise exceptions.PermissionDenied()
 
-        card = get_object_or_404(models.Card, card_number=pk)
-        card.last_seen = now()
-        card.save()
+        card = get_object_or_404(models.Card.objects.select_related('user__member'), card_number=pk)
+
+        # skip save() so scans don't create history records
+        models.Card.objects.filter(id=card.id).update(last_seen=now())
 
         member = card.user.member
         t = utils.now_local_tz().strftime('%Y-%m-%d %H:%M:%S, %a %I:%M %p')
@@ -979,46 +1041,68 @@ class DoorViewSet(viewsets.ViewSet, List):
             member_id=member.id,
             first_name=member.preferred_name,
         )
-        cache.set('last_scan', last_scan)
+        utils_stats.set_stat('last_scan', last_scan)
 
-        utils_stats.calc_card_scans()
+        utils_stats.count_card_scan(card.id, member.id)
 
         utils.mqtt_publish('spaceport/door/scan', json.dumps(last_scan))
 
         return Response(200)
 
 
-class LockoutViewSet(viewsets.ViewSet, List):
-    def list(self, request):
-        auth_token = request.META.get('HTTP_AUTHORIZATION', '')
-        if secrets.DOOR_API_TOKEN and not constant_time_compare(auth_token, 'Bearer ' + secrets.DOOR_API_TOKEN):
-            raise exceptions.PermissionDenied()
+# lockout tool name, Member cert field
+LOCKOUT_CERTS = [
+    ('lathe', 'lathe_cert_date'),
+    ('mill', 'mill_cert_date'),
+    ('wood', 'wood_cert_date'),
+    ('wood2', 'wood2_cert_date'),
+    ('cnc', 'tormach_cnc_cert_date'),
+    ('tormach_cnc', 'tormach_cnc_cert_date'),
+    ('precix_cnc', 'precix_cnc_cert_date'),
+    ('embroidery', 'embroidery_cert_date'),
+    ('scanner', 'scanner_cert_date'),
+]
+
+def gen_lockout_list(card_numbers=None):
+    cards = models.Card.objects.filter(
+        active_status='card_active',
+        user__member__paused_date__isnull=True,
+        user__member__is_allowed_entry=True,
+    )
+    if card_numbers is not None:
+        cards = cards.filter(card_number__in=card_numbers)
+
+    cert_fields = sorted(set(field for _, field in LOCKOUT_CERTS))
+    rows = cards.values(
+        'card_number',
+        'user__member__id',
+        'user__member__preferred_name',
+        'user__member__last_name',
+        'user__member__orientation_date',
+        'user__member__vetted_date',
+        *['user__member__' + field for field in cert_fields],
+    )
+
+    active_member_cards = {}
 
-        cards = models.Card.objects.filter(active_status='card_active')
-        active_member_cards = {}
+    for row in rows:
+        common = bool(row['user__member__orientation_date'] or row['user__member__vetted_date'])
 
-        for card in cards:
-            member = card.user.member
-            if member.paused_date: continue
-            if not member.is_allowed_entry: continue
+        authorization = {}
+        authorization['id'] = row['user__member__id']
+        authorization['name'] = row['user__member__preferred_name'] + ' ' + row['user__member__last_name']
+        authorization['common'] = common
 
-            authorization = {}
-            authorization['id'] = member.id
-            authorization['name'] = member.preferred_name + ' ' + member.last_name
-            authorization['common'] = bool(member.orientation_date or member.vetted_date)
-            authorization['lathe'] = bool(member.lathe_cert_date) and authorization['common']
-            authorization['mill'] = bool(member.mill_cert_date) and authorization['common']
-            authorization['wood'] = bool(member.wood_cert_date) and authorization['common']
-            authorization['wood2'] = bool(member.wood2_cert_date) and authorization['common']
-            authorization['cnc'] = bool(member.tormach_cnc_cert_date) and authorization['common']
-            authorization['tormach_cnc'] = bool(member.tormach_cnc_cert_date) and authorization['common']
-            authorization['precix_cnc'] = bool(member.precix_cnc_cert_date) and authorization['common']
-            authorization['embroidery'] = bool(member.embroidery_cert_date) and authorization['common']
-            authorization['scanner'] = bool(member.scanner_cert_date) and authorization['common']
+        for tool, field in LOCKOUT_CERTS:
+            authorization[tool] = bool(row['user__member__' + field]) and common
 
-            active_member_cards[card.card_number] = authorization
+        active_member_cards[row['card_number']] = authorization
 
-        return Response(active_member_cards)
+    return active_member_cards
+
+class LockoutViewSet(CardListViewSet):
+    card_list_name = 'lockout'
+    card_list_func = staticmethod(gen_lockout_list)
 
 
 class IpnView(views.APIView):
@@ -1033,22 +1117,38 @@ class IpnView(views.APIView):
 
 
 class StatsViewSet(viewsets.ViewSet, List):
+    def gen_stats(self, tier, at_protospace):
+        stats = utils_stats.get_stats(tier)
+        stats['at_protospace'] = at_protospace
+        return JSONRenderer().render(stats)
+
     def list(self, request):
-        stats_keys = utils_stats.DEFAULTS.keys()
-        cached_stats = cache.get_many(stats_keys)
-        stats = utils_stats.DEFAULTS.copy()
-        stats.update(cached_stats)
+        # responses are cached as JSON per tier until a stat changes
+        tier = utils_stats.get_tier(self.request.user)
+        at_protospace = utils.is_request_from_protospace(request)
+        blob_key = 'stats_blob_{}_{}'.format(tier, 'inside' if at_protospace else 'outside')
 
-        user = self.request.user
-        if not user.is_authenticated:
-            stats.pop('alarm', None)
-            stats.pop('autoscan', None)
-        elif not is_admin_director(user):
-            stats.pop('autoscan', None)
+        version = utils_stats.get_stats_version(tier)
+        etag = '"{}-{}"'.format(blob_key, version)
+
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH', '')
+        if version and etag in [x.strip() for x in if_none_match.split(',')]:
+            response = HttpResponse(status=drfstatus.HTTP_304_NOT_MODIFIED)
+            response['ETag'] = etag
+            return response
 
-        stats['at_protospace'] = utils.is_request_from_protospace(request)
+        blob = cache.get(blob_key)
 
-        return Response(stats)
+        if blob and version and blob['version'] == version:
+            body = blob['body']
+        else:
+            body = self.gen_stats(tier, at_protospace)
+            cache.set(blob_key, dict(version=version, body=body))
+
+        response = HttpResponse(body, content_type='application/json')
+        if version:
+            response['ETag'] = etag
+        return response
 
     @action(detail=False, methods=['get'])
     def extras(self, request):
@@ -1076,10 +1176,10 @@ class StatsViewSet(viewsets.ViewSet, List):
             sign = sign.replace('…', '...')
 
             if sign.startswith('https://') or sign.startswith('http://'):
-                cache.set('link', sign)
+                utils_stats.set_stat('link', sign)
             else:
-                cache.set('sign', sign)
-                cache.set('vestaboard', sign)
+                utils_stats.set_stat('sign', sign)
+                utils_stats.set_stat('vestaboard', sign)
 
             return Response(200)
         except KeyError:
@@ -1094,7 +1194,7 @@ class StatsViewSet(viewsets.ViewSet, List):
             data = data.replace('“', '"').replace('”', '"')
             data = data.replace('…', '...')
 
-            cache.set('vestaboard', data)
+            utils_stats.set_stat('vestaboard', data)
 
             return Response(200)
         except KeyError:
@@ -1140,7 +1240,7 @@ class StatsViewSet(viewsets.ViewSet, List):
         if state:
             logging.info('Setting alarm status to: %s', state)
             alarm = dict(time=time.time(), data=state)
-            cache.set('alarm', alarm)
+            utils_stats.set_stat('alarm', alarm)
 
         return Response(200)
 
@@ -1152,18 +1252,15 @@ class StatsViewSet(viewsets.ViewSet, List):
         if 'username' not in request.data:
             raise exceptions.ValidationError(dict(username='This field is required.'))
 
-        track = cache.get('track', {})
-
         devicename = request.data['name']
         username = request.data['username'].lower()
         first_name = username.split('.')[0].title()
 
-        track[devicename] = dict(
+        utils_stats.set_device_stat('track', devicename, dict(
             time=time.time(),
             username=username,
             first_name=first_name,
-        )
-        cache.set('track', track)
+        ))
 
         return Response(200)
 
@@ -1172,7 +1269,7 @@ class StatsViewSet(viewsets.ViewSet, List):
         if 'autoscan' not in request.data:
             raise exceptions.ValidationError(dict(autoscan='This field is required.'))
 
-        cache.set('autoscan', request.data['autoscan'])
+        utils_stats.set_stat('autoscan', request.data['autoscan'])
         return Response(200)
 
     @action(detail=False, methods=['post'])
@@ -1189,28 +1286,24 @@ class StatsViewSet(viewsets.ViewSet, List):
 
     @action(detail=True, methods=['post'])
     def printer3d(self, request, pk=None):
-        printer3d = cache.get('printer3d', {})
         devicename = pk
 
         if devicename.startswith('ord'):
             status = request.data['result']['status']
-            printer3d[devicename] = dict(
+            utils_stats.set_device_stat('printer3d', devicename, dict(
                 progress=int(status['display_status']['progress'] * 100),
                 #filename=status['print_stats']['filename'],
                 state=status['idle_timeout']['state'],
-            )
+            ))
         elif devicename.startswith('p1s'):
-            printer3d[devicename] = request.data
+            utils_stats.set_device_stat('printer3d', devicename, request.data)
         elif devicename == 'prusa_xl':
-            printer3d[devicename] = request.data
-
-        cache.set('printer3d', printer3d)
+            utils_stats.set_device_stat('printer3d', devicename, request.data)
 
         return Response(200)
 
     @action(detail=True, methods=['post'])
     def scanner3d(self, request, pk=None):
-        scanner3d = cache.get('scanner3d', {})
         devicename = pk
 
         if devicename.startswith('raptorx1'):
@@ -1232,21 +1325,17 @@ class StatsViewSet(viewsets.ViewSet, List):
                 'IN_USE': 'In Use',
             }
 
-            scanner3d[devicename] = dict(
+            utils_stats.set_device_stat('scanner3d', devicename, dict(
                 time=time.time(),
                 username=username,
                 first_name=first_name,
                 status=STATUSES[status],
-            )
-
-        cache.set('scanner3d', scanner3d)
+            ))
 
         return Response(200)
 
     @action(detail=False, methods=['post'])
     def solar_data(self, request):
-        solar = cache.get('solar', {})
-
         if 'user' not in request.data:
             raise exceptions.ValidationError(dict(user='This field is required.'))
 
@@ -1256,20 +1345,33 @@ class StatsViewSet(viewsets.ViewSet, List):
         user = request.data['user']
         power = request.data['power']
 
-        if 'users' not in solar:
-            solar['users'] = {}
+        # total is summed when stats are read
+        utils_stats.set_device_stat('solar', user, dict(power=int(power), time=time.time()))
 
-        solar['users'][user] = dict(power=int(power), time=time.time())
+        return Response(200)
 
-        total = 0
-        for solar_user in solar['users'].values():
-            if time.time() - solar_user['time'] < 1800:
-                total += solar_user['power']
-        solar['total'] = total
+    @action(detail=False, methods=['get'])
+    def telemetry(self, request):
+        source = request.query_params.get('source', '')
+        if source not in utils_stats.DEVICE_STATS + ['balloon']:
+            raise exceptions.ValidationError(dict(source='Invalid source.'))
 
-        cache.set('solar', solar)
+        # who was on which computer is for members only
+        if source == 'track' and not request.user.is_authenticated:
+            raise exceptions.PermissionDenied()
 
-        return Response(200)
+        try:
+            end = float(request.query_params.get('end', time.time()))
+            start = float(request.query_params.get('start', end - 86400))
+        except ValueError:
+            raise exceptions.ValidationError(dict(non_field_errors='Start and end must be timestamps.'))
+
+        # also catches nan and inf
+        if not (0 <= start <= utils_telemetry.MAX_TIMESTAMP and 0 <= end <= utils_telemetry.MAX_TIMESTAMP):
+            raise exceptions.ValidationError(dict(non_field_errors='Start and end out of range.'))
+
+        device = request.query_params.get('device', None)
+        return Response(utils_telemetry.get_points(source, start, end, device))
 
     @action(detail=False, methods=['get', 'post'])
     def balloon_data(self, request):
@@ -1281,7 +1383,8 @@ class StatsViewSet(viewsets.ViewSet, List):
                 try:
                     protoballoon = dict(last={})
                     protoballoon['last'] = data['positions'][0]
-                    cache.set('protoballoon', protoballoon)
+                    utils_stats.set_stat('protoballoon', protoballoon)
+                    utils_telemetry.record('balloon', 'protoballoon', protoballoon['last'])
                 except:
                     pass
 
@@ -1515,201 +1618,195 @@ class InterestViewSet(Base, Retrieve, Create):
 
 class ProtocoinViewSet(Base):
     @action(detail=False, methods=['post'], permission_classes=[AllowMetadata | IsAuthenticated])
+    @utils_db.atomic_retry
     def spend_request(self, request):
-        try:
-            with transaction.atomic():
-                source_user = self.request.user
-                source_member = source_user.member
+        source_user = self.request.user
+        source_member = source_user.member
 
-                training = None
+        training = None
 
-                try:
-                    balance = float(request.data['balance'])
-                except KeyError:
-                    raise exceptions.ValidationError(dict(balance='This field is required.'))
-                except ValueError:
-                    raise exceptions.ValidationError(dict(balance='Invalid number.'))
+        try:
+            balance = float(request.data['balance'])
+        except KeyError:
+            raise exceptions.ValidationError(dict(balance='This field is required.'))
+        except ValueError:
+            raise exceptions.ValidationError(dict(balance='Invalid number.'))
 
-                try:
-                    amount = float(request.data['amount'])
-                except KeyError:
-                    raise exceptions.ValidationError(dict(amount='This field is required.'))
-                except ValueError:
-                    raise exceptions.ValidationError(dict(amount='Invalid number.'))
+        try:
+            amount = float(request.data['amount'])
+        except KeyError:
+            raise exceptions.ValidationError(dict(amount='This field is required.'))
+        except ValueError:
+            raise exceptions.ValidationError(dict(amount='Invalid number.'))
 
-                try:
-                    category = str(request.data['category'])
-                except KeyError:
-                    raise exceptions.ValidationError(dict(category='This field is required.'))
-                if category not in ['Consumables', 'Donation', 'OnAcct']:
-                    raise exceptions.ValidationError(dict(category='Invalid category.'))
+        try:
+            category = str(request.data['category'])
+        except KeyError:
+            raise exceptions.ValidationError(dict(category='This field is required.'))
+        if category not in ['Consumables', 'Donation', 'OnAcct']:
+            raise exceptions.ValidationError(dict(category='Invalid category.'))
 
-                if category == 'OnAcct':
-                    try:
-                        training_id = int(request.data['training'])
-                    except KeyError:
-                        raise exceptions.ValidationError(dict(training='This field is required.'))
-                    except ValueError:
-                        raise exceptions.ValidationError(dict(training='Invalid number.'))
+        if category == 'OnAcct':
+            try:
+                training_id = int(request.data['training'])
+            except KeyError:
+                raise exceptions.ValidationError(dict(training='This field is required.'))
+            except ValueError:
+                raise exceptions.ValidationError(dict(training='Invalid number.'))
 
-                    training = get_object_or_404(models.Training, id=training_id)
+            training = get_object_or_404(models.Training, id=training_id)
 
-                    if not training.session:
-                        raise exceptions.ValidationError(dict(training='Invalid session.'))
+            if not training.session:
+                raise exceptions.ValidationError(dict(training='Invalid session.'))
 
-                    if training.session.is_cancelled:
-                        raise exceptions.ValidationError(dict(training='Class is cancelled.'))
+            if training.session.is_cancelled:
+                raise exceptions.ValidationError(dict(training='Class is cancelled.'))
 
-                    if training.paid_date:
-                        raise exceptions.ValidationError(dict(training='Already paid.'))
+            if training.paid_date:
+                raise exceptions.ValidationError(dict(training='Already paid.'))
 
-                    if training.session.cost != amount:
-                        msg = 'Protocoin training payment amount mismatch:\n' + str(request.data.dict())
-                        utils.alert_tanner(msg)
-                        raise exceptions.ValidationError(dict(training='Class cost doesn\'t match amount.'))
+            if training.session.cost != amount:
+                msg = 'Protocoin training payment amount mismatch:\n' + str(request.data.dict())
+                utils.alert_tanner(msg)
+                raise exceptions.ValidationError(dict(training='Class cost doesn\'t match amount.'))
 
-                memo = str(request.data.get('memo', ''))
+        memo = str(request.data.get('memo', ''))
 
-                # also prevents negative spending
-                if amount < 0.05:
-                    raise exceptions.ValidationError(dict(amount='Amount too small.'))
+        # also prevents negative spending
+        if amount < 0.05:
+            raise exceptions.ValidationError(dict(amount='Amount too small.'))
 
-                source_user_balance = source_user.transactions.aggregate(Sum('protocoin'))['protocoin__sum'] or 0
-                source_user_balance = float(source_user_balance)
+        source_user_balance = utils.get_protocoin_balance(source_user)
+        source_user_balance = float(source_user_balance)
 
-                if abs(source_user_balance - balance) > 0.01:  # stupid https://docs.djangoproject.com/en/4.2/ref/databases/#decimal-handling
-                    raise exceptions.ValidationError(dict(balance='Incorrect current balance. Try refreshing the page.'))
+        if abs(source_user_balance - balance) > 0.01:  # stupid https://docs.djangoproject.com/en/4.2/ref/databases/#decimal-handling
+            raise exceptions.ValidationError(dict(balance='Incorrect current balance. Try refreshing the page.'))
 
-                if source_user_balance < amount:
-                    raise exceptions.ValidationError(dict(amount='Insufficient funds.'))
+        if source_user_balance < amount:
+            raise exceptions.ValidationError(dict(amount='Insufficient funds.'))
 
-                if training:
-                    tx_memo = 'Protocoin - Transaction spent ₱ {} on {}, session: {}, training: {}'.format(
-                        amount,
-                        training.session.course.name,
-                        str(training.session.id),
-                        str(training.id),
-                    )
-                else:
-                    tx_memo = 'Protocoin - Transaction spent ₱ {} on {}{}'.format(
-                        amount,
-                        category,
-                        ', memo: ' + memo if memo else ''
-                    )
+        if training:
+            tx_memo = 'Protocoin - Transaction spent ₱ {} on {}, session: {}, training: {}'.format(
+                amount,
+                training.session.course.name,
+                str(training.session.id),
+                str(training.id),
+            )
+        else:
+            tx_memo = 'Protocoin - Transaction spent ₱ {} on {}{}'.format(
+                amount,
+                category,
+                ', memo: ' + memo if memo else ''
+            )
 
-                tx = models.Transaction.objects.create(
-                    user=source_user,
-                    protocoin=-amount,
-                    amount=0,
-                    number_of_membership_months=0,
-                    account_type='Protocoin',
-                    category=category,
-                    info_source='System',
-                    memo=tx_memo,
-                )
-                utils.log_transaction(tx)
+        tx = models.Transaction.objects.create(
+            user=source_user,
+            protocoin=-amount,
+            amount=0,
+            number_of_membership_months=0,
+            account_type='Protocoin',
+            category=category,
+            info_source='System',
+            memo=tx_memo,
+        )
+        utils.log_transaction(tx)
 
-                if training:
-                    if training.attendance_status == 'Waiting for payment':
-                        training.attendance_status = 'Confirmed'
-                    training.paid_date = utils.today_local_tz()
-                    training.save()
+        if training:
+            if training.attendance_status == 'Waiting for payment':
+                training.attendance_status = 'Confirmed'
+            training.paid_date = utils.today_local_tz()
+            training.save()
 
-                return Response(200)
-        except OperationalError:
-            self.spend_request(request)
+        return Response(200)
 
     @action(detail=False, methods=['post'], permission_classes=[AllowMetadata | IsAuthenticated])
+    @utils_db.atomic_retry
     def send_to_member(self, request):
+        source_user = self.request.user
+        source_member = source_user.member
+
         try:
-            with transaction.atomic():
-                source_user = self.request.user
-                source_member = source_user.member
+            member_id = int(request.data['member_id'])
+        except KeyError:
+            raise exceptions.ValidationError(dict(member_id='This field is required.'))
+        except ValueError:
+            raise exceptions.ValidationError(dict(member_id='Invalid number.'))
 
-                try:
-                    member_id = int(request.data['member_id'])
-                except KeyError:
-                    raise exceptions.ValidationError(dict(member_id='This field is required.'))
-                except ValueError:
-                    raise exceptions.ValidationError(dict(member_id='Invalid number.'))
+        try:
+            balance = float(request.data['balance'])
+        except KeyError:
+            raise exceptions.ValidationError(dict(balance='This field is required.'))
+        except ValueError:
+            raise exceptions.ValidationError(dict(balance='Invalid number.'))
 
-                try:
-                    balance = float(request.data['balance'])
-                except KeyError:
-                    raise exceptions.ValidationError(dict(balance='This field is required.'))
-                except ValueError:
-                    raise exceptions.ValidationError(dict(balance='Invalid number.'))
+        try:
+            amount = float(request.data['amount'])
+        except KeyError:
+            raise exceptions.ValidationError(dict(amount='This field is required.'))
+        except ValueError:
+            raise exceptions.ValidationError(dict(amount='Invalid number.'))
 
-                try:
-                    amount = float(request.data['amount'])
-                except KeyError:
-                    raise exceptions.ValidationError(dict(amount='This field is required.'))
-                except ValueError:
-                    raise exceptions.ValidationError(dict(amount='Invalid number.'))
+        user_memo = request.data.get('memo', '')
 
-                user_memo = request.data.get('memo', '')
+        # also prevents negative spending
+        if amount < 1.00:
+            raise exceptions.ValidationError(dict(amount='Amount too small.'))
 
-                # also prevents negative spending
-                if amount < 1.00:
-                    raise exceptions.ValidationError(dict(amount='Amount too small.'))
 
+        if member_id == source_member.id:
+            raise exceptions.ValidationError(dict(member_id='Unable to send to self.'))
 
-                if member_id == source_member.id:
-                    raise exceptions.ValidationError(dict(member_id='Unable to send to self.'))
+        destination_member = get_object_or_404(models.Member, id=member_id)
+        destination_user = destination_member.user
 
-                destination_member = get_object_or_404(models.Member, id=member_id)
-                destination_user = destination_member.user
+        source_user_balance = utils.get_protocoin_balance(source_user)
+        source_user_balance = float(source_user_balance)
 
-                source_user_balance = source_user.transactions.aggregate(Sum('protocoin'))['protocoin__sum'] or 0
-                source_user_balance = float(source_user_balance)
+        if abs(source_user_balance - balance) > 0.01:  # stupid https://docs.djangoproject.com/en/4.2/ref/databases/#decimal-handling
+            raise exceptions.ValidationError(dict(balance='Incorrect current balance. Try refreshing the page.'))
 
-                if abs(source_user_balance - balance) > 0.01:  # stupid https://docs.djangoproject.com/en/4.2/ref/databases/#decimal-handling
-                    raise exceptions.ValidationError(dict(balance='Incorrect current balance. Try refreshing the page.'))
+        if source_user_balance < amount:
+            raise exceptions.ValidationError(dict(amount='Insufficient funds.'))
 
-                if source_user_balance < amount:
-                    raise exceptions.ValidationError(dict(amount='Insufficient funds.'))
+        source_delta = -amount
+        destination_delta = amount
 
-                source_delta = -amount
-                destination_delta = amount
+        memo = 'Protocoin - Transaction {} ({}) sent ₱ {} to {} ({})'.format(
+            source_member.preferred_name + ' ' + source_member.last_name,
+            source_member.id,
+            amount,
+            destination_member.preferred_name + ' ' + destination_member.last_name,
+            destination_member.id,
+        )
 
-                memo = 'Protocoin - Transaction {} ({}) sent ₱ {} to {} ({})'.format(
-                    source_member.preferred_name + ' ' + source_member.last_name,
-                    source_member.id,
-                    amount,
-                    destination_member.preferred_name + ' ' + destination_member.last_name,
-                    destination_member.id,
-                )
+        if user_memo:
+            memo += ', memo: ' + user_memo
+
+        tx = models.Transaction.objects.create(
+            user=source_user,
+            protocoin=source_delta,
+            amount=0,
+            number_of_membership_months=0,
+            account_type='Protocoin',
+            category='Other',
+            info_source='System',
+            memo=memo,
+        )
+        utils.log_transaction(tx)
 
-                if user_memo:
-                    memo += ', memo: ' + user_memo
-
-                tx = models.Transaction.objects.create(
-                    user=source_user,
-                    protocoin=source_delta,
-                    amount=0,
-                    number_of_membership_months=0,
-                    account_type='Protocoin',
-                    category='Other',
-                    info_source='System',
-                    memo=memo,
-                )
-                utils.log_transaction(tx)
-
-                tx = models.Transaction.objects.create(
-                    user=destination_user,
-                    protocoin=destination_delta,
-                    amount=0,
-                    number_of_membership_months=0,
-                    account_type='Protocoin',
-                    category='Other',
-                    info_source='System',
-                    memo=memo,
-                )
-                utils.log_transaction(tx)
+        tx = models.Transaction.objects.create(
+            user=destination_user,
+            protocoin=destination_delta,
+            amount=0,
+            number_of_membership_months=0,
+            account_type='Protocoin',
+            category='Other',
+            info_source='System',
+            memo=memo,
+        )
+        utils.log_transaction(tx)
 
-                return Response(200)
-        except OperationalError:
-            self.send_to_member(request)
+        return Response(200)
 
     def get_sessions_teaching(self, user):
         two_hours_ago = now() - datetime.timedelta(hours=2)
@@ -1749,7 +1846,7 @@ class ProtocoinViewSet(Base):
                 first_name='INSTRUCTOR FREE'
             )
         else:
-            user_balance = source_user.transactions.aggregate(Sum('protocoin'))['protocoin__sum'] or 0
+            user_balance = utils.get_protocoin_balance(source_user)
             user_balance = float(user_balance)
 
             res = dict(
@@ -1765,8 +1862,7 @@ class ProtocoinViewSet(Base):
         #if secrets.VEND_API_TOKEN and auth_token != 'Bearer ' + secrets.VEND_API_TOKEN:
         #    raise exceptions.PermissionDenied()
 
-        track = cache.get('track', {})
-        track_graphics_computer = track.get('ARTEMUS', None)
+        track_graphics_computer = utils_stats.get_device_stat('track', 'ARTEMUS')
 
         if not track_graphics_computer:
             return Response(200)
@@ -1782,7 +1878,7 @@ class ProtocoinViewSet(Base):
         if time.time() - track_time > 10:
             return Response(200)
 
-        user_balance = source_user.transactions.aggregate(Sum('protocoin'))['protocoin__sum'] or 0
+        user_balance = utils.get_protocoin_balance(source_user)
         user_balance = float(user_balance)
 
         res = dict(
@@ -1792,102 +1888,101 @@ class ProtocoinViewSet(Base):
         return Response(res)
 
     @action(detail=True, methods=['post'])
+    @utils_db.atomic_retry
     def card_vend_request(self, request, pk=None):
+        auth_token = request.META.get('HTTP_AUTHORIZATION', '')
+        if secrets.VEND_API_TOKEN and not constant_time_compare(auth_token, 'Bearer ' + secrets.VEND_API_TOKEN):
+            raise exceptions.PermissionDenied()
+
+        source_card = get_object_or_404(models.Card, card_number=pk)
+        source_user = source_card.user
+
+        machine = request.data.get('machine', 'unknown')
+
         try:
-            with transaction.atomic():
-                auth_token = request.META.get('HTTP_AUTHORIZATION', '')
-                if secrets.VEND_API_TOKEN and not constant_time_compare(auth_token, 'Bearer ' + secrets.VEND_API_TOKEN):
-                    raise exceptions.PermissionDenied()
+            number = request.data['number']
+        except KeyError:
+            raise exceptions.ValidationError(dict(number='This field is required.'))
 
-                source_card = get_object_or_404(models.Card, card_number=pk)
-                source_user = source_card.user
+        try:
+            balance = float(request.data['balance'])
+        except KeyError:
+            raise exceptions.ValidationError(dict(balance='This field is required.'))
+        except ValueError:
+            raise exceptions.ValidationError(dict(balance='Invalid number.'))
 
-                machine = request.data.get('machine', 'unknown')
+        try:
+            amount = float(request.data['amount'])
+        except KeyError:
+            raise exceptions.ValidationError(dict(amount='This field is required.'))
+        except ValueError:
+            raise exceptions.ValidationError(dict(amount='Invalid number.'))
 
-                try:
-                    number = request.data['number']
-                except KeyError:
-                    raise exceptions.ValidationError(dict(number='This field is required.'))
+        # also prevents negative spending
+        if amount < 0.05:
+            raise exceptions.ValidationError(dict(amount='Amount too small.'))
 
-                try:
-                    balance = float(request.data['balance'])
-                except KeyError:
-                    raise exceptions.ValidationError(dict(balance='This field is required.'))
-                except ValueError:
-                    raise exceptions.ValidationError(dict(balance='Invalid number.'))
 
-                try:
-                    amount = float(request.data['amount'])
-                except KeyError:
-                    raise exceptions.ValidationError(dict(amount='This field is required.'))
-                except ValueError:
-                    raise exceptions.ValidationError(dict(amount='Invalid number.'))
-
-                # also prevents negative spending
-                if amount < 0.05:
-                    raise exceptions.ValidationError(dict(amount='Amount too small.'))
-
-
-                # check for instructor teaching comp
-                sessions_teaching = self.get_sessions_teaching(source_user)
-
-                if sessions_teaching:
-                    session = sessions_teaching.first()
-                    creation = session.history.earliest().history_date
-                    age = (now() - creation).days
-                    msg = 'Instructor {} comp vend, machine: {}, amount: {}, number: {}, course: {}, students: {}, created: {} days ago, class:\nhttps://my.protospace.ca/classes/{}'.format(
-                        str(source_user),
-                        machine,
-                        amount,
-                        number,
-                        session.course.name,
-                        session.students.count(),
-                        age,
-                        session.id,
-                    )
-                    utils.alert_tanner(msg)
-                    logging.info(msg)
+        # check for instructor teaching comp
+        sessions_teaching = self.get_sessions_teaching(source_user)
 
-                    return Response(200)
+        if sessions_teaching:
+            session = sessions_teaching.first()
+            creation = session.history.earliest().history_date
+            age = (now() - creation).days
+            msg = 'Instructor {} comp vend, machine: {}, amount: {}, number: {}, course: {}, students: {}, created: {} days ago, class:\nhttps://my.protospace.ca/classes/{}'.format(
+                str(source_user),
+                machine,
+                amount,
+                number,
+                session.course.name,
+                session.students.count(),
+                age,
+                session.id,
+            )
+            transaction.on_commit(lambda: utils.alert_tanner(msg))
+            logging.info(msg)
 
+            return Response(200)
 
-                source_user_balance = source_user.transactions.aggregate(Sum('protocoin'))['protocoin__sum'] or 0
-                source_user_balance = float(source_user_balance)
 
-                if abs(source_user_balance - balance) > 0.01:  # stupid https://docs.djangoproject.com/en/4.2/ref/databases/#decimal-handling
-                    raise exceptions.ValidationError(dict(balance='Incorrect current balance. Try refreshing the page.'))
+        source_user_balance = utils.get_protocoin_balance(source_user)
+        source_user_balance = float(source_user_balance)
 
-                if source_user_balance < amount:
-                    raise exceptions.ValidationError(dict(amount='Insufficient funds.'))
+        if abs(source_user_balance - balance) > 0.01:  # stupid https://docs.djangoproject.com/en/4.2/ref/databases/#decimal-handling
+            raise exceptions.ValidationError(dict(balance='Incorrect current balance. Try refreshing the page.'))
 
-                source_delta = -amount
+        if source_user_balance < amount:
+            raise exceptions.ValidationError(dict(amount='Insufficient funds.'))
 
-                memo = 'Protocoin - Purchase spent ₱ {} on {} vending machine item #{}'.format(
-                    amount,
-                    machine,
-                    number,
-                )
+        source_delta = -amount
 
-                tx = models.Transaction.objects.create(
-                    user=source_user,
-                    protocoin=source_delta,
-                    amount=0,
-                    number_of_membership_months=0,
-                    account_type='Protocoin',
-                    category='Snacks',
-                    info_source='System',
-                    memo=memo,
-                )
-                utils.log_transaction(tx)
+        memo = 'Protocoin - Purchase spent ₱ {} on {} vending machine item #{}'.format(
+            amount,
+            machine,
+            number,
+        )
 
-                return Response(200)
-        except OperationalError:
-            self.card_vend_request(request, pk)
+        tx = models.Transaction.objects.create(
+            user=source_user,
+            protocoin=source_delta,
+            amount=0,
+            number_of_membership_months=0,
+            account_type='Protocoin',
+            category='Snacks',
+            info_source='System',
+            memo=memo,
+            vending_machine=machine,
+            vending_item=str(number),
+        )
+        utils.log_transaction(tx)
+
+        return Response(200)
 
     @action(detail=False, methods=['get'])
     def transactions(self, request):
         transactions = models.Transaction.objects.exclude(protocoin=0).order_by('-date', '-id')
-        total_protocoin = transactions.aggregate(Sum('protocoin'))['protocoin__sum'] or 0
+        total_protocoin = utils.get_protocoin_supply()
 
         serializer = serializers.ProtocoinTransactionSerializer(transactions, many=True)
 
@@ -1898,234 +1993,224 @@ class ProtocoinViewSet(Base):
         return Response(res)
 
     @action(detail=False, methods=['post'])
+    @utils_db.atomic_retry
     def printer_report(self, request, pk=None):
-        try:
-            with transaction.atomic():
-                auth_token = request.META.get('HTTP_AUTHORIZATION', '')
-                if secrets.PRINTER_API_TOKEN and not constant_time_compare(auth_token, 'Bearer ' + secrets.PRINTER_API_TOKEN):
-                    raise exceptions.PermissionDenied()
-
-                # {'job_name': 'download.png', 'uuid': '6abbad4d-dda3-4954-b4f1-ac77933a0562', 'timestamp': '20230211173624',
-                # 'job_status': '0', 'user_name': 'Tanner.Collin', 'source': '1', 'paper_name': 'Plain Paper', 'paper_sqi': '356', 'ink_ul': '54'}
-
-                job_uuid = request.data['uuid']
-                username = request.data['user_name']
-
-                logging.info('New printer job UUID: %s, username: %s', str(job_uuid), str(username))
-
-                if not job_uuid:
-                    msg = 'Missing job UUID, aborting.'
-                    utils.alert_tanner(msg)
-                    logger.error(msg)
-                    return Response(200)
-
-                tx = models.Transaction.objects.filter(reference_number=job_uuid)
-                if tx.exists():
-                    msg = 'Job {}: already billed for in transaction {}, aborting.'.format(job_uuid, tx[0].id)
-                    utils.alert_tanner(msg)
-                    logger.error(msg)
-                    return Response(200)
-
-                # status 0 = complete
-                # status 3 = cancelled
-
-                is_completed = request.data['job_status'] == '0'
-                is_print = request.data['source'] == '1'
-
-                if not is_completed:
-                    msg = 'Job {} user {}: not complete, aborting.'.format(job_uuid, username)
-                    utils.alert_tanner(msg)
-                    logger.error(msg)
-                    return Response(200)
-
-                if not is_print:
-                    msg = 'Job {} user {}: not a print, aborting.'.format(job_uuid, username)
-                    utils.alert_tanner(msg)
-                    logger.error(msg)
-                    return Response(200)
-
-                INK_PROTOCOIN_PER_ML = 0.75
-                DEFAULT_PAPER_PROTOCOIN_PER_M = 0.50
-                PROTOCOIN_PER_PRINT = 1.0
-
-                total_cost = PROTOCOIN_PER_PRINT
-                logging.info('    Fixed cost: %s', str(PROTOCOIN_PER_PRINT))
-
-                microliters = float(request.data['ink_ul'])
-                millilitres = microliters / 1000.0
-                cost = millilitres * INK_PROTOCOIN_PER_ML
-                total_cost += cost
-                logging.info('    %s ul ink cost: %s', str(microliters), str(cost))
-
-                PAPER_COSTS = {
-                    # Prices: https://forum.protospace.ca/t/issue-with-plotter-printer-protocoin/6928/20
-                    'Plain Paper': 1.00,
-                    'Photo Gloss Paper': 8.77,
-                    # Canvas price: https://forum.protospace.ca/t/motion-canvas-roll-for-44-t1200-large-format-printer/8640/8
-                    'Adhesive Polypropylene Matte': 20.54,
-                }
-
-                paper_name = request.data['paper_name']
-                squareinches = float(request.data['paper_sqi'])
-                squaremetres = squareinches / 1550.0
-                cost = squaremetres * PAPER_COSTS.get(paper_name, DEFAULT_PAPER_PROTOCOIN_PER_M)
-                total_cost += cost
-                logging.info('    %s sqi %s cost: %s', str(squareinches), paper_name, str(cost))
-
-                total_cost = round(total_cost, 2)
-
-                logging.info('Total cost: %s protocoin', str(total_cost))
-
-                if not username:
-                    logging.info('Username data missing, using track data...')
-
-                    track = cache.get('track', {})
-                    try:
-                        if time.time() - track['ARTEMUS']['time'] < 20*60:  # 20 minutes
-                            username = track['ARTEMUS']['username']
-                            logging.info('Found track username: %s', username)
-                    except:
-                        logging.info('Unable to derive username from track.')
-
-                if not username:
-                    msg = 'Job {}: missing username, aborting. Cost: {}'.format(job_uuid, str(total_cost))
-                    utils.alert_tanner(msg)
-                    logger.error(msg)
-                    return Response(200)
+        auth_token = request.META.get('HTTP_AUTHORIZATION', '')
+        if secrets.PRINTER_API_TOKEN and not constant_time_compare(auth_token, 'Bearer ' + secrets.PRINTER_API_TOKEN):
+            raise exceptions.PermissionDenied()
 
-                try:
-                    user = User.objects.get(username__istartswith=username)
-                except User.DoesNotExist:
-                    msg = 'Job {}: unable to find username {}, aborting. Cost: {}'.format(job_uuid, username, str(total_cost))
-                    utils.alert_tanner(msg)
-                    logger.error(msg)
-                    return Response(200)
-
-                memo = 'Protocoin - Purchase spent ₱ {} printing {}'.format(
-                    total_cost,
-                    request.data['job_name'][:100],
-                )
+        # {'job_name': 'download.png', 'uuid': '6abbad4d-dda3-4954-b4f1-ac77933a0562', 'timestamp': '20230211173624',
+        # 'job_status': '0', 'user_name': 'Tanner.Collin', 'source': '1', 'paper_name': 'Plain Paper', 'paper_sqi': '356', 'ink_ul': '54'}
 
-                tx = models.Transaction.objects.create(
-                    user=user,
-                    protocoin=-total_cost,
-                    amount=0,
-                    number_of_membership_months=0,
-                    account_type='Protocoin',
-                    category='Consumables',
-                    info_source='System',
-                    reference_number=job_uuid,
-                    memo=memo,
-                )
-                utils.log_transaction(tx)
+        job_uuid = request.data['uuid']
+        username = request.data['user_name']
+
+        logging.info('New printer job UUID: %s, username: %s', str(job_uuid), str(username))
 
-                track = cache.get('track', {})
+        if not job_uuid:
+            msg = 'Missing job UUID, aborting.'
+            transaction.on_commit(lambda: utils.alert_tanner(msg))
+            logger.error(msg)
+            return Response(200)
 
-                devicename = 'LASTLARGEPRINT'
-                first_name = username.split('.')[0].title()
+        tx = models.Transaction.objects.filter(reference_number=job_uuid)
+        if tx.exists():
+            msg = 'Job {}: already billed for in transaction {}, aborting.'.format(job_uuid, tx[0].id)
+            transaction.on_commit(lambda: utils.alert_tanner(msg))
+            logger.error(msg)
+            return Response(200)
 
-                track[devicename] = dict(
-                    time=time.time(),
-                    username=username,
-                    first_name=first_name,
-                )
-                cache.set('track', track)
+        # status 0 = complete
+        # status 3 = cancelled
 
-                return Response(200)
-        except OperationalError:
-            self.printer_report(request, pk)
+        is_completed = request.data['job_status'] == '0'
+        is_print = request.data['source'] == '1'
+
+        if not is_completed:
+            msg = 'Job {} user {}: not complete, aborting.'.format(job_uuid, username)
+            transaction.on_commit(lambda: utils.alert_tanner(msg))
+            logger.error(msg)
+            return Response(200)
+
+        if not is_print:
+            msg = 'Job {} user {}: not a print, aborting.'.format(job_uuid, username)
+            transaction.on_commit(lambda: utils.alert_tanner(msg))
+            logger.error(msg)
+            return Response(200)
+
+        INK_PROTOCOIN_PER_ML = 0.75
+        DEFAULT_PAPER_PROTOCOIN_PER_M = 0.50
+        PROTOCOIN_PER_PRINT = 1.0
+
+        total_cost = PROTOCOIN_PER_PRINT
+        logging.info('    Fixed cost: %s', str(PROTOCOIN_PER_PRINT))
+
+        microliters = float(request.data['ink_ul'])
+        millilitres = microliters / 1000.0
+        cost = millilitres * INK_PROTOCOIN_PER_ML
+        total_cost += cost
+        logging.info('    %s ul ink cost: %s', str(microliters), str(cost))
+
+        PAPER_COSTS = {
+            # Prices: https://forum.protospace.ca/t/issue-with-plotter-printer-protocoin/6928/20
+            'Plain Paper': 1.00,
+            'Photo Gloss Paper': 8.77,
+            # Canvas price: https://forum.protospace.ca/t/motion-canvas-roll-for-44-t1200-large-format-printer/8640/8
+            'Adhesive Polypropylene Matte': 20.54,
+        }
+
+        paper_name = request.data['paper_name']
+        squareinches = float(request.data['paper_sqi'])
+        squaremetres = squareinches / 1550.0
+        cost = squaremetres * PAPER_COSTS.get(paper_name, DEFAULT_PAPER_PROTOCOIN_PER_M)
+        total_cost += cost
+        logging.info('    %s sqi %s cost: %s', str(squareinches), paper_name, str(cost))
+
+        total_cost = round(total_cost, 2)
+
+        logging.info('Total cost: %s protocoin', str(total_cost))
+
+        if not username:
+            logging.info('Username data missing, using track data...')
+
+            track_graphics_computer = utils_stats.get_device_stat('track', 'ARTEMUS')
+            try:
+                if time.time() - track_graphics_computer['time'] < 20*60:  # 20 minutes
+                    username = track_graphics_computer['username']
+                    logging.info('Found track username: %s', username)
+            except:
+                logging.info('Unable to derive username from track.')
+
+        if not username:
+            msg = 'Job {}: missing username, aborting. Cost: {}'.format(job_uuid, str(total_cost))
+            transaction.on_commit(lambda: utils.alert_tanner(msg))
+            logger.error(msg)
+            return Response(200)
 
-    @action(detail=False, methods=['post'])
-    def cups_printer_report(self, request, pk=None):
         try:
-            with transaction.atomic():
-                auth_token = request.META.get('HTTP_AUTHORIZATION', '')
-                if secrets.PRINTER_API_TOKEN and not constant_time_compare(auth_token, 'Bearer ' + secrets.PRINTER_API_TOKEN):
-                    raise exceptions.PermissionDenied()
+            user = User.objects.get(username__istartswith=username)
+        except User.DoesNotExist:
+            msg = 'Job {}: unable to find username {}, aborting. Cost: {}'.format(job_uuid, username, str(total_cost))
+            transaction.on_commit(lambda: utils.alert_tanner(msg))
+            logger.error(msg)
+            return Response(200)
 
-                # {'job_id': '17', 'user': 'Tanner.Collin', 'title': 'test', 'printer': 'EpsonRAW', 'copies': '1'}
+        memo = 'Protocoin - Purchase spent ₱ {} printing {}'.format(
+            total_cost,
+            request.data['job_name'][:100],
+        )
 
-                job_id = request.data.get('job_id', '')
-                username = request.data.get('user', '')
-                printer = request.data.get('printer', 'unknown-printer')
-                try:
-                    copies = int(request.data.get('copies', '1'))
-                except ValueError:
-                    copies = 1
+        tx = models.Transaction.objects.create(
+            user=user,
+            protocoin=-total_cost,
+            amount=0,
+            number_of_membership_months=0,
+            account_type='Protocoin',
+            category='Consumables',
+            info_source='System',
+            reference_number=job_uuid,
+            memo=memo,
+        )
+        utils.log_transaction(tx)
+
+        devicename = 'LASTLARGEPRINT'
+        first_name = username.split('.')[0].title()
+
+        last_print = dict(
+            time=time.time(),
+            username=username,
+            first_name=first_name,
+        )
+        transaction.on_commit(lambda: utils_stats.set_device_stat('track', devicename, last_print))
 
-                logging.info('New %s printer job UUID: %s, username: %s', str(printer), str(job_id), str(username))
+        return Response(200)
 
-                if not job_id:
-                    msg = 'Missing job ID, aborting.'
-                    utils.alert_tanner(msg)
-                    raise exceptions.ValidationError(dict(job_id='This field is required.'))
+    @action(detail=False, methods=['post'])
+    @utils_db.atomic_retry
+    def cups_printer_report(self, request, pk=None):
+        auth_token = request.META.get('HTTP_AUTHORIZATION', '')
+        if secrets.PRINTER_API_TOKEN and not constant_time_compare(auth_token, 'Bearer ' + secrets.PRINTER_API_TOKEN):
+            raise exceptions.PermissionDenied()
 
-                if not username:
-                    msg = 'Job {}: missing username, aborting.'.format(job_id)
-                    utils.alert_tanner(msg)
-                    raise exceptions.ValidationError(dict(username='This field is required.'))
+        # {'job_id': '17', 'user': 'Tanner.Collin', 'title': 'test', 'printer': 'EpsonRAW', 'copies': '1'}
 
-                reference = 'cups-' + printer + '-' + job_id
+        job_id = request.data.get('job_id', '')
+        username = request.data.get('user', '')
+        printer = request.data.get('printer', 'unknown-printer')
+        try:
+            copies = int(request.data.get('copies', '1'))
+        except ValueError:
+            copies = 1
 
-                tx = models.Transaction.objects.filter(reference_number=reference)
-                if tx.exists():
-                    msg = 'Job {}: already billed for in transaction {}, aborting.'.format(job_id, tx[0].id)
-                    utils.alert_tanner(msg)
-                    raise exceptions.ValidationError(dict(non_field_errors=msg))
+        logging.info('New %s printer job UUID: %s, username: %s', str(printer), str(job_id), str(username))
 
+        if not job_id:
+            msg = 'Missing job ID, aborting.'
+            utils.alert_tanner(msg)
+            raise exceptions.ValidationError(dict(job_id='This field is required.'))
 
-                PROTOCOIN_PER_PRINT = 3.0
+        if not username:
+            msg = 'Job {}: missing username, aborting.'.format(job_id)
+            utils.alert_tanner(msg)
+            raise exceptions.ValidationError(dict(username='This field is required.'))
 
-                total_cost = PROTOCOIN_PER_PRINT * copies
-                logging.info('    Fixed cost: %s * %s', str(PROTOCOIN_PER_PRINT), str(copies))
+        reference = 'cups-' + printer + '-' + job_id
 
-                total_cost = round(total_cost, 2)
+        tx = models.Transaction.objects.filter(reference_number=reference)
+        if tx.exists():
+            msg = 'Job {}: already billed for in transaction {}, aborting.'.format(job_id, tx[0].id)
+            utils.alert_tanner(msg)
+            raise exceptions.ValidationError(dict(non_field_errors=msg))
 
-                logging.info('Total cost: %s protocoin', str(total_cost))
 
+        PROTOCOIN_PER_PRINT = 3.0
 
-                try:
-                    user = User.objects.get(username__istartswith=username)
-                except User.DoesNotExist:
-                    msg = 'Job {}: unable to find username {}, aborting. Cost: {}'.format(job_id, username, str(total_cost))
-                    utils.alert_tanner(msg)
-                    raise exceptions.ValidationError(dict(non_field_errors=msg))
-
-                memo = 'Protocoin - Purchase spent ₱ {} {} printing {}'.format(
-                    total_cost,
-                    printer,
-                    request.data.get('title', '')[:100],
-                )
+        total_cost = PROTOCOIN_PER_PRINT * copies
+        logging.info('    Fixed cost: %s * %s', str(PROTOCOIN_PER_PRINT), str(copies))
 
-                tx = models.Transaction.objects.create(
-                    user=user,
-                    protocoin=-total_cost,
-                    amount=0,
-                    number_of_membership_months=0,
-                    account_type='Protocoin',
-                    category='Consumables',
-                    info_source='System',
-                    reference_number=reference,
-                    memo=memo,
-                )
-                utils.log_transaction(tx)
+        total_cost = round(total_cost, 2)
 
-                track = cache.get('track', {})
+        logging.info('Total cost: %s protocoin', str(total_cost))
 
-                devicename = 'LAST' + printer + 'PRINT'
-                devicename = devicename.upper()
-                first_name = username.split('.')[0].title()
 
-                track[devicename] = dict(
-                    time=time.time(),
-                    username=username,
-                    first_name=first_name,
-                )
-                cache.set('track', track)
+        try:
+            user = User.objects.get(username__istartswith=username)
+        except User.DoesNotExist:
+            msg = 'Job {}: unable to find username {}, aborting. Cost: {}'.format(job_id, username, str(total_cost))
+            utils.alert_tanner(msg)
+            raise exceptions.ValidationError(dict(non_field_errors=msg))
+
+        memo = 'Protocoin - Purchase spent ₱ {} {} printing {}'.format(
+            total_cost,
+            printer,
+            request.data.get('title', '')[:100],
+        )
 
-                return Response(200)
-        except OperationalError:
-            self.cups_printer_report(request, pk)
+        tx = models.Transaction.objects.create(
+            user=user,
+            protocoin=-total_cost,
+            amount=0,
+            number_of_membership_months=0,
+            account_type='Protocoin',
+            category='Consumables',
+            info_source='System',
+            reference_number=reference,
+            memo=memo,
+        )
+        utils.log_transaction(tx)
+
+        devicename = 'LAST' + printer + 'PRINT'
+        devicename = devicename.upper()
+        first_name = username.split('.')[0].title()
+
+        last_print = dict(
+            time=time.time(),
+            username=username,
+            first_name=first_name,
+        )
+        transaction.on_commit(lambda: utils_stats.set_device_stat('track', devicename, last_print))
+
+        return Response(200)
 
 
 class PinballViewSet(Base):
@@ -2188,24 +2273,14 @@ class PinballViewSet(Base):
         def get_favourite_drink(member):
             if member.allow_last_scanned is False:
                 return 'Slug-O-Cola'
-            drinks = {
+            txs = member.user.transactions.filter(category='Snacks')
+            drinks = Counter()
+            for slot, count in utils_stats.count_drinks(txs).items():
                 # max drink length 11 chars
-                '1': 'Coke',
-                '2': 'Coke Zero',
-                '3': 'Root Beer',
-                '4': 'Iced Tea',
-                '5': 'Crush Pop',
-                '6': 'Dr. Pepper',
-                '7': 'Arizona Tea',
-                '8': 'Mystery Pop',
-            }
-            txs = member.user.transactions
-            memos = list(txs.filter(category='Snacks', memo__contains='pop vending machine').values_list('memo'))
-            favs = sorted(memos, key=memos.count, reverse=True)
-            if len(favs) < 10:
+                drinks[slot.short_name or slot.name[:11]] += count
+            if sum(drinks.values()) < 10:
                 return 'can of Pop'
-            favourite_number = favs[0][0][-1]
-            return drinks[favourite_number]
+            return drinks.most_common(1)[0][0]
 
         card = get_object_or_404(models.Card, card_number=pk)
         member = card.user.member
@@ -2337,7 +2412,7 @@ class HostingViewSet(Base):
             time_str=hosting.finished_at.astimezone(utils.DISPLAY_TZ).strftime('%-I:%M %p'),
             first_name=hosting.user.member.preferred_name,
         )
-        cache.set('closing', closing)
+        utils_stats.set_stat('closing', closing)
 
         return Response(200)
 
@@ -13,4 +13,14 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'apiserver.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# needs Django set up first
+from apiserver.api import utils_stream
+
+async def application(scope, receive, send):
+    # long-lived stats stream bypasses Django so idle subscribers are cheap
+    if scope['type'] == 'http' and scope['path'] == utils_stream.STREAM_PATH:
+        await utils_stream.stats_stream(scope, receive, send)
+    else:
+        await django_application(scope, receive, send)
@@ -135,10 +135,11 @@ WSGI_APPLICATION = 'apiserver.wsgi.application'
 
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
+        'ENGINE': 'apiserver.sqlite_backend',  # sqlite3 plus BEGIN IMMEDIATE
         'NAME': os.path.join(BASE_DIR, 'data/db.sqlite3'),
+        'CONN_MAX_AGE': 600,  # gunicorn workers keep their connection
         'OPTIONS': {
-            'timeout': 20,  # increased because generate_backups.py blocks
+            'timeout': 20,  # busy wait for the write lock, pragmas are set in api/signals.py
         },
     },
 }
@@ -0,0 +1,127 @@
+import django, sys, os
+os.environ['DJANGO_SETTINGS_MODULE'] = 'apiserver.settings'
+
+# throughput of concurrent door scans, vend requests and stats reads
+# with the old SQLite setup (rollback journal, new connection per request)
+# vs. WAL + pragmas + persistent connections
+# each run works on a fresh copy of data/db.sqlite3 and every client is its
+# own process, like the gunicorn workers
+
+import time
+import sqlite3
+import tempfile
+import multiprocessing
+from collections import Counter
+from django.conf import settings
+
+SOURCE = os.path.join(settings.BASE_DIR, 'data/db.sqlite3')
+COPY = os.path.join(tempfile.mkdtemp(), 'benchmark.sqlite3')
+settings.DATABASES['default']['NAME'] = COPY
+settings.CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}  # only measure the database
+settings.ALLOWED_HOSTS = ['testserver']
+django.setup()
+
+from django.db import connection, connections, reset_queries
+from django.db.backends.signals import connection_created
+from rest_framework.test import APIClient
+from apiserver.api import models, signals
+
+DURATION = 10
+DOOR_PROCS = 4
+VEND_PROCS = 4
+STATS_PROCS = 4
+
+def copy_db():
+    connections.close_all()
+    for suffix in ['', '-wal', '-shm']:
+        if os.path.exists(COPY + suffix):
+            os.remove(COPY + suffix)
+
+    src = sqlite3.connect(SOURCE)
+    dst = sqlite3.connect(COPY)
+    src.backup(dst)
+    src.close()
+    dst.close()
+
+def setup_members():
+    cards = []
+    for i in range(max(DOOR_PROCS, VEND_PROCS)):
+        user = models.User.objects.create(username='benchmark.user{}'.format(i), email='benchmark{}@email.com'.format(i))
+        models.Member.objects.create(user=user, first_name='Benchmark', last_name='User', preferred_name='Benchmark')
+        card = models.Card.objects.create(user=user, card_number='BE{:06d}'.format(i), active_status='card_active')
+        models.Transaction.objects.create(user=user, amount=0, protocoin=1000, account_type='Protocoin', category='Other')
+        cards.append(card.card_number)
+    return cards
+
+def door(client, card, state):
+    return client.post('/door/{}/seen/'.format(card))
+
+def vend(client, card, state):
+    balance = state.setdefault('balance', 1000)
+    response = client.post('/protocoin/{}/card_vend_request/'.format(card), dict(number=1, balance=balance, amount=1), format='json')
+    if response.status_code == 200:
+        state['balance'] = balance - 1
+    return response
+
+def stats(client, card, state):
+    return client.get('/stats/')
+
+def worker(name, func, card, results, start):
+    client = APIClient()
+    state = {}
+    counts = Counter()
+    time.sleep(max(0, start - time.time()))
+    while time.time() < start + DURATION:
+        try:
+            response = func(client, card, state)
+            ok = response.status_code == 200
+        except BaseException:
+            ok = False
+        counts[name + ('' if ok else '_errors')] += 1
+        reset_queries()  # DEBUG keeps every query
+    connection.close()
+    results.put(counts)
+
+def run(label, tuned):
+    copy_db()
+
+    if tuned:
+        connection_created.connect(signals.sqlite_pragmas_callback, dispatch_uid='sqlite_pragmas')
+        connections.databases['default']['CONN_MAX_AGE'] = 600
+    else:
+        connection_created.disconnect(dispatch_uid='sqlite_pragmas')
+        connections.databases['default']['CONN_MAX_AGE'] = 0
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA journal_mode = DELETE')
+
+    cards = setup_members()
+    connection.close()
+
+    queue = multiprocessing.Queue()
+    start = time.time() + 2
+    procs = []
+    for func, count in [(door, DOOR_PROCS), (vend, VEND_PROCS), (stats, STATS_PROCS)]:
+        for i in range(count):
+            args = (func.__name__, func, cards[i % len(cards)], queue, start)
+            procs.append(multiprocessing.Process(target=worker, args=args))
+
+    for p in procs: p.start()
+    results = Counter()
+    for p in procs: results.update(queue.get())
+    for p in procs: p.join()
+
+    total = sum(v for k, v in results.items() if not k.endswith('_errors'))
+    print('{:>7}: {:7.1f} req/s total'.format(label, total / DURATION))
+    for name in ['door', 'vend', 'stats']:
+        print('         {:>5}: {:7.1f} req/s, {} errors'.format(name, results[name] / DURATION, results[name + '_errors']))
+
+if not os.path.exists(SOURCE):
+    print('No database at', SOURCE)
+    sys.exit(1)
+
+print('{} door, {} vend, {} stats processes for {} s each'.format(DOOR_PROCS, VEND_PROCS, STATS_PROCS, DURATION))
+run('before', tuned=False)
+run('after', tuned=True)
+
+connections.close_all()
+os.remove(COPY)
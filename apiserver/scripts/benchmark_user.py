@@ -0,0 +1,70 @@
+import django, sys, os
+os.environ['DJANGO_SETTINGS_MODULE'] = 'apiserver.settings'
+
+# times serializing /user/ as the transaction table grows
+# works on a fresh copy of data/db.sqlite3, the live database is never touched
+
+import time
+import sqlite3
+import tempfile
+from django.conf import settings
+
+SOURCE = os.path.join(settings.BASE_DIR, 'data/db.sqlite3')
+COPY = os.path.join(tempfile.mkdtemp(), 'benchmark.sqlite3')
+settings.DATABASES['default']['NAME'] = COPY
+settings.CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}  # only measure the database
+django.setup()
+
+from django.db import connections, transaction, reset_queries
+from apiserver.api import models, serializers
+
+SIZES = [0, 10000, 50000, 100000]
+RUNS = 20
+OTHER_MEMBERS = 10
+
+def copy_db():
+    src = sqlite3.connect(SOURCE)
+    dst = sqlite3.connect(COPY)
+    src.backup(dst)
+    src.close()
+    dst.close()
+
+def create_member(i):
+    user = models.User.objects.create(username='benchmark.user{}'.format(i), email='benchmark{}@email.com'.format(i))
+    models.Member.objects.create(user=user, first_name='Benchmark', last_name='User', preferred_name='Benchmark')
+    return user
+
+def add_tx(user):
+    # save() like the views do so the ledger signals run
+    models.Transaction.objects.create(user=user, amount=0, protocoin=1, account_type='Protocoin', category='Other')
+
+def time_user(user):
+    start = time.time()
+    for _ in range(RUNS):
+        serializers.UserSerializer(user).data
+    return (time.time() - start) / RUNS * 1000
+
+if not os.path.exists(SOURCE):
+    print('No database at', SOURCE)
+    sys.exit(1)
+
+copy_db()
+
+user = create_member(0)
+add_tx(user)
+others = [create_member(i) for i in range(1, OTHER_MEMBERS + 1)]
+
+added = 0
+for size in SIZES:
+    with transaction.atomic():  # one commit per batch, it's only a copy
+        for i in range(added, size):
+            add_tx(others[i % len(others)])
+    added = size
+    reset_queries()  # DEBUG keeps every query
+
+    print('{:>7} transactions: {:.2f} ms per /user/'.format(size, time_user(user)))
+
+connections.close_all()
+os.remove(COPY)
+
+print('Done.')
@@ -0,0 +1,99 @@
+import django, sys, os
+os.environ['DJANGO_SETTINGS_MODULE'] = 'apiserver.settings'
+django.setup()
+
+import re
+from datetime import datetime
+
+from apiserver.api import models
+
+# slot contents before VendingSlot existed, only changed slots are imported
+DRINKS_SINCE = {
+    '1970-01-01': {
+        '1': 'Coke',
+        '2': 'Coke Zero',
+        '3': 'Root Beer',
+        '4': 'Iced Tea',
+        '5': 'Crush Pop',
+        '6': 'Dr Pepper',
+        '7': 'Arizona Tea',
+        '8': 'Cherry Coke',
+    },
+    '2025-04-01': {
+        '5': 'Fanta',
+    },
+    '2026-01-08': {
+        '7': 'Diet Coke',
+    },
+    '2026-01-19': {
+        '8': 'Brisk Iced Tea',
+    },
+    '2026-02-01': {
+        '7': 'Brisk Iced Tea',
+        '8': 'Diet Coke',
+    },
+    '2026-02-11': {
+        '4': 'Lime Bubly',
+    },
+}
+
+COLORS = {
+    'Coke': '#e7223a',
+    'Coke Zero': 'black',
+    'Root Beer': '#9a4423',
+    'Iced Tea': '#1582ae',
+    'Crush Pop': '#d77a2d',
+    'Fanta': '#ffd700',
+    'Dr Pepper': '#6f0e21',
+    'Arizona Tea': '#3fad96',
+    'Cherry Coke': '#ab316e',
+    'Diet Coke': '#c8b560',
+    'Brisk Iced Tea': '#f07e05',
+    'Lime Bubly': '#00ff00',
+}
+
+# for the pinball machine, max 11 chars
+SHORT_NAMES = {
+    'Dr Pepper': 'Dr. Pepper',
+    'Brisk Iced Tea': 'Brisk Tea',
+}
+
+MEMO_RE = re.compile(r'on (.+?) vending machine item #(\S+)$')
+
+if models.VendingSlot.objects.filter(machine='pop').exists():
+    print('Pop slots already imported, skipping.')
+else:
+    for since, slots in DRINKS_SINCE.items():
+        for number, name in slots.items():
+            models.VendingSlot.objects.create(
+                machine='pop',
+                number=number,
+                name=name,
+                short_name=SHORT_NAMES.get(name, None),
+                color=COLORS[name],
+                since=datetime.strptime(since, '%Y-%m-%d').date(),
+            )
+            print('Slot', number, 'since', since, '-->', name)
+
+transactions = models.Transaction.objects.filter(
+    category='Snacks',
+    memo__contains='vending machine item #',
+    vending_item__isnull=True,
+)
+updated = []
+
+for tx in transactions:
+    match = MEMO_RE.search(tx.memo)
+    if not match:
+        print('Skipping tx', tx.id, 'memo:', tx.memo)
+        continue
+
+    tx.vending_machine, tx.vending_item = match.groups()
+    updated.append(tx)
+
+print('Performing bulk update...')
+models.Transaction.objects.bulk_update(updated, ['vending_machine', 'vending_item'], batch_size=500)
+
+print('Processed', len(updated), 'vending transactions.')
+
+print('Done.')